@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the startup catch-up of a job with a `state_file`.
+
+Builds a tree of `width` subdirectories per directory over `depth` levels, with
+`files` files in every directory, in a temporary directory, then times:
+
+* the first indexing of the tree, saved to the state file,
+* the catch-up of an unchanged tree, for a job watching modifications (every
+  file is stat'ed) and for a job watching only creations and deletions (the
+  directories whose mtime did not change are not listed),
+* the catch-up after `--changes` files were created and as many deleted.
+
+    python benchmarks/bench_catchup.py [--depth 3] [--width 20] [--files 20]
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os, sys
+import argparse, shutil, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyinotify
+import watcher
+
+
+class Handler(object):
+    """ Stand-in for the `EventHandler` of the job, counting the events. """
+    job = 'bench'
+    timers = None
+
+    def __init__(self):
+        self.events = 0
+
+    def __call__(self, event):
+        self.events += 1
+
+
+def build_tree(top, depth, width, files):
+    """ Create the synthetic tree and return its directories. """
+    dirs = [top]
+    level = [top]
+    for _ in range(depth):
+        next_level = []
+        for path in level:
+            for i in range(width):
+                sub = os.path.join(path, 'd%d' % i)
+                os.mkdir(sub)
+                next_level.append(sub)
+        dirs.extend(next_level)
+        level = next_level
+    for path in dirs:
+        for i in range(files):
+            open(os.path.join(path, 'f%d' % i), 'w').close()
+    return dirs
+
+
+def catch_up(top, state_file, mask):
+    index = watcher.TreeIndex(top, True, watcher.PathTrie(), watcher.FileFilter(), mask,
+                              state_file=state_file, key='bench')
+    handler = Handler()
+    start = time.time()
+    index.build(handler)
+    elapsed = time.time() - start
+    index.close()
+    return elapsed, index.count, handler.events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3, help='levels of subdirectories (default: %(default)s)')
+    parser.add_argument('--width', type=int, default=20, help='subdirectories per directory (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=20, help='files per directory (default: %(default)s)')
+    parser.add_argument('--changes', type=int, default=100, help='files created and deleted (default: %(default)s)')
+    parser.add_argument('--dir', help='where to create the tree (default: system temp dir)')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='watcher-bench-', dir=args.dir)
+    state_file = top + '.db'
+    all_events = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY
+    create_delete = pyinotify.IN_CREATE | pyinotify.IN_DELETE
+    try:
+        dirs = build_tree(top, args.depth, args.width, args.files)
+        print('%d directories, %d files in %s' % (len(dirs), len(dirs) * (args.files + 1), top))
+        # directories modified within the last second are always listed again
+        time.sleep(1.1)
+        results = [('first indexing', catch_up(top, state_file, all_events)),
+                   ('unchanged, create|delete|modify', catch_up(top, state_file, all_events)),
+                   ('unchanged, create|delete', catch_up(top, state_file, create_delete))]
+        step = max(1, len(dirs) // args.changes)
+        for path in dirs[::step][:args.changes]:
+            open(os.path.join(path, 'new'), 'w').close()
+            os.unlink(os.path.join(path, 'f0'))
+        time.sleep(1.1)
+        results.append(('%d changes, create|delete' % (2 * args.changes), catch_up(top, state_file, create_delete)))
+        for (name, (elapsed, paths, events)) in results:
+            print('%-36s %7.2fs %9.0f paths/s %7d events' % (name, elapsed, paths / elapsed, events))
+    finally:
+        shutil.rmtree(top)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(state_file + suffix):
+                os.unlink(state_file + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the per-event cost of the job filters.
+
+Compares the `FileFilter` of watcher.py with the former implementation, which
+called `endswith` for every included and excluded extension, on the example
+job of watcher.ini (include_extensions=video, exclude_extensions=mkv,
+exclude_re=~$).
+
+    python benchmarks/bench_filters.py [-n NUMBER]
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os, sys
+import argparse, re, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import watcher
+
+PATHNAMES = ['/data/video/Some.Show.S01E01.720p.mkv',
+             '/data/video/Some.Show.S01E02.720p.mp4',
+             '/data/video/Some.Show.S01E02.720p.en.srt',
+             '/data/video/.Some.Show.S01E02.720p.mp4.part',
+             '/data/video/Some.Show.S01E03.720p.xvid~',
+             '/data/video/poster.jpg']
+
+
+def legacy_filter(include_extensions, exclude_extensions, exclude_re):
+    """ Filters as done by `EventHandler.runCommand` before `FileFilter`. """
+    def run(pathname):
+        if include_extensions and all(not pathname.endswith(ext) for ext in include_extensions):
+            return False
+        if exclude_extensions and any(pathname.endswith(ext) for ext in exclude_extensions):
+            return False
+        if exclude_re and exclude_re.search(os.path.basename(pathname)):
+            return False
+        return True
+    return run
+
+
+def bench(func, number):
+    """ Return the mean cost of `func` in nanoseconds per pathname. """
+    def loop():
+        for pathname in PATHNAMES:
+            func(pathname)
+    best = min(timeit.repeat(loop, number=number, repeat=5))
+    return best / number / len(PATHNAMES) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000, help='loops per measure (default: %(default)s)')
+    args = parser.parse_args()
+
+    include_extensions = set(watcher.VIDEO_EXTENSIONS)
+    exclude_extensions = set(['mkv'])
+    legacy = legacy_filter(include_extensions, exclude_extensions, re.compile('~$'))
+    compiled = watcher.FileFilter(include_extensions, exclude_extensions, '~$')
+    for pathname in PATHNAMES:
+        if legacy(pathname) != (compiled(pathname) is None):
+            print('Warning: filters disagree on %s' % pathname)
+
+    legacy_ns = bench(legacy, args.number)
+    compiled_ns = bench(compiled, args.number)
+    print('legacy endswith filters: %8.0f ns/event' % legacy_ns)
+    print('compiled FileFilter:     %8.0f ns/event' % compiled_ns)
+    print('speedup:                 %8.1fx' % (legacy_ns / compiled_ns))
+
+
+if __name__ == '__main__':
+    main()
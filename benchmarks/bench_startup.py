@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the startup scan of a recursive job on a synthetic tree.
+
+Builds a tree of `width` subdirectories per directory over `depth` levels in a
+temporary directory, then times the watch of the whole tree with:
+
+* pyinotify's recursive `add_watch` (former startup of watcher.py),
+* `TreeScanner` with 1 thread and with `--threads` threads.
+
+    python benchmarks/bench_startup.py [--depth 3] [--width 20] [--threads 4]
+
+The number of directories must stay below fs.inotify.max_user_watches.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os, sys
+import argparse, shutil, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyinotify
+import watcher
+
+
+def build_tree(top, depth, width):
+    """ Create the synthetic tree and return its number of directories. """
+    count = 1
+    level = [top]
+    for _ in range(depth):
+        next_level = []
+        for path in level:
+            for i in range(width):
+                sub = os.path.join(path, 'd%d' % i)
+                os.mkdir(sub)
+                next_level.append(sub)
+        count += len(next_level)
+        level = next_level
+    return count
+
+
+def bench_pyinotify(top):
+    wm = pyinotify.WatchManager()
+    start = time.time()
+    wm.add_watch(top, pyinotify.IN_CREATE, rec=True)
+    elapsed = time.time() - start
+    wm.close()
+    return elapsed
+
+
+def bench_scanner(top, threads):
+    wm = pyinotify.WatchManager()
+
+    def visit(path):
+        return wm.add_watch(path, pyinotify.IN_CREATE).get(path, -1) >= 0
+    start = time.time()
+    watcher.TreeScanner(top, watcher.PathTrie(), visit, threads, 'bench').run()
+    elapsed = time.time() - start
+    wm.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3, help='levels of subdirectories (default: %(default)s)')
+    parser.add_argument('--width', type=int, default=20, help='subdirectories per directory (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=4, help='scan threads (default: %(default)s)')
+    parser.add_argument('--dir', help='where to create the tree (default: system temp dir)')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='watcher-bench-', dir=args.dir)
+    try:
+        count = build_tree(top, args.depth, args.width)
+        print('%d directories in %s' % (count, top))
+        results = [('pyinotify add_watch(rec=True)', bench_pyinotify(top)),
+                   ('TreeScanner, 1 thread', bench_scanner(top, 1)),
+                   ('TreeScanner, %d threads' % args.threads, bench_scanner(top, args.threads))]
+        for (name, elapsed) in results:
+            print('%-32s %7.2fs %9.0f dirs/s' % (name, elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the memory of the watch table for large trees.
+
+Fills, in a child process each, the watch table of `--dirs` directories of a
+synthetic tree of `width` subdirectories per directory:
+
+* 'pyinotify': a `pyinotify.WatchManager`, with a `Watch` object per watch,
+  and the {path: wd} dict the engines used to keep,
+* 'compact': a `CompactWatchManager`.
+
+The kernel limits the number of inotify watches (fs.inotify.max_user_watches),
+so the watch descriptors are made up and the directories do not exist: only
+the table is measured, not the rest of the daemon (see loadtest.py for its
+RSS per watched directory). It reports the RSS of the child before and after
+filling the table, the time to fill it, and the time to get the path of a
+watch (as for every event) and the watch of a path (as for every new directory).
+
+    python benchmarks/bench_watch_table.py [--dirs 100000,1000000] [--width 20] [--names repeated]
+
+With '--names unique', every directory has a different name, e.g. for trees of
+hashes, and the names cannot be shared.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os, sys
+import argparse, gc, random, subprocess, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyinotify
+import watcher
+
+TOP = '/srv/watcher-bench/data'
+
+
+def tree_paths(count, width, unique):
+    """ Paths of the first `count` directories of the tree, breadth first.
+
+        Directory i > 0 is in directory (i - 1) // width, the paths are built
+        one at a time so that only the table takes memory.
+        """
+    for i in range(count):
+        parts = []
+        while i > 0:
+            parts.append('%08x' % i if unique else 'd%d' % ((i - 1) % width))
+            i = (i - 1) // width
+        parts.append(TOP)
+        yield '/'.join(reversed(parts))
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def fill(table, count, width, unique):
+    """ Fill a watch table as the engines do, return it with the time it took. """
+    excluded = watcher.PathTrie()
+    mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE
+    start = time.time()
+    if table == 'compact':
+        wm = watcher.CompactWatchManager()
+        for (wd, path) in enumerate(tree_paths(count, width, unique), 1):
+            wm.register(wd, path, mask, None, True, excluded, True)
+        wdd = None
+    else:
+        wm = pyinotify.WatchManager()
+        wdd = dict()
+        for (wd, path) in enumerate(tree_paths(count, width, unique), 1):
+            watch = pyinotify.Watch(wd, os.path.normpath(path), mask, None, True, excluded)
+            watch.dir = True
+            wm._wmd[wd] = watch
+            wdd[path] = wd
+    return wm, wdd, time.time() - start
+
+
+def child(table, count, width, unique):
+    gc.collect()
+    before = rss_kb()
+    wm, wdd, elapsed = fill(table, count, width, unique)
+    gc.collect()
+    after = rss_kb()
+    wds = [random.randint(1, count) for _ in range(100000)]
+    start = time.time()
+    for wd in wds:
+        wm.get_path(wd)
+    get_path = (time.time() - start) / len(wds)
+    paths = [wm.get_path(wd) for wd in wds[:1000 if table == 'compact' else 10]]
+    start = time.time()
+    for path in paths:
+        wm.get_wd(path)
+    get_wd = (time.time() - start) / len(paths)
+    print('%d %d %f %f %f' % (before, after, elapsed, get_path, get_wd))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirs', default='100000,1000000', help='numbers of directories (default: %(default)s)')
+    parser.add_argument('--width', type=int, default=20, help='subdirectories per directory (default: %(default)s)')
+    parser.add_argument('--names', choices=('repeated', 'unique'), default='repeated',
+                        help="'repeated': d0, d1... in every directory, 'unique': a different name for every directory (default: %(default)s)")
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    unique = args.names == 'unique'
+    if args.child:
+        return child(args.child[0], int(args.child[1]), args.width, unique)
+
+    print('%-10s %9s %11s %11s %10s %9s %12s %12s' % ('table', 'dirs', 'RSS before', 'RSS after', 'bytes/dir',
+                                                      'fill', 'get_path', 'get_wd'))
+    for count in [int(n) for n in args.dirs.split(',')]:
+        for table in ('pyinotify', 'compact'):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--width', str(args.width),
+                                              '--names', args.names, '--child', table, str(count)])
+            before, after, elapsed, get_path, get_wd = output.decode().split()
+            before, after = int(before), int(after)
+            print('%-10s %9d %8d kB %8d kB %10.0f %8.2fs %10.2fus %10.2fus' % (
+                  table, count, before, after, (after - before) * 1024 / count, float(elapsed),
+                  float(get_path) * 1e6, float(get_wd) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test of the daemon: startup, event throughput, latency and memory.
+
+Builds a tree of `width` subdirectories per directory over `depth` levels, with
+`files` files in every directory, in a temporary directory, writes an ini file
+with a recursive job on it, runs `watcher.py debug` on it and measures:
+
+* the startup time, until all the directories are watched (polled from the
+  `watcher_watches` metric of the stats socket; without stats socket, e.g. for
+  an older daemon given with `--watcher`, until the command runs for a file
+  written in the last directory of the tree),
+* the RSS of the daemon per watched directory, compared to a daemon watching an
+  empty directory, and its number of threads, idle and at the peak of the test,
+* the p50/p99 latency from an event to its command: files are created at
+  `--latency-rate` and the command of the job writes the time it ran,
+* the event rate sustained before an IN_Q_OVERFLOW: storms of create, modify
+  and move events at doubling rates, on '.storm' files excluded by the filters
+  of the job so that no command runs; it needs the stats socket.
+
+The results are written as JSON to `--output`. Compare them to a previous run
+with `--compare`, which fails if a result is worse by more than `--tolerance`.
+
+    python benchmarks/loadtest.py [--depth 2] [--width 20] [--engine shared] [--output new.json] [--compare old.json]
+
+Extra options of the job are given with `--option name=value`.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os, sys
+import argparse, json, multiprocessing, random, shutil, signal, subprocess, tempfile, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import watcher
+
+STORM_EVENTS = {'create': 1, 'modify': 1, 'move': 2}   # events per operation
+
+
+def build_tree(top, depth, width, files):
+    """ Create the synthetic tree and return its directories. """
+    dirs = [top]
+    level = [top]
+    for _ in range(depth):
+        next_level = []
+        for path in level:
+            for i in range(width):
+                sub = os.path.join(path, 'd%d' % i)
+                os.mkdir(sub)
+                next_level.append(sub)
+        dirs.extend(next_level)
+        level = next_level
+    for path in dirs:
+        for i in range(files):
+            open(os.path.join(path, 'f%d' % i), 'w').close()
+    return dirs
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Daemon(object):
+    """ `watcher.py debug` running a generated ini file, with its stats socket.
+        """
+    def __init__(self, workdir, name, tree, engine, latency_log, options, script):
+        self.script = script
+        self.latency_log = latency_log
+        self.stats = True
+        self.ini = os.path.join(workdir, name + '.ini')
+        self.socket = os.path.join(workdir, name + '.sock')
+        self.log = os.path.join(workdir, name + '.log')
+        self.process = None
+        self.peak_threads = 0
+        with open(self.ini, 'w') as f:
+            f.write('[DEFAULT]\n')
+            f.write('logfile=%s\npidfile=%s\n' % (self.log, os.path.join(workdir, name + '.pid')))
+            f.write('stats_socket=%s\nengine=%s\n' % (self.socket, engine))
+            f.write('working_directory=\numask=\ngid=\nuid=\n\n')
+            f.write('[load]\n')
+            job = dict(watch=tree, events='create,modify,move', recursive='true', autoadd='true',
+                       excluded='', include_extensions='', exclude_extensions='.storm', exclude_re='',
+                       background='false', outfile='', max_concurrency=str(multiprocessing.cpu_count()),
+                       # '%' is doubled for the interpolation of ConfigParser
+                       command='echo $filename $$(date +%%s.%%N) >> ' + latency_log)
+            job.update(options)
+            for (name, value) in sorted(job.items()):
+                f.write('%s=%s\n' % (name, value))
+
+    def start(self):
+        self.started = time.time()
+        with open(self.log, 'ab') as log:
+            self.process = subprocess.Popen([sys.executable, self.script, 'debug', '-c', self.ini],
+                                            stdout=log, stderr=subprocess.STDOUT)
+
+    def metrics(self):
+        """ Values of the metrics, summed over their labels; empty if the daemon is not ready.
+            """
+        try:
+            text = watcher.query_stats(self.socket)
+        except (IOError, OSError):
+            return {}
+        values = {}
+        for line in text.splitlines():
+            if line.startswith('#') or not line.strip():
+                continue
+            (name, value) = line.rsplit(' ', 1)
+            name = name.split('{', 1)[0]
+            values[name] = values.get(name, 0) + float(value)
+        return values
+
+    def status(self, field):
+        """ Field of /proc/<pid>/status, as an integer (kB for the memory). """
+        with open('/proc/%d/status' % self.process.pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+        return None
+
+    def sample(self):
+        self.peak_threads = max(self.peak_threads, self.status('Threads'))
+
+    def wait_watches(self, count, timeout, probe):
+        """ Wait until `count` directories are watched; return the time since the start.
+
+            The daemon starts its stats socket before watching the tree. Without
+            it, wait until the command runs for the file `probe`, written every
+            poll, instead.
+            """
+        while time.time() - self.started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError('the daemon exited, see %s' % self.log)
+            if os.path.exists(self.socket):
+                if self.metrics().get('watcher_watches', 0) >= count:
+                    self.sample()
+                    return time.time() - self.started
+            elif self.probed(probe):
+                self.stats = False
+                self.sample()
+                return time.time() - self.started
+            time.sleep(0.02)
+        raise RuntimeError('%d directories not watched after %ds, see %s' % (count, timeout, self.log))
+
+    def probed(self, probe):
+        """ Write to the file `probe`, return True if the command of the job ran for it.
+            """
+        with open(probe, 'a') as f:
+            f.write('x')
+        if not os.path.exists(self.latency_log):
+            return False
+        with open(self.latency_log) as f:
+            return any(line.split(' ', 1)[0] == probe for line in f)
+
+    def wait_received(self, count, timeout):
+        """ Wait until the daemon received `count` events, or they stop coming; return its metrics.
+            """
+        deadline = time.time() + timeout
+        last, idle = None, 0
+        while time.time() < deadline:
+            values = self.metrics()
+            self.sample()
+            received = values.get('watcher_events_received_total', 0)
+            if received >= count:
+                break
+            idle = idle + 1 if received == last else 0
+            if idle >= 10:
+                break
+            last = received
+            time.sleep(0.1)
+        return values
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        for _ in range(100):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        self.process.kill()
+        self.process.wait()
+
+
+def measure_latency(daemon, dirs, latency_log, count, rate):
+    """ Create `count` files at `rate` per second and read the time their command ran.
+        """
+    created = {}
+    start = time.time()
+    for i in range(count):
+        delay = start + i / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        path = os.path.join(random.choice(dirs), 'lat%d' % i)
+        created[path] = time.time()
+        open(path, 'w').close()
+    ran = {}
+    deadline = time.time() + 30
+    while len(ran) < count and time.time() < deadline:
+        daemon.sample()
+        time.sleep(0.2)
+        if os.path.exists(latency_log):
+            with open(latency_log) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        ran[parts[0]] = float(parts[1])
+    latencies = [(ran[path] - created[path]) * 1000 for path in created if path in ran]
+    result = dict(count=count, rate=rate, missing=count - len(latencies))
+    if latencies:
+        result.update(p50_ms=round(percentile(latencies, 50), 2), p99_ms=round(percentile(latencies, 99), 2),
+                      max_ms=round(max(latencies), 2), mean_ms=round(sum(latencies) / len(latencies), 2))
+    return result
+
+
+def storm(dirs, files, moved, ops, rate, duration):
+    """ Generate create, modify and move events on '.storm' files at `rate` events per second.
+
+        `files` are modified and renamed, the renamed ones are in `moved`.
+        Return the number of events generated and the time it took.
+        """
+    created = []
+    events = 0
+    start = time.time()
+    while True:
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+        target = rate * elapsed
+        if events >= target:
+            time.sleep(0.005)
+            continue
+        while events < target:
+            op = random.choice(ops)
+            if op == 'create':
+                path = os.path.join(random.choice(dirs), 'c%d.storm' % len(created))
+                open(path, 'w').close()
+                created.append(path)
+            elif op == 'modify':
+                path = random.choice(files)
+                with open(path + '.moved.storm' if path in moved else path, 'a') as f:
+                    f.write('x')
+            else:
+                path = random.choice(files)
+                if path in moved:
+                    os.rename(path + '.moved.storm', path)
+                    moved.discard(path)
+                else:
+                    os.rename(path, path + '.moved.storm')
+                    moved.add(path)
+            events += STORM_EVENTS[op]
+    elapsed = time.time() - start
+    # deletions are not in the mask of the job: they do not queue events
+    for path in created:
+        os.unlink(path)
+    return events, elapsed
+
+
+def measure_throughput(daemon, dirs, ops, start_rate, max_rate, duration):
+    """ Run storms at doubling rates until the event queue overflows.
+
+        The sustained rate is the one of the last storm without overflow; it is
+        the rate of the generator if it cannot go faster.
+        """
+    files = [os.path.join(path, 'x%d.storm' % i) for path in dirs for i in range(2)]
+    for path in files:
+        open(path, 'w').close()
+    moved = set()
+    daemon.wait_received(float('inf'), 10)
+    steps = []
+    sustained = 0
+    limited = False
+    rate = start_rate
+    while rate <= max_rate:
+        before = daemon.metrics()
+        events, elapsed = storm(dirs, files, moved, ops, rate, duration)
+        expected = before.get('watcher_events_received_total', 0) + events
+        after = daemon.wait_received(expected, 60)
+        overflows = after.get('watcher_queue_overflows_total', 0) - before.get('watcher_queue_overflows_total', 0)
+        received = after.get('watcher_events_received_total', 0) - before.get('watcher_events_received_total', 0)
+        step = dict(rate=rate, generated=events, generated_rate=round(events / elapsed), received=int(received),
+                    overflow=overflows > 0)
+        steps.append(step)
+        print('storm at %6d events/s: %6d generated (%6d/s), %6d received%s' % (
+              rate, events, step['generated_rate'], received, ', OVERFLOW' if overflows else ''), file=sys.stderr)
+        if overflows:
+            break
+        sustained = step['generated_rate']
+        if step['generated_rate'] < rate * 0.8:
+            limited = True
+            break
+        rate *= 2
+    for path in files:
+        os.unlink(path + '.moved.storm' if path in moved else path)
+    return dict(steps=steps, sustained_events_per_second=sustained, limited_by_generator=limited)
+
+
+def compare(results, previous, tolerance):
+    """ Print the results next to `previous` ones; return the names of the regressions.
+        """
+    checks = [('startup_seconds', ('startup_seconds',), False),
+              ('rss_bytes_per_directory', ('rss_bytes_per_directory',), False),
+              ('threads.peak', ('threads', 'peak'), False),
+              ('latency.p50_ms', ('latency', 'p50_ms'), False),
+              ('latency.p99_ms', ('latency', 'p99_ms'), False),
+              ('throughput.sustained', ('throughput', 'sustained_events_per_second'), True)]
+    regressions = []
+    for (name, keys, higher_is_better) in checks:
+        old, new = previous, results
+        for key in keys:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ' REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(name)
+        print('%-26s %12.2f -> %12.2f  %+6.1f%%%s' % (name, old, new, change * 100, flag), file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=2, help='levels of subdirectories (default: %(default)s)')
+    parser.add_argument('--width', type=int, default=20, help='subdirectories per directory (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=5, help='files per directory (default: %(default)s)')
+    parser.add_argument('--engine', default='threaded', help='engine of the daemon (default: %(default)s)')
+    parser.add_argument('--watcher', default=os.path.join(ROOT, 'watcher.py'),
+                        help='watcher.py to run, e.g. of a baseline revision (default: %(default)s)')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE', help='extra option of the job')
+    parser.add_argument('--latency-count', type=int, default=500, help='files created for the latency (default: %(default)s)')
+    parser.add_argument('--latency-rate', type=float, default=100, help='files created per second (default: %(default)s)')
+    parser.add_argument('--ops', default='create,modify,move', help='operations of the storms (default: %(default)s)')
+    parser.add_argument('--start-rate', type=int, default=1000, help='events/s of the first storm (default: %(default)s)')
+    parser.add_argument('--max-rate', type=int, default=256000, help='events/s of the last storm (default: %(default)s)')
+    parser.add_argument('--storm-duration', type=float, default=2, help='seconds per storm (default: %(default)s)')
+    parser.add_argument('--output', help='JSON file of the results (default: stdout)')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression (default: %(default)s)')
+    parser.add_argument('--dir', help='where to create the tree (default: system temp dir)')
+    parser.add_argument('--keep', action='store_true', help='keep the tree, ini and log files')
+    args = parser.parse_args()
+    options = dict(option.split('=', 1) for option in args.option)
+    ops = args.ops.split(',')
+    for op in ops:
+        if op not in STORM_EVENTS:
+            parser.error('unknown operation %r' % op)
+
+    workdir = tempfile.mkdtemp(prefix='watcher-load-', dir=args.dir)
+    top = os.path.join(workdir, 'tree')
+    empty = os.path.join(workdir, 'empty')
+    os.mkdir(top)
+    os.mkdir(empty)
+    latency_log = os.path.join(workdir, 'latency.txt')
+    daemons = []
+    try:
+        dirs = build_tree(top, args.depth, args.width, args.files)
+        print('%d directories, %d files in %s' % (len(dirs), len(dirs) * args.files, top), file=sys.stderr)
+
+        baseline = Daemon(workdir, 'baseline', empty, args.engine, os.path.join(workdir, 'baseline.txt'), options,
+                          args.watcher)
+        daemons.append(baseline)
+        baseline.start()
+        baseline.wait_watches(1, 60, os.path.join(empty, 'probe'))
+        baseline_rss = baseline.status('VmRSS')
+        baseline.stop()
+
+        daemon = Daemon(workdir, 'load', top, args.engine, latency_log, options, args.watcher)
+        daemons.append(daemon)
+        daemon.start()
+        # the tree is watched top down: its last directory is among the last ones watched
+        startup = daemon.wait_watches(len(dirs), 600, os.path.join(dirs[-1], 'probe'))
+        # the index of the job is built in the background once the tree is watched
+        time.sleep(1)
+        rss = daemon.status('VmRSS')
+        idle_threads = daemon.status('Threads')
+        print('watched in %.2fs, RSS %d kB, %d threads' % (startup, rss, idle_threads), file=sys.stderr)
+
+        latency = measure_latency(daemon, dirs, latency_log, args.latency_count, args.latency_rate)
+        print('latency: %s' % latency, file=sys.stderr)
+        if daemon.stats:
+            throughput = measure_throughput(daemon, dirs, ops, args.start_rate, args.max_rate, args.storm_duration)
+        else:
+            print('no stats socket: startup timed until the first event, throughput not measured', file=sys.stderr)
+            throughput = None
+        daemon.sample()
+        daemon.stop()
+
+        try:
+            revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                               cwd=os.path.dirname(os.path.abspath(args.watcher)),
+                                               stderr=open(os.devnull, 'w')).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            revision = None
+        results = dict(revision=revision, python=sys.version.split()[0], time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       parameters=vars(args), directories=len(dirs), files=len(dirs) * args.files,
+                       startup_seconds=round(startup, 3), startup_until_first_event=not daemon.stats,
+                       rss_kb=rss, baseline_rss_kb=baseline_rss,
+                       rss_bytes_per_directory=round((rss - baseline_rss) * 1024 / len(dirs), 1),
+                       threads=dict(idle=idle_threads, peak=daemon.peak_threads),
+                       latency=latency, throughput=throughput)
+    finally:
+        for daemon in daemons:
+            daemon.stop()
+        if args.keep:
+            print('kept %s' % workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit('regressions: %s' % ', '.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import os, sys
+import configparser
+
+import pyinotify
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import watcher
+
+# options without default of a job section
+JOB_OPTIONS = dict(events='create', excluded='', include_extensions='', exclude_extensions='', exclude_re='',
+                   recursive='true', autoadd='true', background='false', outfile='', command='cmd $filename')
+
+
+class FakeTimers(object):
+    """ `TimerQueue` whose timers only run when the test fires them, on a clock moved by `advance`. """
+    def __init__(self):
+        self.timers = []
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        timer = watcher.Timer(self.now + delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        """ Move the clock `seconds` ahead, running the timers due meanwhile. """
+        end = self.now + seconds
+        while True:
+            due = [timer for timer in self.timers if timer.when <= end and not timer.cancelled]
+            if not due:
+                break
+            timer = min(due, key=lambda timer: timer.when)
+            self.timers.remove(timer)
+            self.now = max(self.now, timer.when)
+            timer.callback(*timer.args)
+        self.now = end
+
+    def fire(self):
+        """ Run the pending timers, by delay, and the timers they add. """
+        while self.timers:
+            timers, self.timers = sorted(self.timers, key=lambda timer: timer.when), []
+            for timer in timers:
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+
+def make_event(mask, pathname, cookie=0, wd=1):
+    path, name = os.path.split(pathname)
+    return pyinotify.Event({'wd': wd, 'mask': mask, 'cookie': cookie, 'path': path, 'name': name,
+                            'dir': bool(mask & pyinotify.IN_ISDIR)})
+
+
+def make_job(name='job', **options):
+    """ Job parsed by `parse_job`, from the options of its section. """
+    config = configparser.ConfigParser()
+    config[name] = dict(JOB_OPTIONS, **options)
+    return watcher.parse_job(config, name)
+
+
+@pytest.fixture
+def timers():
+    return FakeTimers()
+
+
+@pytest.fixture
+def make_handler(timers):
+    """ Build an `EventHandler` whose commands are recorded in `handler.commands` instead of run. """
+    def make(command='cmd $tflags $filename', **options):
+        handler = watcher.EventHandler('job', command, None, None, None, False, None, timers=timers, **options)
+        handler.commands = []
+        def submit(command, data=None):
+            handler.commands.append((command, data))
+            return True
+        handler.submit = submit
+        return handler
+    return make
@@ -0,0 +1,148 @@
+import array
+
+import pytest
+
+import watcher
+
+
+def own(paths, path):
+    """ Node of `path`, used by the test as its owner. """
+    node = paths.lookup(path, True)
+    paths.refs[node] += 1
+    return node
+
+
+def disown(paths, node):
+    paths.refs[node] -= 1
+    paths.release(node)
+
+
+def test_paths_round_trip():
+    paths = watcher.CompactPaths()
+    nodes = [own(paths, path) for path in ('/srv/a/b', '/srv/a/c', '/srv/d')]
+    assert [paths.path(node) for node in nodes] == ['/srv/a/b', '/srv/a/c', '/srv/d']
+    assert paths.lookup('/srv/a/b') == nodes[0]
+    assert paths.lookup('/srv/a/x') == -1
+    assert paths.lookup('/srv//a/b/') == nodes[0]
+    assert paths.child(paths.lookup('/srv/a'), 'c') == nodes[1]
+    # '/', srv, a, b, c, d
+    assert len(paths) == 6
+    assert paths.names.count('srv') == 1
+
+
+def test_unused_nodes_are_freed():
+    paths = watcher.CompactPaths()
+    b, c = own(paths, '/srv/a/b'), own(paths, '/srv/a/c')
+    disown(paths, b)
+    assert paths.lookup('/srv/a/b') == -1
+    assert paths.path(c) == '/srv/a/c'
+    disown(paths, c)
+    assert len(paths) == 1
+    assert paths.children == {}
+    assert paths.first_child[0] == -1
+
+
+def test_free_nodes_are_reused_with_default_columns():
+    column = array.array('i')
+    paths = watcher.CompactPaths((column, -1))
+    node = own(paths, '/srv/a')
+    column[node] = 7
+    disown(paths, node)
+    size = len(paths.parents)
+    node = own(paths, '/data/b')
+    assert len(paths.parents) == size
+    assert column[node] == -1
+    assert paths.path(node) == '/data/b'
+    assert list(paths.child_nodes(node)) == []
+
+
+def test_move_keeps_the_subtree():
+    paths = watcher.CompactPaths()
+    c, d = own(paths, '/srv/a/b/c'), own(paths, '/srv/a/b/d')
+    b = paths.lookup('/srv/a/b')
+    paths.move(b, '/data/moved')
+    assert (paths.path(c), paths.path(d)) == ('/data/moved/c', '/data/moved/d')
+    assert paths.lookup('/data/moved/c') == c
+    # the old parents are not used anymore
+    assert paths.lookup('/srv') == -1
+    assert sorted(paths.child_nodes(b)) == sorted([c, d])
+    disown(paths, c)
+    disown(paths, d)
+    assert len(paths) == 1
+
+
+def test_move_over_a_sibling():
+    paths = watcher.CompactPaths()
+    a, b = own(paths, '/srv/a'), own(paths, '/srv/b')
+    paths.move(a, '/srv/b')
+    assert paths.lookup('/srv/b') == a
+    assert paths.path(a) == '/srv/b'
+    # the replaced node is only freed by its owner
+    assert paths.path(b) == '/srv/b'
+    disown(paths, b)
+    assert paths.lookup('/srv/b') == a
+    disown(paths, a)
+    assert len(paths) == 1
+
+
+def test_remove_frees_the_subtree():
+    paths = watcher.CompactPaths()
+    own(paths, '/srv/a/b/c')
+    own(paths, '/srv/a/d')
+    keep = own(paths, '/srv/e')
+    a = paths.lookup('/srv/a')
+    assert [paths.path(node) for node in paths.subtree(a)][0] == '/srv/a'
+    assert sorted(paths.path(node) for node in paths.subtree(a)) == ['/srv/a', '/srv/a/b', '/srv/a/b/c', '/srv/a/d']
+    paths.remove(a)
+    assert paths.lookup('/srv/a') == -1
+    assert paths.lookup('/srv/a/d') == -1
+    assert list(paths.child_nodes(paths.lookup('/srv'))) == [keep]
+    disown(paths, keep)
+    assert len(paths) == 1
+
+
+@pytest.fixture
+def wm():
+    wm = watcher.CompactWatchManager()
+    yield wm
+    wm.close()
+
+
+def test_watches_round_trip(wm):
+    wm.register(1, '/srv/a', 0x100)
+    wm.register(5, '/srv/a/b', 0x200)
+    assert (wm.get_wd('/srv/a/b'), wm.get_path(5)) == (5, '/srv/a/b')
+    assert sorted(wm.watches) == [1, 5] and 3 not in wm.watches
+    assert wm.get_watch(5).mask == 0x200
+    assert wm.subtree([1]) == [1, 5]
+    wm.del_watch(1)
+    assert wm.get_wd('/srv/a') is None
+    assert wm.get_path(5) == '/srv/a/b'
+    wm.del_watch(5)
+    assert len(wm.watches) == 0
+    assert len(wm.tree) == 1
+
+
+def test_new_watch_descriptor_of_a_path(wm):
+    wm.register(1, '/srv/a', 0x100)
+    wm.register(2, '/srv/a', 0x100)
+    assert wm.get_wd('/srv/a') == 2
+    assert wm.get_watch(1) is None
+    assert len(wm.watches) == 1
+    wm.del_watch(2)
+    assert len(wm.tree) == 1
+
+
+def test_rename_moves_the_watches_under_it(wm):
+    wm.register(1, '/srv/a', 0x100)
+    wm.register(2, '/srv/a/b', 0x100)
+    wm.register(3, '/srv/a/b/c', 0x100)
+    wm.rename(2, '/data/moved')
+    assert [wm.get_path(wd) for wd in (1, 2, 3)] == ['/srv/a', '/data/moved', '/data/moved/c']
+    assert wm.get_wd('/data/moved/c') == 3
+    assert wm.get_wd('/srv/a/b/c') is None
+    assert wm.subtree([1]) == [1]
+    assert sorted(wm.subtree([2])) == [2, 3]
+    for wd in (1, 2, 3):
+        wm.del_watch(wd)
+    assert len(wm.tree) == 1
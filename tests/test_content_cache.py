@@ -0,0 +1,106 @@
+import os
+
+import pyinotify
+import pytest
+
+import watcher
+from conftest import make_event
+
+
+@pytest.fixture
+def cache():
+    return watcher.ContentCache('job')
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def run(cache, event, queued=True):
+    """ Whether the command of `event` runs, as the handler checks and records it. """
+    changed = cache.changed(event)
+    if changed:
+        cache.record([event.pathname], queued)
+    return changed
+
+
+def test_unchanged_content_is_skipped(cache, tmp_path):
+    path = str(tmp_path / 'a')
+    write(path, b'one')
+    event = make_event(pyinotify.IN_MODIFY, path)
+    assert run(cache, event)
+    os.utime(path, (0, 0))
+    assert not run(cache, make_event(pyinotify.IN_ATTRIB, path))
+    write(path, b'two')
+    assert run(cache, event)
+    write(path, b'one')
+    assert run(cache, event)
+    assert not run(cache, event)
+
+
+def test_digest_is_cached_by_inode_size_and_mtime(cache, tmp_path):
+    path = str(tmp_path / 'a')
+    write(path, b'one')
+    event = make_event(pyinotify.IN_MODIFY, path)
+    run(cache, event)
+    run(cache, event)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_dropped_command_is_not_recorded(cache, tmp_path):
+    path = str(tmp_path / 'a')
+    write(path, b'one')
+    event = make_event(pyinotify.IN_MODIFY, path)
+    assert run(cache, event, queued=False)
+    assert run(cache, event)
+    assert not run(cache, event)
+
+
+def test_pending_digest_skips_the_repeated_events(cache, tmp_path):
+    path = str(tmp_path / 'a')
+    write(path, b'one')
+    event = make_event(pyinotify.IN_CLOSE_WRITE, path)
+    assert cache.changed(event)
+    # e.g. IN_MODIFY then IN_CLOSE_WRITE of the same write, before the first command is queued
+    assert not cache.changed(event)
+    cache.record([path], True)
+    assert not cache.changed(event)
+
+
+def test_other_events_forget_the_file(cache, tmp_path):
+    path = str(tmp_path / 'a')
+    write(path, b'one')
+    event = make_event(pyinotify.IN_MODIFY, path)
+    run(cache, event)
+    assert run(cache, make_event(pyinotify.IN_DELETE, path))
+    assert run(cache, event)
+
+
+def test_directories_and_missing_files_run(cache, tmp_path):
+    assert cache.changed(make_event(pyinotify.IN_ATTRIB | pyinotify.IN_ISDIR, str(tmp_path)))
+    assert cache.changed(make_event(pyinotify.IN_MODIFY, str(tmp_path / 'missing')))
+
+
+def test_large_files_are_sampled(cache, tmp_path):
+    cache.SAMPLE_THRESHOLD, cache.SAMPLE_SIZE = 64, 8
+    path = str(tmp_path / 'a')
+    write(path, b'a' * 100)
+    event = make_event(pyinotify.IN_MODIFY, path)
+    assert run(cache, event)
+    # a change in a sample is seen
+    write(path, b'a' * 50 + b'b' + b'a' * 49)
+    assert run(cache, event)
+    # a change between the samples is not
+    write(path, b'a' * 20 + b'b' + b'a' * 29 + b'b' + b'a' * 49)
+    assert not run(cache, event)
+
+
+def test_lru_size(tmp_path):
+    cache = watcher.ContentCache('job', size=2)
+    for name in 'abc':
+        path = str(tmp_path / name)
+        write(path, name.encode('ascii'))
+        run(cache, make_event(pyinotify.IN_MODIFY, path))
+    assert list(cache.last) == [str(tmp_path / 'b'), str(tmp_path / 'c')]
+    assert len(cache.digests) == 2
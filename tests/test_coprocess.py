@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+import watcher
+
+
+@pytest.fixture
+def make_pool(timers):
+    pools = []
+    def make(command='cat > /dev/null', overflow='block', size=1):
+        pool = watcher.CoprocessPool('job', command, False, None, size, overflow, timers)
+        pools.append(pool)
+        return pool
+    yield make
+    for pool in pools:
+        processes = [instance.process for instance in pool.instances if instance.process is not None]
+        pool.close()
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def test_lines_reach_the_instances(make_pool, tmp_path):
+    pool = make_pool('cat >> %s'%(tmp_path / 'out'), size=2)
+    pool.start()
+    processes = [instance.process for instance in pool.instances]
+    for i in range(4):
+        assert pool.send(b'{"line": %d}\n'%i)
+    pool.close()
+    for process in processes:
+        process.wait()
+    assert sorted((tmp_path / 'out').read_bytes().splitlines()) == [b'{"line": %d}'%i for i in range(4)]
+
+
+def test_restart_delay_doubles_on_quick_exits(make_pool, timers, monkeypatch):
+    monkeypatch.setattr(watcher, 'monotonic', timers.monotonic)
+    pool = make_pool()
+    instance = pool.instances[0]
+    delays = []
+    for _ in range(8):
+        pool.restart(instance)
+        delays.append(instance.delay)
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+    assert [timer.when for timer in timers.timers][:3] == [1, 2, 4]
+    # an instance that ran long enough restarts quickly again
+    timers.now = instance.started + pool.BACKOFF_MAX
+    pool.restart(instance)
+    assert instance.delay == 1
+
+
+def test_exited_instance_is_restarted(make_pool, timers):
+    pool = make_pool('true', overflow='drop-newest')
+    pool.start()
+    pool.instances[0].process.wait()
+    pool.send(b'{}\n' * 100000)
+    assert pool.instances[0].process is None
+    assert [timer.callback for timer in timers.timers] == [pool.start]
+    timers.advance(1)
+    assert pool.instances[0].process is not None
+
+
+def test_drop_newest_when_no_pipe_has_room(make_pool):
+    pool = make_pool(overflow='drop-newest')
+    assert not pool.send(b'a\n')
+    assert not pool.queue
+
+
+def test_drop_oldest_keeps_the_last_lines(make_pool):
+    pool = make_pool(overflow='drop-oldest')
+    for line in (b'a\n', b'b\n', b'c\n'):
+        assert pool.send(line)
+    assert list(pool.queue) == [b'c\n']
+
+
+def test_block_queues_while_no_instance_runs(make_pool):
+    pool = make_pool()
+    pool.QUEUE_SIZE = 2
+    assert pool.send(b'a\n') and pool.send(b'b\n')
+    start = time.time()
+    assert not pool.send(b'c\n')
+    assert time.time() - start < pool.BLOCK_TIMEOUT
+    assert list(pool.queue) == [b'a\n', b'b\n']
+
+
+def test_block_gives_up_on_a_stuck_instance(make_pool):
+    pool = make_pool('sleep 30')
+    pool.QUEUE_SIZE, pool.BLOCK_TIMEOUT = 2, 0.2
+    pool.start()
+    line = b'x' * 4095 + b'\n'
+    while not pool.queue:
+        assert pool.send(line)
+    assert pool.send(line)
+    start = time.time()
+    assert not pool.send(line)
+    assert time.time() - start >= 0.2
+    # the next lines are dropped at once, until a queued line is written
+    start = time.time()
+    assert not pool.send(line)
+    assert time.time() - start < 0.2
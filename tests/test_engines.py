@@ -0,0 +1,121 @@
+import os
+import time
+
+import pyinotify
+import pytest
+
+import watcher
+from conftest import make_event, make_job
+
+IN_CREATE, IN_DELETE, IN_ISDIR = pyinotify.IN_CREATE, pyinotify.IN_DELETE, pyinotify.IN_ISDIR
+IN_MOVED_FROM, IN_MOVED_TO = pyinotify.IN_MOVED_FROM, pyinotify.IN_MOVED_TO
+
+
+class Recorder(object):
+    """ Job handler that records the events dispatched to it. """
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append((event.maskname, event.pathname))
+
+
+@pytest.fixture
+def engine():
+    engine = watcher.SharedEngine()
+    yield engine
+    engine.wm.close()
+
+
+def add_job(engine, name, folder, **options):
+    handler = Recorder()
+    engine.add_job(make_job(name, watch=str(folder), **options), handler)
+    return handler
+
+
+def test_overlapping_jobs_share_a_watch(engine, tmp_path):
+    add_job(engine, 'a', tmp_path, events='create', autoadd='false')
+    add_job(engine, 'b', tmp_path, events='delete', autoadd='false')
+    assert engine.count_watches() == 1
+    wd = engine.wm.get_wd(str(tmp_path))
+    assert engine.wm.get_watch(wd).mask == IN_CREATE | IN_DELETE
+    assert engine.subscribers[wd] == {'a': IN_CREATE, 'b': IN_DELETE}
+
+
+def test_autoadd_widens_the_watch_mask(engine, tmp_path):
+    add_job(engine, 'a', tmp_path, events='delete')
+    wd = engine.wm.get_wd(str(tmp_path))
+    assert engine.wm.get_watch(wd).mask == IN_DELETE | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO
+
+
+def test_events_are_routed_by_watch_and_job_mask(engine, tmp_path):
+    (tmp_path / 'a').mkdir()
+    a = add_job(engine, 'a', tmp_path, events='create', autoadd='false')
+    b = add_job(engine, 'b', tmp_path / 'a', events='create,delete', autoadd='false')
+    top, sub = engine.wm.get_wd(str(tmp_path)), engine.wm.get_wd(str(tmp_path / 'a'))
+    engine.dispatch(make_event(IN_CREATE, str(tmp_path / 'a' / 'f'), wd=sub))
+    engine.dispatch(make_event(IN_DELETE, str(tmp_path / 'a' / 'f'), wd=sub))
+    engine.dispatch(make_event(IN_DELETE, str(tmp_path / 'g'), wd=top))
+    engine.dispatch(make_event(IN_CREATE, str(tmp_path / 'g'), wd=top + sub + 1))
+    assert a.events == [('IN_CREATE', str(tmp_path / 'a' / 'f'))]
+    assert b.events == [('IN_CREATE', str(tmp_path / 'a' / 'f')), ('IN_DELETE', str(tmp_path / 'a' / 'f'))]
+
+
+def test_remove_job_unsubscribes_it(engine, tmp_path):
+    add_job(engine, 'a', tmp_path, events='create', autoadd='false')
+    b = add_job(engine, 'b', tmp_path, events='delete', autoadd='false')
+    wd = engine.wm.get_wd(str(tmp_path))
+    engine.remove_job('a')
+    assert engine.wm.get_watch(wd).mask == IN_DELETE
+    engine.dispatch(make_event(IN_CREATE, str(tmp_path / 'f'), wd=wd))
+    engine.dispatch(make_event(IN_DELETE, str(tmp_path / 'f'), wd=wd))
+    assert b.events == [('IN_DELETE', str(tmp_path / 'f'))]
+    engine.remove_job('b')
+    assert engine.count_watches() == 0
+    assert engine.subscribers == {}
+
+
+def test_new_directory_is_dispatched_before_its_content(engine, tmp_path):
+    handler = add_job(engine, 'a', tmp_path)
+    (tmp_path / 'new' / 'deep').mkdir(parents=True)
+    (tmp_path / 'new' / 'deep' / 'f').write_text('f')
+    engine.dispatch(make_event(IN_CREATE | IN_ISDIR, str(tmp_path / 'new'), wd=engine.wm.get_wd(str(tmp_path))))
+    assert handler.events == [('IN_CREATE|IN_ISDIR', str(tmp_path / 'new')),
+                              ('IN_CREATE|IN_ISDIR', str(tmp_path / 'new' / 'deep')),
+                              ('IN_CREATE', str(tmp_path / 'new' / 'deep' / 'f'))]
+    assert engine.count_watches() == 3
+
+
+def test_moved_directory_keeps_its_watches(engine, tmp_path):
+    (tmp_path / 'd' / 'e').mkdir(parents=True)
+    add_job(engine, 'a', tmp_path)
+    wds = [engine.wm.get_wd(str(tmp_path / path)) for path in ('d', 'd/e')]
+    os.rename(str(tmp_path / 'd'), str(tmp_path / 'moved'))
+    event = make_event(IN_MOVED_TO | IN_ISDIR, str(tmp_path / 'moved'), wd=engine.wm.get_wd(str(tmp_path)))
+    event.src_pathname = str(tmp_path / 'd')
+    engine.dispatch(event)
+    assert [engine.wm.get_wd(str(tmp_path / path)) for path in ('moved', 'moved/e')] == wds
+    assert engine.wm.get_wd(str(tmp_path / 'd')) is None
+    assert engine.count_watches() == 3
+
+
+@pytest.mark.parametrize('engine_class', [watcher.ThreadedEngine, watcher.SharedEngine])
+def test_new_directory_over_budget_is_polled_with_its_content(engine_class, tmp_path, make_handler):
+    top = tmp_path / 'tree'
+    top.mkdir()
+    handler = make_handler('cmd $filename')
+    engine = engine_class()
+    engine.poller, engine.budget = watcher.Poller(), 1
+    engine.start()
+    try:
+        engine.add_job(make_job('job', watch=str(top), poll_interval='0.1'), handler)
+        (top / 'new' / 'deep').mkdir(parents=True)
+        (top / 'new' / 'deep' / 'f2').write_text('f2')
+        expected = set(("cmd '%s'"%(top / path), None) for path in ('new', 'new/deep', 'new/deep/f2'))
+        deadline = time.time() + 5
+        while set(handler.commands) != expected and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        engine.stop()
+        engine.poller.stop()
+    assert sorted(handler.commands) == sorted(expected)
@@ -0,0 +1,85 @@
+import watcher
+
+
+def test_no_rules_pass():
+    assert watcher.FileFilter()('/srv/a.txt') is None
+
+
+def test_include_extensions():
+    rules = watcher.FileFilter(include_extensions={'mp4', '.mkv'})
+    assert rules('/srv/a.mp4') is None
+    assert rules('/srv/a.MKV') is None
+    assert rules('/srv/a.txt') is not None
+    assert rules('/srv/mp4') is not None
+    # the extension is looked up in the name only
+    assert rules('/srv/d.mp4/a') is not None
+
+
+def test_multi_dot_extensions():
+    rules = watcher.FileFilter(include_extensions={'.tar.gz'}, exclude_extensions={'.gz'})
+    assert rules('/srv/a.tar.gz') is not None
+    rules = watcher.FileFilter(include_extensions={'.tar.gz'})
+    assert rules('/srv/a.b.tar.gz') is None
+    assert rules('/srv/a.gz') is not None
+
+
+def test_exclude_extensions():
+    rules = watcher.FileFilter(exclude_extensions={'.tmp', '.swp'})
+    assert rules('/srv/a.TMP') is not None
+    assert rules('/srv/a.tmp.txt') is None
+
+
+def test_case_sensitive():
+    rules = watcher.FileFilter(include_extensions={'.mp4'}, include_glob=['*.mp4'], ignore_case=False)
+    assert rules('/srv/a.mp4') is None
+    assert rules('/srv/a.MP4') is not None
+
+
+def test_globs_on_names_and_paths():
+    rules = watcher.FileFilter(include_glob=['report-*', '/srv/in/*/*.csv'])
+    assert rules('/srv/x/report-1.pdf') is None
+    assert rules('/srv/in/2024/a.csv') is None
+    assert rules('/srv/other/a.csv') is not None
+    rules = watcher.FileFilter(exclude_glob=['.*', '*~'])
+    assert rules('/srv/.hidden') is not None
+    assert rules('/srv/a.txt~') is not None
+    assert rules('/srv/.d/a.txt') is None
+
+
+def test_exclude_re_searches_the_name():
+    rules = watcher.FileFilter(exclude_re=r'^\d+$')
+    assert rules('/srv/123') is not None
+    assert rules('/srv/123/a') is None
+
+
+def test_video_extensions():
+    rules = watcher.FileFilter(include_extensions=set(watcher.VIDEO_EXTENSIONS))
+    assert rules('/srv/a.avi') is None
+    assert rules('/srv/a.txt') is not None
+
+
+def test_trie_contains_the_paths_under_its_directories():
+    trie = watcher.PathTrie(['/srv/a/b', '/data/'])
+    assert '/srv/a/b' in trie
+    assert '/srv/a/b/c/d' in trie
+    assert '/data/x' in trie
+    assert '/srv/a' not in trie
+    assert '/srv/a/bc' not in trie
+    assert trie('/srv/a/b/../b/c')
+
+
+def test_trie_of_the_root():
+    trie = watcher.PathTrie(['/'])
+    assert '/any/thing' in trie
+
+
+def test_empty_trie():
+    trie = watcher.PathTrie()
+    assert not trie
+    assert '/srv' not in trie
+    assert watcher.PathTrie(['/srv'])
+
+
+def test_trie_equality():
+    assert watcher.PathTrie(['/a', '/b/']) == watcher.PathTrie(['/b', '/a'])
+    assert watcher.PathTrie(['/a']) != watcher.PathTrie(['/b'])
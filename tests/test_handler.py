@@ -0,0 +1,169 @@
+import os
+import time
+
+import pyinotify
+
+import watcher
+from conftest import make_event
+
+IN_CREATE, IN_DELETE, IN_MODIFY = pyinotify.IN_CREATE, pyinotify.IN_DELETE, pyinotify.IN_MODIFY
+IN_MOVED_FROM, IN_MOVED_TO = pyinotify.IN_MOVED_FROM, pyinotify.IN_MOVED_TO
+IN_CLOSE_WRITE = pyinotify.IN_CLOSE_WRITE
+
+
+def test_filtered_events_are_not_run():
+    handler = watcher.EventHandler('job', 'cmd $filename', {'.txt'}, None, None, False, None)
+    handler.commands = []
+    handler.submit = lambda command, data=None: handler.commands.append(command) or True
+    handler(make_event(IN_CREATE, '/srv/a.jpg'))
+    handler(make_event(IN_CREATE, '/srv/a.txt'))
+    assert handler.commands == ["cmd '/srv/a.txt'"]
+
+
+def test_debounce_merges_the_events_of_a_file(make_handler, timers):
+    handler = make_handler(debounce=0.1)
+    handler(make_event(IN_CREATE, '/srv/a'))
+    handler(make_event(IN_MODIFY, '/srv/a'))
+    handler(make_event(IN_MODIFY, '/srv/b'))
+    assert handler.commands == []
+    timers.fire()
+    assert sorted(handler.commands, key=lambda command: command[0][-3:]) == [
+        ("cmd 'IN_MODIFY|IN_CREATE' '/srv/a'", None), ("cmd 'IN_MODIFY' '/srv/b'", None)]
+
+
+def test_batch_size(make_handler, timers):
+    handler = make_handler('cmd $filenames', batch_size=3)
+    for name in 'abcd':
+        handler(make_event(IN_CREATE, '/srv/' + name))
+    assert handler.commands == [("cmd '/srv/a' '/srv/b' '/srv/c'", None)]
+    timers.fire()
+    assert handler.commands[1:] == [("cmd '/srv/d'", None)]
+
+
+def test_batch_latency(make_handler, timers):
+    handler = make_handler('cmd $filenames', batch_size=10, batch_latency=0.5)
+    handler(make_event(IN_CREATE, '/srv/a'))
+    handler(make_event(IN_CREATE, '/srv/b'))
+    assert len(timers.timers) == 1
+    timers.fire()
+    assert handler.commands == [("cmd '/srv/a' '/srv/b'", None)]
+
+
+def test_batch_input_lines(make_handler, timers):
+    handler = make_handler('cmd', batch_size=2, batch_input='lines')
+    handler(make_event(IN_CREATE, '/srv/a'))
+    handler(make_event(IN_CREATE, '/srv/b'))
+    assert handler.commands == [('cmd', b'/srv/a\n/srv/b\n')]
+
+
+def test_split_args_fits_the_command_line(make_handler):
+    handler = make_handler('cmd $filenames')
+    event = make_event(IN_CREATE, '/srv/a')
+    args = [handler.shellquote('/srv/%06d-%s' % (i, 'x' * 40)) for i in range(10000)]
+    chunks = list(handler.splitArgs(event, args))
+    assert len(chunks) > 1
+    assert [arg for chunk in chunks for arg in chunk] == args
+    for chunk in chunks:
+        assert len(handler.substitute(event, ' '.join(chunk))) <= watcher.MAX_ARG_STRLEN
+
+
+def test_batch_split_into_several_commands(make_handler, timers):
+    handler = make_handler('cmd $filenames', batch_size=5000)
+    for i in range(5000):
+        handler(make_event(IN_CREATE, '/srv/%06d-%s' % (i, 'x' * 40)))
+    assert len(handler.commands) > 1
+    assert sum(len(command.split()) - 1 for (command, data) in handler.commands) == 5000
+
+
+def test_moves_are_paired(make_handler, timers):
+    handler = make_handler('cmd $tflags $src $dest', pair_moves=True)
+    handler(make_event(IN_MOVED_FROM, '/srv/a', cookie=7))
+    handler(make_event(IN_MOVED_TO, '/srv/b', cookie=7))
+    timers.fire()
+    assert handler.commands == [("cmd 'IN_MOVED_FROM|IN_MOVED_TO' '/srv/a' '/srv/b'", None)]
+
+
+def test_unpaired_moves(make_handler, timers):
+    handler = make_handler('cmd $tflags $filename', pair_moves=True)
+    handler(make_event(IN_MOVED_FROM, '/srv/out', cookie=1))
+    handler(make_event(IN_MOVED_TO, '/srv/in', cookie=2))
+    assert handler.commands == [("cmd 'IN_CREATE' '/srv/in'", None)]
+    timers.fire()
+    assert handler.commands[1:] == [("cmd 'IN_DELETE' '/srv/out'", None)]
+
+
+def test_paired_moves_follow_the_job_events(make_handler, timers):
+    # the job watches creations only: the moves are watched to be paired, and only run as creations
+    handler = make_handler('cmd $tflags $filename', pair_moves=True, run_mask=IN_CREATE)
+    handler(make_event(IN_MOVED_FROM, '/srv/a', cookie=7))
+    handler(make_event(IN_MOVED_TO, '/srv/b', cookie=7))
+    handler(make_event(IN_MOVED_FROM, '/srv/out', cookie=8))
+    handler(make_event(IN_MOVED_TO, '/srv/in', cookie=9))
+    timers.fire()
+    assert handler.commands == [("cmd 'IN_CREATE' '/srv/in'", None)]
+
+
+def test_events_only_watched_are_not_run(make_handler):
+    handler = make_handler(run_mask=IN_CREATE)
+    handler(make_event(IN_MODIFY, '/srv/a'))
+    handler(make_event(IN_CREATE, '/srv/b'))
+    assert handler.commands == [("cmd 'IN_CREATE' '/srv/b'", None)]
+
+
+def old(path):
+    """ Set the mtime of `path` in the past, as a file no longer written. """
+    os.utime(path, (time.time() - 60, time.time() - 60))
+
+
+def test_held_file_is_extended_by_its_writes(make_handler, timers, monkeypatch, tmp_path):
+    monkeypatch.setattr(watcher, 'monotonic', timers.monotonic)
+    handler = make_handler(run_mask=IN_CREATE, stable_after=2)
+    path = tmp_path / 'a'
+    path.write_text('a')
+    handler(make_event(IN_CREATE, str(path)))
+    timers.advance(1)
+    path.write_text('ab')
+    handler(make_event(IN_MODIFY, str(path)))
+    handler(make_event(IN_CLOSE_WRITE, str(path)))
+    old(str(path))
+    timers.advance(1.5)
+    assert handler.commands == []
+    timers.advance(1)
+    assert handler.commands == [("cmd 'IN_CREATE' '%s'"%path, None)]
+    assert handler.unstable == {}
+
+
+def test_held_file_written_without_event(make_handler, timers, monkeypatch, tmp_path):
+    monkeypatch.setattr(watcher, 'monotonic', timers.monotonic)
+    handler = make_handler(run_mask=IN_CREATE, stable_after=2)
+    path = tmp_path / 'a'
+    path.write_text('a')
+    handler(make_event(IN_CREATE, str(path)))
+    # e.g. on a polled tree: only its recent mtime and new size tell it is written
+    path.write_text('ab')
+    timers.advance(2.5)
+    assert handler.commands == []
+    old(str(path))
+    timers.advance(2)
+    assert handler.commands == [("cmd 'IN_CREATE' '%s'"%path, None)]
+
+
+def test_held_file_deleted(make_handler, timers, monkeypatch, tmp_path):
+    monkeypatch.setattr(watcher, 'monotonic', timers.monotonic)
+    handler = make_handler(run_mask=IN_CREATE, stable_after=2)
+    for name in 'ab':
+        (tmp_path / name).write_text(name)
+        handler(make_event(IN_CREATE, str(tmp_path / name)))
+    (tmp_path / 'a').unlink()
+    handler(make_event(IN_DELETE, str(tmp_path / 'a')))
+    # removed without event
+    (tmp_path / 'b').unlink()
+    timers.advance(5)
+    assert handler.commands == []
+    assert handler.unstable == {}
+
+
+def test_directories_are_not_held(make_handler, timers):
+    handler = make_handler(stable_after=2)
+    handler(make_event(IN_CREATE | pyinotify.IN_ISDIR, '/srv/d'))
+    assert handler.commands == [("cmd 'IN_CREATE|IN_ISDIR' '/srv/d'", None)]
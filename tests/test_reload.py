@@ -0,0 +1,120 @@
+import pytest
+
+import watcher
+
+DEFAULT = """
+[DEFAULT]
+pidfile=%(tmp)s/watcher.pid
+stats_socket=none
+engine=threaded
+events=create,modify
+excluded=
+include_extensions=
+exclude_extensions=
+exclude_re=
+recursive=true
+autoadd=true
+background=false
+outfile=/dev/null
+"""
+
+
+class Engine(object):
+    """ Engine that records the calls of the watcher instead of watching. """
+    def __init__(self):
+        self.calls = []
+
+    def add_job(self, job, handler):
+        self.calls.append(('add_job', job['name']))
+
+    def remove_job(self, name):
+        self.calls.append(('remove_job', name))
+
+    def update_job(self, job):
+        self.calls.append(('update_job', job['name']))
+
+    def add_dir(self, name, path):
+        self.calls.append(('add_dir', name, path))
+
+    def count_watches(self):
+        return 0
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / 'watcher.ini'
+    def write(jobs):
+        text = DEFAULT%{'tmp': tmp_path}
+        for (name, options) in sorted(jobs.items()):
+            text += '\n[%s]\n'%name + ''.join('%s=%s\n'%item for item in sorted(options.items()))
+        path.write_text(text)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def make_watcher(config):
+    def make(jobs):
+        w = watcher.Watcher([config(jobs)])
+        w.engine = Engine()
+        w.add_jobs()
+        w.engine.calls = []
+        return w
+    return make
+
+
+def job(tmp_path, folder, command='cmd $filename', **options):
+    options.update(watch=str(tmp_path / folder), command=command)
+    return options
+
+
+def test_unchanged_jobs_are_not_touched(make_watcher, config, tmp_path):
+    jobs = {'a': job(tmp_path, 'a'), 'b': job(tmp_path, 'b')}
+    w = make_watcher(jobs)
+    handlers = dict(w.handlers)
+    w.reload()
+    assert w.engine.calls == []
+    assert w.handlers == handlers
+
+
+def test_jobs_are_added_and_removed(make_watcher, config, tmp_path):
+    w = make_watcher({'a': job(tmp_path, 'a'), 'b': job(tmp_path, 'b')})
+    config({'a': job(tmp_path, 'a'), 'c': job(tmp_path, 'c')})
+    w.reload()
+    assert w.engine.calls == [('remove_job', 'b'), ('add_job', 'c')]
+    assert sorted(w.jobs) == sorted(w.handlers) == ['a', 'c']
+
+
+def test_changed_command_updates_the_handler(make_watcher, config, tmp_path):
+    w = make_watcher({'a': job(tmp_path, 'a')})
+    handler = w.handlers['a']
+    config({'a': job(tmp_path, 'a', command='other $filename')})
+    w.reload()
+    assert w.engine.calls == []
+    assert w.handlers['a'] is handler
+    assert handler.command == 'other $filename'
+
+
+def test_changed_events_update_the_watches(make_watcher, config, tmp_path):
+    w = make_watcher({'a': job(tmp_path, 'a')})
+    config({'a': job(tmp_path, 'a', events='create,delete')})
+    w.reload()
+    assert w.engine.calls == [('update_job', 'a')]
+
+
+def test_changed_folder_watches_the_job_again(make_watcher, config, tmp_path):
+    w = make_watcher({'a': job(tmp_path, 'a')})
+    handler = w.handlers['a']
+    config({'a': job(tmp_path, 'moved')})
+    w.reload()
+    assert w.engine.calls == [('remove_job', 'a'), ('add_job', 'a')]
+    assert w.handlers['a'] is not handler
+    assert w.jobs['a']['folder'] == str(tmp_path / 'moved')
+
+
+def test_invalid_config_is_not_applied(make_watcher, config, tmp_path):
+    w = make_watcher({'a': job(tmp_path, 'a')})
+    config({'a': job(tmp_path, 'a', command='other $filename', weight='0')})
+    w.reload()
+    assert w.engine.calls == []
+    assert w.jobs['a']['command'] == 'cmd $filename'
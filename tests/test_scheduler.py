@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import itertools
+import threading
+import time
+
+import pytest
+
+import watcher
+
+
+def start_all(scheduler, count):
+    """ Names of the jobs of the next `count` tasks the workers would start. """
+    started = []
+    for _ in range(count):
+        item = scheduler.next_task()
+        if item is None:
+            break
+        started.append(item[0])
+    return started
+
+
+def test_weights_share_the_workers():
+    scheduler = watcher.CommandScheduler(1, 1000)
+    scheduler.add_job('light', 1000, 'block', weight=1)
+    scheduler.add_job('heavy', 1000, 'block', weight=3)
+    for _ in range(100):
+        scheduler.submit('light', lambda: None)
+        scheduler.submit('heavy', lambda: None)
+    counts = collections.Counter(start_all(scheduler, 40))
+    assert counts == {'light': 10, 'heavy': 30}
+
+
+def test_priority_goes_first():
+    scheduler = watcher.CommandScheduler(1, 1000)
+    scheduler.add_job('low', 1000, 'block')
+    scheduler.add_job('high', 1000, 'block', priority=1)
+    for _ in range(3):
+        scheduler.submit('low', lambda: None)
+        scheduler.submit('high', lambda: None)
+    assert start_all(scheduler, 6) == ['high'] * 3 + ['low'] * 3
+
+
+def test_idle_job_does_not_save_up_time():
+    scheduler = watcher.CommandScheduler(1, 1000)
+    scheduler.add_job('busy', 1000, 'block')
+    scheduler.add_job('idle', 1000, 'block')
+    for _ in range(10):
+        scheduler.submit('busy', lambda: None)
+    start_all(scheduler, 8)
+    for _ in range(4):
+        scheduler.submit('idle', lambda: None)
+    # the idle job shares from now on, it does not get the 8 turns it missed
+    assert collections.Counter(start_all(scheduler, 4)) == {'busy': 2, 'idle': 2}
+
+
+def test_max_concurrency():
+    scheduler = watcher.CommandScheduler(4, 1000)
+    scheduler.add_job('job', 2, 'block')
+    for _ in range(5):
+        scheduler.submit('job', lambda: None)
+    for name in start_all(scheduler, 2):
+        scheduler.running[name] += 1
+    assert scheduler.next_task() is None
+
+
+def test_rate_limit_holds_the_tasks():
+    scheduler = watcher.CommandScheduler(1, 1000)
+    scheduler.add_job('job', 1000, 'block', rate_limit=2, rate_burst=3)
+    for _ in range(5):
+        scheduler.submit('job', lambda: None)
+    assert start_all(scheduler, 5) == ['job'] * 3
+    assert 0 < scheduler.wakeup <= 0.5
+    assert scheduler.throttled['job'] == 1
+    # the same held task is counted once
+    scheduler.next_task()
+    assert scheduler.throttled['job'] == 1
+
+
+def test_rate_limit_kept_on_update():
+    scheduler = watcher.CommandScheduler(1, 1000)
+    scheduler.add_job('job', 1, 'block', rate_limit=1)
+    bucket = scheduler.buckets['job']
+    scheduler.add_job('job', 2, 'block', rate_limit=1)
+    assert scheduler.buckets['job'] is bucket
+    scheduler.add_job('job', 2, 'block')
+    assert 'job' not in scheduler.buckets
+
+
+def test_drop_newest():
+    scheduler = watcher.CommandScheduler(1, 2)
+    scheduler.add_job('job', 1, 'drop-newest')
+    assert scheduler.submit('job', 'a') and scheduler.submit('job', 'b')
+    assert not scheduler.submit('job', 'c')
+    assert [task for (seq, task) in scheduler.pending['job']] == ['a', 'b']
+    assert scheduler.dropped['job'] == 1
+
+
+def test_drop_oldest():
+    scheduler = watcher.CommandScheduler(1, 2)
+    scheduler.add_job('job', 1, 'drop-oldest')
+    for task in 'abc':
+        assert scheduler.submit('job', task)
+    assert [task for (seq, task) in scheduler.pending['job']] == ['b', 'c']
+    assert scheduler.queued == 2
+
+
+def test_full_queue_takes_a_task_of_an_idle_job():
+    scheduler = watcher.CommandScheduler(1, 2)
+    scheduler.add_job('flood', 1, 'drop-newest')
+    scheduler.add_job('other', 1, 'drop-newest')
+    scheduler.submit('flood', 'a')
+    scheduler.submit('flood', 'b')
+    assert scheduler.submit('other', 'c')
+    assert not scheduler.submit('other', 'd')
+
+
+def test_block_waits_for_room():
+    scheduler = watcher.CommandScheduler(1, 1)
+    scheduler.add_job('job', 1, 'block')
+    scheduler.submit('job', 'a')
+    result = []
+    thread = threading.Thread(target=lambda: result.append(scheduler.submit('job', 'b')))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    with scheduler.cond:
+        scheduler.next_task()
+        scheduler.cond.notify_all()
+    thread.join(5)
+    assert result == [True]
+
+
+def test_block_returns_when_the_job_is_removed():
+    scheduler = watcher.CommandScheduler(1, 1)
+    scheduler.add_job('job', 1, 'block')
+    scheduler.submit('job', 'a')
+    result = []
+    thread = threading.Thread(target=lambda: result.append(scheduler.submit('job', 'b')))
+    thread.start()
+    thread.join(0.2)
+    scheduler.remove_job('job')
+    thread.join(5)
+    assert result == [False]
+    assert not scheduler.submit('job', 'c')
+
+
+def test_workers_run_the_tasks():
+    scheduler = watcher.CommandScheduler(2, 100)
+    scheduler.add_job('job', 2, 'block')
+    done = threading.Semaphore(0)
+    scheduler.start()
+    try:
+        for _ in range(10):
+            scheduler.submit('job', done.release)
+        assert all(done.acquire(timeout=5) for _ in range(10))
+    finally:
+        scheduler.stop()
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        watcher.CommandScheduler(1, 1).add_job('job', 1, 'drop-all')
+
+
+def test_asyncio_jobs_changed_while_tasks_launch():
+    loop = asyncio.new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+    scheduler = watcher.AsyncioScheduler(loop, 2, 100000)
+    started = threading.Event()
+    loop.call_soon(lambda: scheduler.start() or started.set())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    ran = []
+    def task():
+        ran.append(None)
+        future = loop.create_future()
+        loop.call_soon(future.set_result, None)
+        return future
+    try:
+        assert started.wait(5)
+        scheduler.add_job('busy', 2, 'block')
+        for _ in range(5000):
+            scheduler.submit('busy', task)
+        # as the jobs of a reload, from another thread, while the tasks are launched
+        jobs = itertools.count()
+        deadline = time.time() + 10
+        while len(ran) < 5000 and time.time() < deadline:
+            name = 'job%d'%next(jobs)
+            scheduler.add_job(name, 1, 'block')
+            scheduler.remove_job(name)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    assert errors == []
+    assert len(ran) == 5000
@@ -0,0 +1,171 @@
+import os
+import time
+
+import pyinotify
+import pytest
+
+import watcher
+
+MASK = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY
+
+
+class Recorder(object):
+    """ Job handler that records the events sent by the index. """
+    job    = 'job'
+    timers = None
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append((event.maskname, event.pathname))
+
+
+class Event(object):
+    def __init__(self, pathname):
+        self.pathname = pathname
+
+
+@pytest.fixture
+def top(tmp_path):
+    top = tmp_path / 'top'
+    (top / 'd' / 'e').mkdir(parents=True)
+    (top / 'a.txt').write_text('a')
+    (top / 'd' / 'b.txt').write_text('b')
+    (top / 'd' / 'e' / 'c.txt').write_text('c')
+    return top
+
+
+def make_index(top, excluded=(), mask=MASK, state_file=None, **rules):
+    return watcher.TreeIndex(str(top), True, watcher.PathTrie([str(top / path) for path in excluded]),
+                             watcher.FileFilter(**rules), mask, state_file=state_file)
+
+
+def rel(top, changes):
+    return [(change, os.path.relpath(path, str(top)), isdir) for (change, path, isdir) in changes]
+
+
+def test_first_scan_indexes_the_tree(top):
+    index = make_index(top)
+    assert index.rescan(report=False) is None
+    assert index.count == 5
+    assert index.rescan() == []
+
+
+def test_changes_are_sorted(top):
+    index = make_index(top)
+    index.rescan(report=False)
+    (top / 'd' / 'e' / 'c.txt').unlink()
+    (top / 'd' / 'e').rmdir()
+    (top / 'n' / 'm').mkdir(parents=True)
+    (top / 'n' / 'm' / 'f.txt').write_text('f')
+    (top / 'a.txt').write_text('changed')
+    assert rel(top, index.rescan()) == [
+        ('deleted', 'd/e/c.txt', False), ('deleted', 'd/e', True),
+        ('created', 'n', True), ('created', 'n/m', True), ('created', 'n/m/f.txt', False),
+        ('modified', 'a.txt', False)]
+    assert index.count == 6
+
+
+def test_directory_replaced_by_a_file(top):
+    index = make_index(top)
+    index.rescan(report=False)
+    (top / 'd' / 'e' / 'c.txt').unlink()
+    (top / 'd' / 'e').rmdir()
+    (top / 'd' / 'e').write_text('e')
+    assert rel(top, index.rescan()) == [
+        ('deleted', 'd/e/c.txt', False), ('deleted', 'd/e', True), ('created', 'd/e', False)]
+
+
+def test_excluded_directories_are_not_indexed(top):
+    index = make_index(top, excluded=['d/e'])
+    index.rescan(report=False)
+    assert index.count == 3
+    (top / 'd' / 'e' / 'new.txt').write_text('new')
+    assert index.rescan() == []
+
+
+def test_filtered_files_are_not_indexed(top):
+    index = make_index(top, include_extensions={'.txt'})
+    index.rescan(report=False)
+    (top / 'd' / 'x.jpg').write_text('x')
+    (top / 'd' / 'y.txt').write_text('y')
+    # the directories are walked but are not entries
+    assert index.count == 3
+    assert rel(top, index.rescan()) == [('created', 'd/y.txt', False)]
+
+
+def test_missing_top(tmp_path):
+    index = make_index(tmp_path / 'top')
+    index.rescan(report=False)
+    (tmp_path / 'top').mkdir()
+    (tmp_path / 'top' / 'a').write_text('a')
+    assert rel(tmp_path / 'top', index.rescan()) == [('created', 'a', False)]
+    (tmp_path / 'top' / 'a').unlink()
+    (tmp_path / 'top').rmdir()
+    assert rel(tmp_path / 'top', index.rescan()) == [('deleted', 'a', False)]
+
+
+def test_unchanged_directories_are_not_listed(top, monkeypatch):
+    index = make_index(top, mask=pyinotify.IN_CREATE | pyinotify.IN_DELETE)
+    for directory in (top / 'd' / 'e', top / 'd', top):
+        # older than the mtime resolution, as a directory not changed recently
+        os.utime(str(directory), (time.time() - 10, time.time() - 10))
+    index.rescan(report=False)
+    listed = []
+    listdir = index.listdir
+    monkeypatch.setattr(index, 'listdir', lambda path: listed.append(path) or listdir(path))
+    assert index.rescan() == []
+    assert listed == []
+    (top / 'd' / 'new.txt').write_text('new')
+    assert rel(top, index.rescan()) == [('created', 'd/new.txt', False)]
+    assert listed == [str(top / 'd')]
+
+
+def test_live_events_update_the_index(top):
+    index = make_index(top)
+    index.rescan(report=False)
+    os.rename(str(top / 'd'), str(top / 'moved'))
+    (top / 'a.txt').unlink()
+    for path in ('d', 'moved', 'a.txt'):
+        index.record(Event(str(top / path)))
+    index.close()
+    # the moved tree is indexed, nothing is left to reconcile
+    assert index.count == 4
+    assert index.rescan() == []
+    with index.lock:
+        assert index.paths.lookup(str(top / 'd')) == -1
+        assert index.paths.lookup(str(top / 'a.txt')) == -1
+
+
+def test_state_file_sends_the_changes_since_the_last_run(top, tmp_path):
+    state_file = str(tmp_path / 'state.db')
+    index = make_index(top, state_file=state_file)
+    handler = Recorder()
+    index.build(handler)
+    assert handler.events == []
+    (top / 'd' / 'b.txt').unlink()
+    index.record(Event(str(top / 'd' / 'b.txt')))
+    index.close()
+    (top / 'a.txt').unlink()
+    (top / 'd' / 'new.txt').write_text('new')
+
+    index = make_index(top, state_file=state_file)
+    index.build(handler)
+    index.close()
+    assert [(maskname, os.path.relpath(path, str(top))) for (maskname, path) in handler.events] == [
+        ('IN_DELETE', 'a.txt'), ('IN_CREATE', 'd/new.txt')]
+
+
+def test_state_file_of_other_options_is_ignored(top, tmp_path):
+    state_file = str(tmp_path / 'state.db')
+    index = make_index(top, state_file=state_file)
+    index.build(Recorder())
+    index.close()
+    index = watcher.TreeIndex(str(top), True, watcher.PathTrie(), watcher.FileFilter(), MASK,
+                              state_file=state_file, key='other')
+    handler = Recorder()
+    index.build(handler)
+    index.close()
+    assert handler.events == []
+    assert index.count == 5
@@ -17,6 +17,24 @@ import daemon, lockfile
 import re
 import subprocess
 import shlex
+import threading
+import functools, itertools, collections
+import multiprocessing
+import importlib
+import heapq
+import fnmatch
+import socket
+import stat
+import hashlib
+import array, glob
+import json
+import fcntl, select
+try:
+    import socketserver
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # python 2
+    import SocketServer as socketserver
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 try:
     import configparser
@@ -26,6 +44,29 @@ try:
     basestring
 except NameError:  # python 3 compatibility
     basestring = str
+try:
+    monotonic = time.monotonic
+except AttributeError:  # python 2
+    monotonic = time.time
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    try:
+        from scandir import scandir  # scandir from pip
+    except ImportError:
+        scandir = None
+try:
+    import asyncio
+except ImportError:  # python 2
+    asyncio = None
+try:
+    import sqlite3
+except ImportError:  # python built without sqlite
+    sqlite3 = None
+try:
+    fsencode = os.fsencode
+except AttributeError:  # python 2
+    fsencode = lambda s: s.encode(sys.getfilesystemencoding() or 'utf-8')
 
 logger = logging.getLogger("daemonlog")
 logger.setLevel(logging.INFO)
@@ -40,6 +81,13 @@ VIDEO_EXTENSIONS = ('.3g2', '.3gp', '.3gp2', '.3gpp', '.60d', '.ajp', '.asf', '.
                     '.qt', '.ram', '.rm', '.rmvb', '.swf', '.ts', '.vfw', '.vid', '.video', '.viv', '.vivo', '.vob',
                     '.vro', '.wm', '.wmv', '.wmx', '.wrap', '.wvx', '.wx', '.x264', '.xvid')
 
+# Command line limits (see execve(2)), with a fallback for systems without sysconf
+try:
+    ARG_MAX = os.sysconf('SC_ARG_MAX')
+except (AttributeError, ValueError, OSError):
+    ARG_MAX = 131072
+MAX_ARG_STRLEN = 131072 - 1
+
 class DaemonRunnerError(Exception):
     """ Abstract base class for errors from DaemonRunner. """
 
@@ -52,6 +100,9 @@ class DaemonRunnerStartFailureError(RuntimeError, DaemonRunnerError):
 class DaemonRunnerStopFailureError(RuntimeError, DaemonRunnerError):
     """ Raised when failure stopping DaemonRunner. """
 
+class DaemonRunnerReloadFailureError(RuntimeError, DaemonRunnerError):
+    """ Raised when failure reloading DaemonRunner. """
+
 
 class DaemonRunner(object):
     """ Controller for a callable running in a separate background process.
@@ -59,6 +110,7 @@ class DaemonRunner(object):
         * 'start': Become a daemon and call `run()`.
         * 'stop': Exit the daemon process specified in the PID file.
         * 'restart': Call `stop()`, then `start()`.
+        * 'reload': Send SIGHUP to the daemon process specified in the PID file.
         * 'run': Run `func(func_arg)`
         """
     def __init__(self, func, func_arg=None, pidfile=None, stdin=None, stdout=None, stderr=None, uid=None, gid=None, umask=None, working_directory=None, signal_map=None, files_preserve=None):
@@ -87,7 +139,6 @@ class DaemonRunner(object):
         if signal_map is not None:
             self.daemon_context.signal_map = signal_map
         self.daemon_context.files_preserve = files_preserve
-        signal.signal(signal.SIGCLD, signal.SIG_IGN)
 
     def restart(self):
         """ Stop, then start.
@@ -138,6 +189,21 @@ class DaemonRunner(object):
             self.pidfile.break_lock()
         logger.info("Daemon stopped")
 
+    def reload(self):
+        """ Ask the daemon process specified in the current PID file to reload its configuration.
+            """
+        if not self.pidfile.is_locked() or is_pidfile_stale(self.pidfile):
+            pidfile_path = self.pidfile.path
+            logger.info("PID file %(pidfile_path)r not locked, daemon not running" % vars())
+            return
+        pid = self.pidfile.read_pid()
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as exc:
+            raise DaemonRunnerReloadFailureError(
+                "Failed to reload %(pid)d: %(exc)s" % vars())
+        logger.info("Daemon reload requested")
+
     def _terminate_daemon_process(self, sig=signal.SIGTERM):
         """ Terminate the daemon process specified in the current PID file.
             """
@@ -190,303 +256,4110 @@ def is_pidfile_stale(pidfile):
 
     return result
 
-class EventHandler(pyinotify.ProcessEvent):
-    def __init__(self, job, command, include_extensions, exclude_extensions, exclude_re, background, outfile):
-        pyinotify.ProcessEvent.__init__(self)
-        self.job = job
-        self.command = command
-        self.include_extensions = include_extensions
-        self.exclude_extensions = exclude_extensions
-        self.exclude_re_txt = exclude_re
-        self.exclude_re = None if not exclude_re else re.compile(exclude_re)
-        self.background = background
-        self.outfile = outfile
-        
-    # from http://stackoverflow.com/questions/35817/how-to-escape-os-system-calls-in-python
-    def shellquote(self, s):
-        s = str(s)
-        return "'" + s.replace("'", "'\\''") + "'"
+class TokenBucket(object):
+    """ Rate limit of `rate` actions per second, with up to `burst` actions at once.
+        """
+    def __init__(self, rate, burst=1):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.stamp  = monotonic()
 
-    def runCommand(self, event):
-        # if specified, exclude extensions, or include extensions.
-        if self.include_extensions and all(not event.pathname.endswith(ext) for ext in self.include_extensions):
-            #print "File %s excluded because its exension is not in the included extensions %r"%(event.pathname, self.include_extensions)
-            logger.debug("File %s excluded because its extension is not in the included extensions %r"%(event.pathname, self.include_extensions))
-            return
-        if self.exclude_extensions and any(event.pathname.endswith(ext) for ext in self.exclude_extensions):
-            #print "File %s excluded because its extension is in the excluded extensions %r"%(event.pathname, self.exclude_extensions)
-            logger.debug("File %s excluded because its extension is in the excluded extensions %r"%(event.pathname, self.exclude_extensions))
-            return
-        if self.exclude_re and self.exclude_re.search(os.path.basename(event.pathname)):
-            logger.debug("File %s excluded because its name matched exclude regexp '%s'"%(event.pathname, self.exclude_re_txt))
-            return
+    def delay(self, now):
+        """ Seconds until the next action is allowed, 0 if it is allowed now.
+            """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
 
-        t = string.Template(self.command)
-        command = t.substitute(job=self.shellquote(self.job),
-                               watched=self.shellquote(event.path),
-                               filename=self.shellquote(event.pathname),
-                               tflags=self.shellquote(event.maskname),
-                               nflags=self.shellquote(event.mask),
-                               cookie=self.shellquote(event.cookie if hasattr(event, "cookie") else 0))
-        try:
-            if not self.background:
-                # sync exec
-                os.system(command)
-                #print "Run command print: %s" % (command)
-                logger.info("Run command log: %s" % (command))
+    def take(self):
+        self.tokens -= 1
+
+
+class CommandScheduler(object):
+    """ Run the job commands on a bounded pool of worker threads.
+
+        At most `max_workers` commands run at once, and at most `max_concurrency`
+        for a given job. Commands waiting for a worker are queued, up to `queue_size`
+        commands for all the jobs. When the queue is full, the `overflow` policy of
+        the submitting job applies, unless the job has no queued command:
+
+        * 'block': wait until a queued command is started.
+        * 'drop-oldest': drop the oldest queued command of the job.
+        * 'drop-newest': drop the submitted command.
+
+        Free workers take the next command of the job with the highest `priority`,
+        then with the lowest virtual time, which grows by 1 / `weight` for each
+        command started: backlogged jobs of a same priority start commands in
+        proportion to their weights. A job with a `rate_limit` starts at most that
+        many commands per second, `rate_burst` at once after being idle. The backlog
+        of the jobs and the commands held by their rate limit are logged with
+        `timers` every `REPORT_INTERVAL` seconds, while there is something to report.
+
+        Workers wait for their command to exit, so no child is left unreaped.
+        Python handlers run in the workers, or in a pool of `processes` processes
+        (see `process_pool`) while a worker waits for their result.
+        """
+    OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+    REPORT_INTERVAL = 10
+    # event loop running the commands, see `AsyncioScheduler`
+    loop = None
+    # size of the process pool of the handlers (default: number of CPUs)
+    processes = None
+    pool = None
+    # `TimerQueue` or `LoopTimers` of the reports
+    timers = None
+
+    def __init__(self, max_workers, queue_size):
+        self.max_workers = max_workers
+        self.queue_size  = queue_size
+        self.cond        = threading.Condition()
+        self.pending     = dict()   # job name -> deque of (seq, task)
+        self.running     = dict()   # job name -> number of running tasks
+        self.limits      = dict()   # job name -> (max_concurrency, overflow)
+        self.dropped     = dict()   # job name -> number of dropped tasks
+        self.shares      = dict()   # job name -> (priority, weight)
+        self.buckets     = dict()   # job name -> TokenBucket, for the jobs with a rate limit
+        self.vtimes      = dict()   # job name -> virtual time
+        self.vclock      = 0        # virtual time of the last task started
+        self.throttled   = dict()   # job name -> number of tasks held by the rate limit
+        self.held        = dict()   # job name -> seq of the last task held by the rate limit
+        self.reported    = dict()   # job name -> (throttled, dropped) at the last report
+        self.report_time = None
+        self.report_timer = None
+        self.wakeup      = None     # seconds until a job held by its rate limit can start a task
+        self.queued      = 0
+        self.seq         = itertools.count()
+        self.workers     = []
+        self.stopping    = False
+
+    def add_job(self, name, max_concurrency, overflow, rate_limit=None, rate_burst=1, priority=0, weight=1):
+        """ Add the job `name`, or update its limits. Its rate limit is kept if unchanged.
+            """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r for %s"%(overflow, name))
+        with self.cond:
+            self.limits[name] = (max_concurrency, overflow)
+            self.shares[name] = (priority, weight)
+            bucket = self.buckets.get(name)
+            if rate_limit is None:
+                self.buckets.pop(name, None)
+            elif bucket is None or (bucket.rate, bucket.burst) != (rate_limit, rate_burst):
+                self.buckets[name] = TokenBucket(rate_limit, rate_burst)
+            self.pending.setdefault(name, collections.deque())
+            self.running.setdefault(name, 0)
+            self.dropped.setdefault(name, 0)
+            self.vtimes.setdefault(name, self.vclock)
+            self.throttled.setdefault(name, 0)
+            self.cond.notify_all()
+
+    def remove_job(self, name):
+        """ Drop the queued tasks of the job `name`; its running tasks are not interrupted.
+            """
+        with self.cond:
+            self.queued -= len(self.pending[name])
+            self.pending[name].clear()
+            del self.limits[name]
+            self.buckets.pop(name, None)
+            self.cond.notify_all()
+
+    def submit(self, name, task):
+        """ Queue the callable `task` of the job `name`.
+
+            Return False if `task` was not queued.
+            """
+        with self.cond:
+            limits = self.limits.get(name)
+            if limits is None:
+                logger.debug("%s: job removed, command dropped"%name)
+                return False
+            if self.queue_full(name):
+                if limits[1] == 'block':
+                    while self.queue_full(name) and not self.stopping and name in self.limits:
+                        self.cond.wait()
+                elif not self.drop(name, limits[1]):
+                    return False
+            if self.stopping:
+                return False
+            if name not in self.limits:
+                logger.debug("%s: job removed, command dropped"%name)
+                return False
+            self.enqueue(name, task)
+            self.cond.notify_all()
+        return True
+
+    def queue_full(self, name):
+        """ Whether the queue is full for the job `name`.
+
+            A job without queued tasks can always queue one, so that a flooded job
+            filling the queue does not hold the others.
+            """
+        return self.queued >= self.queue_size and len(self.pending[name]) > 0
+
+    def enqueue(self, name, task):
+        queue = self.pending[name]
+        if not queue:
+            # an idle job does not save up virtual time
+            self.vtimes[name] = max(self.vtimes[name], self.vclock)
+        queue.append((next(self.seq), task))
+        self.queued += 1
+        if self.timers is not None and self.report_timer is None:
+            self.report_time = monotonic()
+            self.report_timer = self.timers.call_later(self.REPORT_INTERVAL, self.report)
+
+    def drop(self, name, overflow):
+        """ Apply a drop `overflow` policy of the job `name` to the full queue.
+
+            Return False if the submitted task is the one dropped.
+            """
+        self.dropped[name] += 1
+        metrics.inc('watcher_commands_dropped_total', job=name)
+        if overflow == 'drop-oldest' and self.pending[name]:
+            self.pending[name].popleft()
+            self.queued -= 1
+            logger.debug("%s: command queue full, dropped the oldest command"%name)
+            return True
+        logger.debug("%s: command queue full, dropped the new command"%name)
+        return False
+
+    def next_task(self):
+        """ Pop the next task to start, among the jobs below their concurrency and rate limits.
+
+            The job with the highest priority, then the lowest virtual time, then
+            the oldest task is chosen. `wakeup` is set to the seconds until a job
+            held by its rate limit can start a task.
+            """
+        now = monotonic()
+        best, best_key = None, None
+        self.wakeup = None
+        for (name, queue) in self.pending.items():
+            if not queue or name not in self.limits or self.running[name] >= self.limits[name][0]:
+                continue
+            bucket = self.buckets.get(name)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay > 0:
+                    self.throttle(name, queue[0][0])
+                    if self.wakeup is None or delay < self.wakeup:
+                        self.wakeup = delay
+                    continue
+            key = (-self.shares[name][0], self.vtimes[name], queue[0][0])
+            if best_key is None or key < best_key:
+                best, best_key = name, key
+        if best is None:
+            return None
+        self.queued -= 1
+        self.vclock = self.vtimes[best]
+        self.vtimes[best] += 1 / self.shares[best][1]
+        if best in self.buckets:
+            self.buckets[best].take()
+        return best, self.pending[best].popleft()[1]
+
+    def throttle(self, name, seq):
+        """ Count the task `seq` of the job `name` as held by its rate limit, once.
+            """
+        if self.held.get(name) != seq:
+            self.held[name] = seq
+            self.throttled[name] += 1
+            metrics.inc('watcher_commands_throttled_total', job=name)
+
+    def report(self):
+        """ Log the backlog of the jobs, and their tasks throttled or dropped since the last report.
+
+            Reports go on until there is nothing to report, and start again with the next queued task.
+            """
+        now = monotonic()
+        with self.cond:
+            active = False
+            for (name, queue) in self.pending.items():
+                counts = (self.throttled[name], self.dropped[name])
+                last = self.reported.get(name, (0, 0))
+                if queue or counts != last:
+                    logger.info("%s: %d commands queued, %d running, %d throttled and %d dropped in %d s"%(
+                                name, len(queue), self.running[name], counts[0] - last[0], counts[1] - last[1],
+                                now - self.report_time))
+                    self.reported[name] = counts
+                    active = True
+            self.report_time = now
+            if active and not self.stopping:
+                self.report_timer = self.timers.call_later(self.REPORT_INTERVAL, self.report)
             else:
-                logger.info("Executing child: \"%s\""%command)
-                args = shlex.split(command)
-                # async exec
-                subprocess.Popen(args, stdout=self.outfile, stderr=self.outfile)
-        except OSError as err:
-            #print "Failed to run command '%s' %s" % (command, str(err))
-            logger.info("Failed to run command '%s' %s" % (command, str(err)))
+                self.report_timer = None
 
+    def backlog(self):
+        """ Number of queued tasks per job, for the 'watcher_job_queue_depth' gauge.
+            """
+        with self.cond:
+            return [(dict(job=name), len(queue)) for (name, queue) in self.pending.items() if name in self.limits]
 
+    def run_worker(self):
+        while True:
+            with self.cond:
+                item = self.next_task()
+                while item is None:
+                    if self.stopping:
+                        return
+                    self.cond.wait(self.wakeup)
+                    item = self.next_task()
+                name, task = item
+                self.running[name] += 1
+                self.cond.notify_all()
+            try:
+                task()
+            except Exception:
+                logger.exception("%s: command failed"%name)
+            finally:
+                with self.cond:
+                    self.running[name] -= 1
+                    self.cond.notify_all()
 
+    def start(self):
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self.run_worker, name='worker-%d'%i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
 
-    def process_IN_ACCESS(self, event):
-        #print "Access: %s"%(event.pathname)
-        logger.info("Access: %s"%(event.pathname))
-        self.runCommand(event)
+    def stop(self):
+        """ Drop the queued commands and let the workers exit once their command is done.
+            """
+        with self.cond:
+            self.stopping = True
+            if self.queued:
+                logger.info("Dropped %d queued commands"%self.queued)
+            for queue in self.pending.values():
+                queue.clear()
+            self.queued = 0
+            self.cond.notify_all()
+        # handlers still running in the pool are not waited for
+        if self.pool is not None:
+            self.pool.terminate()
 
-    def process_IN_ATTRIB(self, event):
-        #print "Attrib: %s"%(event.pathname)
-        logger.info("Attrib: %s"%(event.pathname))
-        self.runCommand(event)
+    def count_running(self):
+        with self.cond:
+            return sum(self.running.values())
 
-    def process_IN_CLOSE_WRITE(self, event):
-        #print "Close write: %s"%(event.pathname)
-        logger.info("Close write: %s"%(event.pathname))
-        self.runCommand(event)
+    def process_pool(self):
+        """ Pool of processes running the handlers with `handler_pool = processes`, started on first use.
+            """
+        with self.cond:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+                logger.debug("Started %d handler processes"%(self.processes or multiprocessing.cpu_count()))
+            return self.pool
 
-    def process_IN_CLOSE_NOWRITE(self, event):
-        #print "Close nowrite: %s"%(event.pathname)
-        logger.info("Close nowrite: %s"%(event.pathname))
-        self.runCommand(event)
 
-    def process_IN_CREATE(self, event):
-        #print "Creating: %s"%(event.pathname)
-        logger.info("Creating: %s"%(event.pathname))
-        self.runCommand(event)
+class AsyncioScheduler(CommandScheduler):
+    """ `CommandScheduler` running the commands as subprocesses of an asyncio event loop.
 
-    def process_IN_DELETE(self, event):
-        #print "Deleting: %s"%(event.pathname)
-        logger.info("Deleting: %s"%(event.pathname))
-        self.runCommand(event)
+        There is no worker thread: tasks return a future, and the next task is
+        started when a future is done. `submit`, `add_job` and `remove_job` may
+        be called from any thread.
+        With the 'block' overflow policy, the event loop cannot wait: the task is
+        queued anyway, and `backpressure.pause()` is called to stop reading events
+        until the queue has room again (`backpressure.resume()`).
+        """
+    def __init__(self, loop, max_workers, queue_size):
+        CommandScheduler.__init__(self, max_workers, queue_size)
+        self.loop         = loop
+        self.thread       = None
+        self.active       = 0
+        self.backpressure = None
+        self.paused       = False
+        self.timer        = None     # launch when a job held by its rate limit can start a task
 
-    def process_IN_MODIFY(self, event):
-        #print "Modify: %s"%(event.pathname)
-        logger.info("Modify: %s"%(event.pathname))
-        self.runCommand(event)
+    def add_job(self, *args, **kwargs):
+        self.in_loop(CommandScheduler.add_job, self, *args, **kwargs)
 
-    def process_IN_MOVE_SELF(self, event):
-        #print "Move self: %s"%(event.pathname)
-        logger.info("Move self: %s"%(event.pathname))
-        self.runCommand(event)
+    def remove_job(self, name):
+        self.in_loop(CommandScheduler.remove_job, self, name)
 
-    def process_IN_MOVED_FROM(self, event):
-        #print "Moved from: %s"%(event.pathname)
-        logger.info("Moved from: %s"%(event.pathname))
-        self.runCommand(event)
+    def in_loop(self, method, *args, **kwargs):
+        """ Call `method` from the thread of the event loop, then launch the tasks it allows.
 
-    def process_IN_MOVED_TO(self, event):
-        #print "Moved to: %s"%(event.pathname)
-        logger.info("Moved to: %s"%(event.pathname))
-        self.runCommand(event)
+            The jobs are iterated by `next_task` without lock: they are only
+            changed by the loop, the other threads wait for it to call `method`.
+            """
+        if self.thread is None or threading.current_thread() is self.thread:
+            result = method(*args, **kwargs)
+            if self.thread is not None and not self.stopping:
+                self.launch()
+            return result
+        done, outcome = threading.Event(), []
+        def call():
+            try:
+                outcome.append((True, self.in_loop(method, *args, **kwargs)))
+            except Exception as err:
+                outcome.append((False, err))
+            finally:
+                done.set()
+        self.loop.call_soon_threadsafe(call)
+        done.wait()
+        ok, result = outcome[0]
+        if not ok:
+            raise result
+        return result
 
-    def process_IN_OPEN(self, event):
-        #print "Opened: %s"%(event.pathname)
-        logger.info("Opened: %s"%(event.pathname))
-        self.runCommand(event)
+    def submit(self, name, task):
+        if threading.current_thread() is not self.thread:
+            self.loop.call_soon_threadsafe(self.submit, name, task)
+            return True
+        limits = self.limits.get(name)
+        if limits is None:
+            logger.debug("%s: job removed, command dropped"%name)
+            return False
+        if self.stopping:
+            return False
+        if self.queue_full(name):
+            if limits[1] == 'block':
+                self.pause()
+            elif not self.drop(name, limits[1]):
+                return False
+        self.enqueue(name, task)
+        self.launch()
+        return True
 
-def watcher(config):
-    wdds      = dict()
-    notifiers = dict()
-
-    # read jobs from config file
-    for section in config.sections():
-        # get the basic config info
-        mask      = parseMask(config.get(section,'events').split(','))
-        folder    = config.get(section,'watch')
-        recursive = config.getboolean(section,'recursive')
-        autoadd   = config.getboolean(section,'autoadd')
-        excluded  = None if '' in config.get(section,'excluded').split(',') else set(config.get(section,'excluded').split(','))
-        include_extensions = None if '' in config.get(section,'include_extensions').split(',') else set(config.get(section,'include_extensions').split(','))
-        exclude_extensions = None if '' in config.get(section,'exclude_extensions').split(',') else set(config.get(section,'exclude_extensions').split(','))
-        exclude_re = None if not config.get(section,'exclude_re') else config.get(section,'exclude_re')
-        command   = config.get(section,'command')
-        background= config.getboolean(section,'background')
-
-        outfile = config.get(section, 'outfile')
-        t = string.Template(outfile)
-        outfile = t.substitute(job=section)
-        outfile_h = open(outfile, 'a+b', buffering=0) if outfile else None
-        logger.debug("outfile = '%s'"%outfile)
-
-        logger.info(section + ": " + folder)
-
-        # parse include_extensions
-        if include_extensions and 'video' in include_extensions:
-            include_extensions.discard('video')
-            include_extensions |= set(VIDEO_EXTENSIONS)
-
-        wm = pyinotify.WatchManager()
-        handler = EventHandler(section, command, include_extensions, exclude_extensions, exclude_re, background, outfile_h)
-
-        wdds[section] = wm.add_watch(folder, mask, rec=recursive,auto_add=autoadd)
-        # Remove watch about excluded dir. 
-        if excluded:
-            for excluded_dir in excluded :
-                for (k,v) in wdds[section].items():
-                    if k.startswith(excluded_dir):
-                        wm.rm_watch(v)
-                        wdds[section].pop(k)
-                logger.debug("Excluded dirs : " + excluded_dir)
-        # Create ThreadNotifier so that each job has its own thread
-        notifiers[section] = pyinotify.ThreadedNotifier(wm, handler)
-
-    # Start all the notifiers.
-    for (name, notifier) in notifiers.items():
-        try:
-            notifier.start()
-            logger.debug('Notifier for %s is instanciated'%(name))
-        except pyinotify.NotifierError as err:
-            logger.warning( '%r %r'%(sys.stderr, err))
-    
-    # Wait for SIGTERM
-    try:
-        while 1:
-            time.sleep(0.1)
-    except:
-        cleanup_notifiers(notifiers)
-    if outfile:
-        outfile_h.close()
-        logger.debug("closed %s"%outfile)
-    
-def cleanup_notifiers(notifiers):
-    """Close notifiers instances when the process is killed
-    """
-    for notifier in notifiers.values():
-        notifier.stop()
+    def pause(self):
+        if not self.paused and self.backpressure is not None:
+            logger.debug("Command queue full, events are not read")
+            self.paused = True
+            self.backpressure.pause()
 
-def parseMask(masks):
-    ret = False;
+    def launch(self):
+        """ Start queued tasks while there are free slots.
+            """
+        while self.active < self.max_workers:
+            item = self.next_task()
+            if item is None:
+                break
+            name, task = item
+            self.running[name] += 1
+            self.active += 1
+            try:
+                future = task()
+            except Exception:
+                logger.exception("%s: command failed"%name)
+                self.done(name, None)
+                continue
+            future.add_done_callback(functools.partial(self.done, name))
+        if self.wakeup is not None and self.timer is None:
+            self.timer = self.loop.call_later(self.wakeup, self.relaunch)
+        if self.paused and self.queued < self.queue_size:
+            logger.debug("Command queue has room, events are read again")
+            self.paused = False
+            self.backpressure.resume()
 
-    for mask in masks:
-        mask = mask.strip()
+    def relaunch(self):
+        self.timer = None
+        if not self.stopping:
+            self.launch()
 
-        if 'access' == mask:
-            ret = addMask(pyinotify.IN_ACCESS, ret)
-        elif 'attribute_change' == mask:
-            ret = addMask(pyinotify.IN_ATTRIB, ret)
-        elif 'write_close' == mask:
-            ret = addMask(pyinotify.IN_CLOSE_WRITE, ret)
-        elif 'nowrite_close' == mask:
-            ret = ddMask(pyinotify.IN_CLOSE_NOWRITE, ret)
-        elif 'create' == mask:
-            ret = addMask(pyinotify.IN_CREATE, ret)
-        elif 'delete' == mask:
-            ret = addMask(pyinotify.IN_DELETE, ret)
-        elif 'self_delete' == mask:
-            ret = addMask(pyinotify.IN_DELETE_SELF, ret)
-        elif 'modify' == mask:
-            ret = addMask(pyinotify.IN_MODIFY, ret)
-        elif 'self_move' == mask:
-            ret = addMask(pyinotify.IN_MOVE_SELF, ret)
-        elif 'move_from' == mask:
-            ret = addMask(pyinotify.IN_MOVED_FROM, ret)
-        elif 'move_to' == mask:
-            ret = addMask(pyinotify.IN_MOVED_TO, ret)
-        elif 'open' == mask:
-            ret = addMask(pyinotify.IN_OPEN, ret)
-        elif 'all' == mask:
-            m = pyinotify.IN_ACCESS | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | \
-                pyinotify.IN_CLOSE_NOWRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
-                pyinotify.IN_DELETE_SELF | pyinotify.IN_MODIFY | pyinotify.IN_MOVE_SELF | \
-                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_OPEN
-            ret = addMask(m, ret)
-        elif 'move' == mask:
-            ret = addMask(pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO, ret)
-        elif 'close' == mask:
-            ret = addMask(pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE, ret)
-    return ret
+    def done(self, name, future):
+        self.running[name] -= 1
+        self.active -= 1
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            logger.error("%s: command failed: %s"%(name, future.exception()))
+        if not self.stopping:
+            self.launch()
 
-def addMask(new_option, current_options):
-    if not current_options:
-        return new_option
-    else:
-        return current_options | new_option
+    def start(self):
+        # the thread running the event loop
+        self.thread = threading.current_thread()
 
-def init_daemon(cf):
-    """Convert config.defaults() OrderedDict to a `dict` to use in daemon initialization
-    """
-    #logfile = cf.get('logfile', '/tmp/watcher.log')
-    pidfile = cf.get('pidfile', '/tmp/watcher.pid')
-    # uid
-    uid = cf.get('uid', None)
-    if uid is not None:
-        try:
-            uid = int(uid)
-        except ValueError as e:
-            if uid != '':
-                logger.warning('Incorrect uid value: %r' %(e))    
-            uid = None
-    # gid
-    gid = cf.get('gid', None)
-    if gid is not None:
-        try:
-            gid = int(gid)
-        except ValueError as e:
-            if gid != '':
-                logger.warning('Incorrect gid value: %r' %(e))    
-            gid = None
+    def stop(self):
+        self.stopping = True
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.queued:
+            logger.info("Dropped %d queued commands"%self.queued)
+        for queue in self.pending.values():
+            queue.clear()
+        self.queued = 0
+        if self.pool is not None:
+            self.pool.terminate()
 
-    umask = cf.get('umask', None)
-    if umask is not None:
-        try:
-            umask = int(umask)
-        except ValueError as e:
-            if umask != '':
-                logger.warning('Incorrect umask value: %r' %(e))    
-            umask = None
 
-    wd = cf.get('working_directory', None)
-    if wd is not None and not os.path.isdir(wd):
-        if wd != '':
-            logger.warning('Working directory not a valid directory ("%s"). Set to default ("/")' %(wd))    
-        wd = None
+class Metrics(object):
+    """ Counters, gauges and histograms of the daemon, in the Prometheus text format.
 
-    return {'pidfile':pidfile, 'stdin':None, 'stdout':None, 'stderr':None, 'uid':uid, 'gid':gid, 'umask':umask, 'working_directory':wd}
+        Metrics are declared with `describe`, then updated with `inc` and
+        `observe`; gauges are callables evaluated by `render`, returning a value
+        or a list of (labels, value) pairs.
+        """
+    DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
 
-if __name__ == "__main__":
-    # Parse commandline arguments
-    parser = argparse.ArgumentParser(
-                description='A daemon to monitor changes within specified directories and run commands on these changes.',
-             )
-    parser.add_argument('-c','--config',
-                        action='store',
-                        help='Path to the config file (default: %(default)s)')
-    parser.add_argument('command',
-                        action='store',
-                        choices=['start','stop','restart','debug'],
-                        help='What to do.')
-    parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.help       = collections.OrderedDict()    # name -> (type, help)
+        self.values     = collections.defaultdict(dict) # name -> {labels: value}
+        self.gauges     = dict()                        # name -> callable
 
-    args = parser.parse_args()
+    def describe(self, name, kind, help):
+        self.help[name] = (kind, help)
 
-    # Parse the config file
-    config = configparser.ConfigParser()
-    if args.config:
-        # load config file specified by commandline
-        confok = config.read(args.config)
-    else:
-        # load config file from default locations
-        confok = config.read(['/etc/watcher.ini', os.path.expanduser('~/.watcher.ini')]);
-    if not confok:
-        sys.stderr.write("Failed to read config file. Try -c parameter\n")
-        sys.exit(4);
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add `value` to the histogram `name`.
+            """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            if key not in values:
+                values[key] = [0] * (len(self.DURATION_BUCKETS) + 2)
+            histogram = values[key]
+            for (i, bound) in enumerate(self.DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name, func, help):
+        self.describe(name, 'gauge', help)
+        self.gauges[name] = func
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values[name].get(tuple(sorted(labels.items())), 0)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('%s="%s"' % (k, escape(v)) for (k, v) in labels) + '}'
+
+    def render(self):
+        lines = []
+        for (name, (kind, help)) in self.help.items():
+            if name in self.gauges:
+                try:
+                    values = self.gauges[name]()
+                except Exception:
+                    logger.exception("Failed to evaluate gauge %s"%name)
+                    continue
+                if not isinstance(values, list):
+                    values = [({}, values)]
+                values = [(tuple(sorted(labels.items())), value) for (labels, value) in values]
+            else:
+                with self.lock:
+                    values = sorted((key, list(v) if isinstance(v, list) else v) for (key, v) in self.values[name].items())
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, value) in values:
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+                    continue
+                for (bound, count) in zip(self.DURATION_BUCKETS + ('+Inf',), value[:-2] + [value[-1]]):
+                    lines.append('%s_bucket%s %d' % (name, self.format_labels(labels + (('le', bound),)), count))
+                lines.append('%s_sum%s %s' % (name, self.format_labels(labels), value[-2]))
+                lines.append('%s_count%s %d' % (name, self.format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('watcher_events_received_total', 'counter', 'Events received, per job and event type.')
+metrics.describe('watcher_events_filtered_total', 'counter', 'Events excluded by the job filters, per job and event type.')
+metrics.describe('watcher_events_dispatched_total', 'counter', 'Events that passed the job filters, per job and event type.')
+metrics.describe('watcher_queue_overflows_total', 'counter', 'IN_Q_OVERFLOW events, per job.')
+metrics.describe('watcher_reconciliations_total', 'counter', 'Rescans of the tree of a job after an overflow, per job.')
+metrics.describe('watcher_reconciled_events_total', 'counter', 'Changes found by the rescans, per job and change.')
+metrics.describe('watcher_commands_launched_total', 'counter', 'Commands and handlers started, per job.')
+metrics.describe('watcher_commands_failed_total', 'counter', 'Commands that could not be started or exited with a non-zero status, and handlers that raised an exception, per job.')
+metrics.describe('watcher_commands_dropped_total', 'counter', 'Commands dropped because the queue was full, per job.')
+metrics.describe('watcher_commands_throttled_total', 'counter', 'Commands held by the rate limit of their job, per job.')
+metrics.describe('watcher_command_exit_codes_total', 'counter', 'Exit statuses of the commands, per job.')
+metrics.describe('watcher_dedupe_lookups_total', 'counter', 'Lookups of the content digest cache of the jobs with dedupe=content, per job and result (hit or miss).')
+metrics.describe('watcher_events_deduplicated_total', 'counter', 'Events that did not run the command because the content of their file did not change, per job.')
+metrics.describe('watcher_command_duration_seconds', 'histogram', 'Duration of the commands and handlers, per job.')
+
+
+class StatsRequestHandler(socketserver.StreamRequestHandler):
+    """ Write the metrics to the client of the stats unix socket, then close it. """
+    def handle(self):
+        self.wfile.write(metrics.render().encode('utf-8'))
+
+
+class StatsHTTPRequestHandler(BaseHTTPRequestHandler):
+    """ Serve the metrics over HTTP, for Prometheus. """
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("stats: " + format % args)
+
+
+if asyncio is not None:
+    class StatsProtocol(asyncio.Protocol):
+        """ Serve the metrics from an asyncio event loop, raw or over HTTP.
+            """
+        def __init__(self, http=False):
+            self.http      = http
+            self.transport = None
+            self.request   = b''
+
+        def connection_made(self, transport):
+            self.transport = transport
+            if not self.http:
+                transport.write(metrics.render().encode('utf-8'))
+                transport.close()
+
+        def data_received(self, data):
+            self.request += data
+            if b'\r\n\r\n' not in self.request and b'\n\n' not in self.request:
+                return
+            body = metrics.render().encode('utf-8')
+            self.transport.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                                 b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+            self.transport.close()
+
+
+class StatsServer(object):
+    """ Expose the metrics on a unix socket, on a HTTP port and/or in a file.
+
+        The file is written every `interval` seconds (atomically, for the
+        textfile collector of the node exporter). The sockets are served by a
+        thread each, or by the asyncio event `loop`.
+        """
+    def __init__(self, socket_path=None, port=None, address='127.0.0.1', filename=None, interval=60, timers=None, loop=None):
+        self.socket_path = socket_path
+        self.port        = port
+        self.address     = address
+        self.filename    = filename
+        self.interval    = interval
+        self.timers      = timers
+        self.loop        = loop
+        self.servers     = []
+        self.timer       = None
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever, name='stats')
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+
+    def start(self):
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            if self.loop is not None:
+                self.servers.append(self.loop.run_until_complete(
+                    self.loop.create_unix_server(StatsProtocol, self.socket_path)))
+            else:
+                self.serve(socketserver.UnixStreamServer(self.socket_path, StatsRequestHandler))
+            logger.debug("Stats on unix socket %s"%self.socket_path)
+        if self.port:
+            if self.loop is not None:
+                self.servers.append(self.loop.run_until_complete(
+                    self.loop.create_server(functools.partial(StatsProtocol, True), self.address, self.port)))
+            else:
+                self.serve(HTTPServer((self.address, self.port), StatsHTTPRequestHandler))
+            logger.debug("Stats on http://%s:%d/"%(self.address, self.port))
+        if self.filename:
+            self.write()
+
+    def write(self):
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(metrics.render())
+            os.rename(tmp, self.filename)
+        except (IOError, OSError) as err:
+            logger.warning("Failed to write stats to %s: %s"%(self.filename, err))
+        self.timer = self.timers.call_later(self.interval, self.write)
+
+    def stop(self):
+        for server in self.servers:
+            if self.loop is not None:
+                server.close()
+            else:
+                server.shutdown()
+                server.server_close()
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.timer is not None:
+            self.timer.cancel()
+
+def query_stats(socket_path):
+    """ Read the metrics of the running daemon from its stats unix socket.
+        """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return b''.join(chunks).decode('utf-8')
+
+def stats_socket(config):
+    """ Path of the stats unix socket: `stats_socket`, or next to the PID file by default.
+        """
+    path = get_option(config, 'DEFAULT', 'stats_socket')
+    if path is None:
+        pidfile = get_option(config, 'DEFAULT', 'pidfile', '/tmp/watcher.pid')
+        path = pidfile + '.sock'
+    return None if path == 'none' else path
+
+
+class Timer(object):
+    """ Callback scheduled by `TimerQueue.call_later`. """
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when      = when
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue(object):
+    """ Run delayed callbacks from a single thread, whatever the number of timers.
+
+        Timers are kept in a heap; `call_later` has the same signature as the
+        asyncio loop method.
+        """
+    def __init__(self):
+        self.heap     = []
+        self.cond     = threading.Condition()
+        self.seq      = itertools.count()
+        self.thread   = None
+        self.stopping = False
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        with self.cond:
+            heapq.heappush(self.heap, (timer.when, next(self.seq), timer))
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopping:
+                        return
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - monotonic()
+                    if delay <= 0:
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.cond.wait(delay)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback %r failed"%(timer.callback,))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='timers')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+
+class LoopTimers(object):
+    """ `TimerQueue` interface on an asyncio event loop.
+
+        `call_later` may be called from any thread; the callbacks run in the loop.
+        """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.fire, timer)
+        return timer
+
+    @staticmethod
+    def fire(timer):
+        if timer.cancelled:
+            return
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            logger.exception("Timer callback %r failed"%(timer.callback,))
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def maskname(mask):
+    """ Names of all the flags set in `mask`, separated by '|'.
+
+        Unlike `pyinotify.EventsCodes.maskname`, `mask` may hold several events.
+        """
+    names = [name for (name, value) in sorted(pyinotify.EventsCodes.OP_FLAGS.items(), key=lambda item: item[1])
+             if value & mask]
+    if mask & pyinotify.IN_ISDIR:
+        names.append('IN_ISDIR')
+    return '|'.join(names)
+
+def copy_event(event, **changes):
+    """ Copy of a pyinotify `event`, with the attributes in `changes` replaced.
+        """
+    attrs = dict(vars(event))
+    attrs.update(changes)
+    # pyinotify.Event only names masks of a single event
+    mask, attrs['mask'] = attrs['mask'], event.mask
+    copy = pyinotify.Event(attrs)
+    copy.mask = mask
+    copy.maskname = maskname(mask)
+    return copy
+
+# event passed to the python handlers of the jobs, picklable for the process pool;
+# `src` is the source path of a move, or `pathname`
+HandlerEvent = collections.namedtuple('HandlerEvent', 'job watched pathname mask maskname cookie src')
+
+_handlers = dict()  # 'module:function' -> function
+
+def load_handler(spec):
+    """ Import the function of a `handler` option, 'package.module:function'.
+
+        Functions are imported once per process, a modified module needs a restart.
+        """
+    function = _handlers.get(spec)
+    if function is None:
+        module, sep, name = spec.partition(':')
+        if not module or not name:
+            raise ValueError("Handler %r is not in the 'package.module:function' form"%spec)
+        try:
+            function = importlib.import_module(module)
+            for attr in name.split('.'):
+                function = getattr(function, attr)
+        except (ImportError, AttributeError) as err:
+            raise ValueError("Failed to load handler %r: %s"%(spec, err))
+        if not callable(function):
+            raise ValueError("Handler %r is not callable"%spec)
+        _handlers[spec] = function
+    return function
+
+def call_handler(spec, arg):
+    """ Call the handler `spec` with a `HandlerEvent` or a list of them, in a worker process or thread.
+        """
+    return load_handler(spec)(arg)
+
+
+class FileFilter(object):
+    """ Include/exclude rules of a job, compiled once.
+
+        Extensions are looked up in sets, for the suffixes of the file name starting
+        with a dot (as many as the dots of the longest extension), so the cost does
+        not depend on the number of extensions. Globs
+        are compiled into a single regular expression; a glob containing '/' is
+        matched against the full path, otherwise against the file name only.
+
+        Calling the filter with a pathname returns None if the file passes, or the
+        reason why it is excluded.
+        """
+    def __init__(self, include_extensions=None, exclude_extensions=None, exclude_re=None,
+                 include_glob=None, exclude_glob=None, ignore_case=True):
+        self.ignore_case = ignore_case
+        self.include_extensions = self.compileExtensions(include_extensions)
+        self.exclude_extensions = self.compileExtensions(exclude_extensions)
+        self.max_dots = max([ext.count('.') for ext in (self.include_extensions or ())] +
+                            [ext.count('.') for ext in (self.exclude_extensions or ())] + [1])
+        self.exclude_re_txt = exclude_re
+        self.exclude_re = None if not exclude_re else re.compile(exclude_re)
+        self.include_glob = self.compileGlobs(include_glob)
+        self.exclude_glob = self.compileGlobs(exclude_glob)
+
+    def compileExtensions(self, extensions):
+        if not extensions:
+            return None
+        extensions = set(ext.strip() for ext in extensions)
+        if self.ignore_case:
+            extensions = set(ext.lower() for ext in extensions)
+        return frozenset(ext if ext.startswith('.') else '.' + ext for ext in extensions if ext)
+
+    def compileGlobs(self, patterns):
+        """ Compile `patterns` into a (name regexp, path regexp) pair.
+            """
+        if not patterns:
+            return None
+        flags = re.IGNORECASE if self.ignore_case else 0
+        compiled = []
+        for patterns in ([p for p in patterns if '/' not in p], [p for p in patterns if '/' in p]):
+            compiled.append(re.compile('|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns), flags) if patterns else None)
+        return tuple(compiled)
+
+    def matchExtension(self, name, extensions):
+        i = len(name)
+        for _ in range(self.max_dots):
+            i = name.rfind('.', 0, i)
+            if i == -1:
+                return False
+            if name[i:] in extensions:
+                return True
+        return False
+
+    def matchGlob(self, pathname, name, globs):
+        return bool((globs[0] and globs[0].match(name)) or (globs[1] and globs[1].match(pathname)))
+
+    def __call__(self, pathname):
+        name = pathname[pathname.rfind('/') + 1:]
+        folded = name.lower() if self.ignore_case else name
+        if self.include_extensions is not None and not self.matchExtension(folded, self.include_extensions):
+            return "its extension is not in the included extensions"
+        if self.exclude_extensions is not None and self.matchExtension(folded, self.exclude_extensions):
+            return "its extension is in the excluded extensions"
+        if self.include_glob is not None and not self.matchGlob(pathname, name, self.include_glob):
+            return "it does not match the included globs"
+        if self.exclude_glob is not None and self.matchGlob(pathname, name, self.exclude_glob):
+            return "it matched the excluded globs"
+        if self.exclude_re is not None and self.exclude_re.search(name):
+            return "its name matched exclude regexp '%s'" % self.exclude_re_txt
+        return None
+
+
+class ContentCache(object):
+    """ Digests of the content of files, to skip the events that did not change it.
+
+        Digests are cached by (device, inode, size, mtime) in an LRU of `size`
+        entries, so a chmod or an event repeated for the same write does not read
+        the file again. Files up to `SAMPLE_THRESHOLD` bytes are hashed entirely,
+        larger ones from `SAMPLE_SIZE` bytes at their start, middle and end, and
+        their size. The digest of the last command run for a path is kept in an
+        LRU of `size` entries too: `changed` holds the digest of an event as
+        pending, and `record` keeps it once the command of the event is queued,
+        or forgets it if the command was dropped.
+        """
+    SAMPLE_THRESHOLD = 8 << 20
+    SAMPLE_SIZE      = 1 << 20
+    # events that do not run the command when the content did not change
+    CONTENT_MASK     = pyinotify.IN_ATTRIB | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE
+    # events after which the path has no content
+    FORGET_MASK      = pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+
+    def __init__(self, job, size=10000):
+        self.job     = job
+        self.size    = size
+        self.lock    = threading.Lock()
+        self.digests = collections.OrderedDict()   # (dev, ino, size, mtime) -> digest
+        self.last    = collections.OrderedDict()   # pathname -> digest of the last command run
+        self.pending = dict()                      # pathname -> digest of the command not queued yet
+        self.hits    = 0
+        self.misses  = 0
+
+    def lookup(self, cache, key):
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    def store(self, cache, key, value):
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > self.size:
+            cache.popitem(last=False)
+
+    def digest(self, pathname):
+        """ Digest of the content of `pathname`, or None if it cannot be read.
+            """
+        try:
+            with open(pathname, 'rb') as f:
+                st = os.fstat(f.fileno())
+                key = (st.st_dev, st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+                with self.lock:
+                    digest = self.lookup(self.digests, key)
+                    if digest is not None:
+                        self.hits += 1
+                        metrics.inc('watcher_dedupe_lookups_total', job=self.job, result='hit')
+                        return digest
+                    self.misses += 1
+                metrics.inc('watcher_dedupe_lookups_total', job=self.job, result='miss')
+                h = hashlib.sha1()
+                if st.st_size <= self.SAMPLE_THRESHOLD:
+                    for chunk in iter(functools.partial(f.read, self.SAMPLE_SIZE), b''):
+                        h.update(chunk)
+                else:
+                    h.update(str(st.st_size).encode('ascii'))
+                    for offset in (0, (st.st_size - self.SAMPLE_SIZE) // 2, st.st_size - self.SAMPLE_SIZE):
+                        f.seek(offset)
+                        h.update(f.read(self.SAMPLE_SIZE))
+        except (IOError, OSError):
+            return None
+        digest = h.digest()
+        with self.lock:
+            self.store(self.digests, key, digest)
+        return digest
+
+    def changed(self, event):
+        """ Whether the command should run for `event`: False for a content event
+            of a file whose content did not change since the last command run for it.
+            """
+        if event.mask & pyinotify.IN_ISDIR:
+            return True
+        if event.mask & self.FORGET_MASK or not event.mask & self.CONTENT_MASK:
+            with self.lock:
+                self.last.pop(event.pathname, None)
+                self.pending.pop(event.pathname, None)
+            return True
+        digest = self.digest(event.pathname)
+        if digest is None:
+            return True
+        with self.lock:
+            last = self.pending.get(event.pathname)
+            if last is None:
+                last = self.lookup(self.last, event.pathname)
+            unchanged = last == digest
+            if not unchanged:
+                self.pending[event.pathname] = digest
+            hits, misses = self.hits, self.misses
+        if unchanged:
+            metrics.inc('watcher_events_deduplicated_total', job=self.job)
+            logger.info("Unchanged: %s, command not run (cache: %d hits, %d misses)"%(event.pathname, hits, misses))
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Changed: %s (cache: %d hits, %d misses)"%(event.pathname, hits, misses))
+        return not unchanged
+
+    def record(self, pathnames, queued):
+        """ Keep the pending digests of `pathnames` if their command was queued, forget them otherwise.
+            """
+        with self.lock:
+            for pathname in pathnames:
+                digest = self.pending.pop(pathname, None)
+                if digest is not None and queued:
+                    self.store(self.last, pathname, digest)
+
+
+class Coprocess(object):
+    """ One instance of the command of a `CoprocessPool`. """
+    __slots__ = ('number', 'process', 'started', 'delay', 'timer', 'rest')
+
+    def __init__(self, number):
+        self.number  = number
+        self.process = None
+        self.started = 0
+        self.delay   = 0     # restart delay, doubled at each quick exit
+        self.timer   = None  # pending restart
+        self.rest    = b''   # end of a line partially written to the pipe
+
+    def fileno(self):
+        return self.process.stdin.fileno()
+
+
+class CoprocessPool(object):
+    """ Instances of the command of a job, started once and fed with one JSON line per event.
+
+        Each line goes to the next instance whose pipe has room (round-robin).
+        When all the pipes are full, lines are queued, and written by a thread
+        of the pool as the pipes get room, unless the `overflow` policy of the
+        job drops them. With 'block', `send` waits for room when `QUEUE_SIZE`
+        lines are queued, at most `BLOCK_TIMEOUT` seconds and only while an
+        instance runs, then drops the line, and the next ones until a queued
+        line is written: the thread reading the events is never held long by
+        a coprocess that is stuck or restarting. The event loop
+        cannot wait: lines sent from it are queued, and reading events is
+        paused until the pipes have room again.
+
+        An instance that exits is restarted after a delay, doubled at each exit
+        within BACKOFF_MAX seconds of its start.
+        """
+    BACKOFF_MAX = 60
+    QUEUE_SIZE = 1000
+    BLOCK_TIMEOUT = 1
+
+    def __init__(self, job, command, background, outfile, size, overflow, timers, loop=None, backpressure=None):
+        self.job          = job
+        self.command      = command
+        self.background   = background
+        self.outfile      = outfile
+        self.overflow     = overflow
+        self.timers       = timers
+        self.loop         = loop
+        self.backpressure = backpressure
+        self.instances    = [Coprocess(i) for i in range(size)]
+        self.next         = 0
+        self.cond         = threading.Condition()
+        self.queue        = collections.deque()  # lines waiting for room in the pipes
+        self.paused       = False
+        self.stalled      = False   # a blocked `send` timed out, and no queued line was written since
+        self.closed       = False
+
+    def start(self, instance=None):
+        if instance is None:
+            for instance in self.instances:
+                self.start(instance)
+            if self.loop is None:
+                thread = threading.Thread(target=self.run, name='coprocess-%s'%self.job)
+                thread.daemon = True
+                thread.start()
+            return
+        instance.timer = None
+        if self.closed:
+            return
+        metrics.inc('watcher_commands_launched_total', job=self.job)
+        try:
+            if not self.background:
+                process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE)
+            else:
+                process = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE,
+                                           stdout=self.outfile, stderr=self.outfile)
+        except OSError as err:
+            logger.info("Failed to run command '%s' %s" % (self.command, str(err)))
+            metrics.inc('watcher_commands_failed_total', job=self.job)
+            return self.restart(instance)
+        fd = process.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        with self.cond:
+            instance.started = monotonic()
+            instance.process = process
+            self.cond.notify_all()
+        logger.info("Started coprocess %d of %s, pid %d: %s" % (instance.number, self.job, process.pid, self.command))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.flush)
+
+    def restart(self, instance):
+        if instance.delay and monotonic() - instance.started < self.BACKOFF_MAX:
+            instance.delay = min(instance.delay * 2, self.BACKOFF_MAX)
+        else:
+            instance.delay = 1
+        logger.info("Restarting coprocess %d of %s in %d s" % (instance.number, self.job, instance.delay))
+        instance.timer = self.timers.call_later(instance.delay, self.start, instance)
+
+    def exited(self, instance):
+        """ Reap an instance whose pipe is closed, and restart it.
+            """
+        process, instance.process = instance.process, None
+        instance.rest = b''
+        if self.loop is not None:
+            self.loop.remove_writer(process.stdin.fileno())
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if process.poll() is None:
+            # it closed its standard input but is still running
+            process.kill()
+        returncode = process.wait()
+        metrics.observe('watcher_command_duration_seconds', monotonic() - instance.started, job=self.job)
+        metrics.inc('watcher_command_exit_codes_total', job=self.job, code=returncode)
+        metrics.inc('watcher_commands_failed_total', job=self.job)
+        logger.warning("Coprocess %d of %s exited with status %d" % (instance.number, self.job, returncode))
+        self.restart(instance)
+
+    def write(self, instance, data):
+        """ Write what the pipe of `instance` takes of `data`, return the number of bytes written.
+            """
+        try:
+            return os.write(instance.fileno(), data)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return 0
+            if err.errno != errno.EPIPE:
+                raise
+        self.exited(instance)
+        return 0
+
+    def offer(self, data):
+        """ Write `data` to the next instance with room in its pipe. Return False if there is none.
+
+            When the pipe takes only the start of `data`, the rest is written to
+            the same instance before anything else.
+            """
+        for i in range(len(self.instances)):
+            instance = self.instances[(self.next + i) % len(self.instances)]
+            if instance.process is None:
+                continue
+            if instance.rest:
+                instance.rest = instance.rest[self.write(instance, instance.rest):]
+                if instance.rest or instance.process is None:
+                    continue
+            if not data:
+                continue
+            written = self.write(instance, data)
+            if written:
+                instance.rest = data[written:]
+                self.next = (instance.number + 1) % len(self.instances)
+                return True
+        return False
+
+    def send(self, data):
+        """ Send the JSON lines `data` to one of the instances.
+
+            Return False if the lines were dropped.
+            """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.push, data)
+            return True
+        with self.cond:
+            if self.closed:
+                return False
+            if not self.queue and self.offer(data):
+                if any(instance.rest for instance in self.instances):
+                    # the thread of the pool completes the lines partially written
+                    self.cond.notify_all()
+                return True
+            if self.overflow == 'drop-oldest' and self.queue:
+                metrics.inc('watcher_commands_dropped_total', job=self.job)
+                logger.debug("%s: coprocess pipes full, dropped the oldest event" % self.job)
+                self.queue.popleft()
+            elif self.overflow == 'block':
+                deadline = monotonic() + self.BLOCK_TIMEOUT
+                while len(self.queue) >= self.QUEUE_SIZE and not self.closed and not self.stalled and self.running():
+                    wait = deadline - monotonic()
+                    if wait <= 0:
+                        logger.warning("%s: coprocess does not read its events, dropping them" % self.job)
+                        self.stalled = True
+                        break
+                    self.cond.wait(wait)
+            if self.overflow == 'drop-newest' or len(self.queue) >= self.QUEUE_SIZE or self.closed:
+                metrics.inc('watcher_commands_dropped_total', job=self.job)
+                logger.debug("%s: coprocess pipes full, dropped an event" % self.job)
+                return False
+            self.queue.append(data)
+            self.cond.notify_all()
+        return True
+
+    def running(self):
+        return [instance for instance in self.instances if instance.process is not None]
+
+    def writable(self):
+        """ Running instances with a line to write: queued, or the rest of a line partially written.
+            """
+        return [instance for instance in self.running() if self.queue or instance.rest]
+
+    def run(self):
+        """ Write the queued lines as the pipes get room, in the thread of the pool.
+            """
+        while True:
+            with self.cond:
+                while not self.closed and not self.writable():
+                    self.cond.wait()
+                if self.closed:
+                    return
+                while self.queue and self.offer(self.queue[0]):
+                    self.queue.popleft()
+                    self.stalled = False
+                self.offer(b'')
+                # room in the queue for a blocked `send`
+                self.cond.notify_all()
+                fds = [instance.fileno() for instance in self.writable()]
+            if fds:
+                try:
+                    select.select([], fds, [], 1)
+                except (select.error, OSError, ValueError):
+                    # a pipe was closed meanwhile
+                    pass
+
+    def push(self, data):
+        """ `send` from the event loop.
+            """
+        if self.closed:
+            return
+        if not self.queue and self.offer(data):
+            return self.watch()
+        if self.overflow == 'drop-newest':
+            metrics.inc('watcher_commands_dropped_total', job=self.job)
+            return
+        if self.overflow == 'drop-oldest' and self.queue:
+            metrics.inc('watcher_commands_dropped_total', job=self.job)
+            self.queue.popleft()
+        self.queue.append(data)
+        if not self.paused and self.backpressure is not None:
+            logger.debug("%s: coprocess pipes full, events are not read" % self.job)
+            self.paused = True
+            self.backpressure.pause()
+        self.watch()
+
+    def flush(self):
+        while self.queue and self.offer(self.queue[0]):
+            self.queue.popleft()
+        self.offer(b'')
+        self.watch()
+        if self.paused and not self.queue:
+            logger.debug("%s: coprocess pipes have room, events are read again" % self.job)
+            self.paused = False
+            self.backpressure.resume()
+
+    def watch(self):
+        """ Wait in the event loop for room in the pipes, while lines are pending.
+            """
+        for instance in self.instances:
+            if instance.process is None:
+                continue
+            if self.queue or instance.rest:
+                self.loop.add_writer(instance.fileno(), self.flush)
+            else:
+                self.loop.remove_writer(instance.fileno())
+
+    def close(self):
+        """ Close the pipes; the instances exit at the end of their input.
+            """
+        self.closed = True
+        for instance in self.instances:
+            if instance.timer is not None:
+                instance.timer.cancel()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.close_pipes)
+        else:
+            with self.cond:
+                self.close_pipes()
+                self.cond.notify_all()
+
+    def close_pipes(self):
+        for instance in self.instances:
+            if instance.process is None:
+                continue
+            if self.loop is not None:
+                self.loop.remove_writer(instance.fileno())
+            try:
+                instance.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.timers.call_later(1, self.reap, instance.process, monotonic() + self.BACKOFF_MAX)
+            instance.process = None
+        if self.paused:
+            self.paused = False
+            self.backpressure.resume()
+
+    def reap(self, process, deadline):
+        if process.poll() is not None:
+            return
+        if monotonic() > deadline:
+            logger.warning("Coprocess of %s did not exit, killing it" % self.job)
+            process.kill()
+        self.timers.call_later(1, self.reap, process, deadline)
+
+
+class PendingFile(object):
+    """ File held by `EventHandler.holdEvent` until it is no longer written.
+        """
+    __slots__ = ('event', 'changed', 'signature')
+
+    def __init__(self, event, changed, signature):
+        self.event     = event      # merged events of the file
+        self.changed   = changed    # time of its last write
+        self.signature = signature  # (size, mtime) at the last check
+
+
+class EventHandler(pyinotify.ProcessEvent):
+    # `TreeIndex` of the job, to recover the events lost on overflows
+    index = None
+    # `CoprocessPool` of the job, fed with the events instead of running the command
+    coprocess = None
+    # `ContentCache` of the job, to skip the events that did not change the content
+    dedupe = None
+
+    def __init__(self, job, command, include_extensions, exclude_extensions, exclude_re, background, outfile, scheduler=None,
+                 timers=None, debounce=None, batch_size=None, batch_latency=1, batch_input='args',
+                 include_glob=None, exclude_glob=None, ignore_case=True, handler=None, handler_pool='threads',
+                 pair_moves=False, move_window=0.1, run_mask=None, stable_after=0):
+        pyinotify.ProcessEvent.__init__(self)
+        self.job = job
+        self.command = command
+        self.handler = handler
+        self.handler_pool = handler_pool
+        self.filter = FileFilter(include_extensions, exclude_extensions, exclude_re, include_glob, exclude_glob, ignore_case)
+        self.background = background
+        self.outfile = outfile
+        self.scheduler = scheduler
+        self.timers = timers
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.debounced = dict() # pathname -> merged event
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.batch_input = batch_input
+        self.batch = []
+        self.batch_timer = None
+        self.deduping = collections.deque() # events whose content is read in the executor of the loop
+        self.pair_moves = pair_moves
+        self.move_window = move_window
+        self.moves = dict() # cookie -> (IN_MOVED_FROM event, timer)
+        self.run_mask = pyinotify.ALL_EVENTS if run_mask is None else run_mask
+        self.stable_after = stable_after
+        self.unstable = dict() # pathname -> PendingFile
+
+    # from http://stackoverflow.com/questions/35817/how-to-escape-os-system-calls-in-python
+    def shellquote(self, s):
+        s = str(s)
+        return "'" + s.replace("'", "'\\''") + "'"
+
+    # attributes set from the job options, see `update`
+    OPTIONS = ('command', 'handler', 'handler_pool', 'filter', 'background', 'outfile', 'debounce', 'batch_size',
+               'batch_latency', 'batch_input', 'pair_moves', 'move_window', 'run_mask', 'stable_after')
+
+    def update(self, other):
+        """ Take the options of the handler `other`, built from the new options of the job.
+
+            Pending events are kept and are run with the new options.
+            """
+        with self.lock:
+            outfile = self.outfile
+            coprocess, self.coprocess = self.coprocess, other.coprocess
+            for name in self.OPTIONS:
+                setattr(self, name, getattr(other, name))
+            if self.dedupe is not None and other.dedupe is not None:
+                self.dedupe.size = other.dedupe.size
+            else:
+                self.dedupe = other.dedupe
+            if self.index is not None and other.index is not None:
+                self.index.filter = other.filter
+                self.index.mask = other.index.mask
+                self.index.interval = other.index.interval
+                index = None
+            else:
+                index, self.index = self.index, other.index
+        if outfile:
+            outfile.close()
+        if index is not None:
+            index.close()
+        if coprocess is not None:
+            coprocess.close()
+
+    def close(self):
+        if self.coprocess is not None:
+            self.coprocess.close()
+        if self.outfile:
+            self.outfile.close()
+            logger.debug("closed %s"%self.outfile.name)
+        if self.index is not None:
+            self.index.close()
+
+    def __call__(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            metrics.inc('watcher_queue_overflows_total', job=self.job)
+            return self.process_IN_Q_OVERFLOW(event)
+        if event.mask & pyinotify.IN_IGNORED:
+            return
+        kind = event.maskname.split('|', 1)[0]
+        metrics.inc('watcher_events_received_total', job=self.job, event=kind)
+        # filter before any logging or processing
+        reason = self.filter(event.pathname)
+        if reason is not None:
+            metrics.inc('watcher_events_filtered_total', job=self.job, event=kind)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("File %s excluded because %s"%(event.pathname, reason))
+            return
+        metrics.inc('watcher_events_dispatched_total', job=self.job, event=kind)
+        if self.index is not None:
+            self.index.record(event)
+        if self.stable_after and self.holdEvent(event):
+            return
+        if not event.mask & self.run_mask and not (self.pair_moves and event.mask & self.MOVE_MASK):
+            # only watched to follow the writes or to pair the moves
+            return
+        return pyinotify.ProcessEvent.__call__(self, event)
+
+    # events of a file being written, see `holdEvent`
+    WRITE_MASK = pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE
+    # events paired by `pairMove`
+    MOVE_MASK = pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+    def holdEvent(self, event):
+        """ Hold the events of a file until it is not written for `stable_after` seconds.
+
+            The creation, modification and close events of a file start or extend
+            its quiet window; they are merged and run by `checkStable` when it ends.
+            Return True if `event` was held.
+            """
+        if event.mask & pyinotify.IN_ISDIR:
+            return False
+        with self.lock:
+            pending = self.unstable.get(event.pathname)
+            if pending is not None and event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                del self.unstable[event.pathname]
+                logger.debug("%s removed before it was written"%event.pathname)
+            elif pending is not None and event.mask & self.WRITE_MASK:
+                pending.event.mask |= event.mask & self.run_mask
+                pending.changed = monotonic()
+                return True
+            elif event.mask & self.WRITE_MASK & self.run_mask:
+                held = copy_event(event, mask=event.mask & self.run_mask, cookie=getattr(event, 'cookie', 0))
+                self.unstable[event.pathname] = PendingFile(held, monotonic(), self.signature(event.pathname))
+                logger.debug("Waiting for %s to be written"%event.pathname)
+                self.timers.call_later(self.stable_after, self.checkStable, event.pathname)
+                return True
+        return False
+
+    @staticmethod
+    def signature(pathname):
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def checkStable(self, pathname):
+        """ Run the held events of `pathname` if it was not written for `stable_after` seconds.
+
+            Its mtime, or its size and mtime since the last check when the mtime
+            is recent (e.g. set in the future by a network filesystem), are
+            checked too, for the writes without event (e.g. on a polled tree).
+            """
+        with self.lock:
+            pending = self.unstable.get(pathname)
+            if pending is None:
+                return
+            wait = pending.changed + self.stable_after - monotonic()
+        if wait <= 0:
+            signature = self.signature(pathname)
+            with self.lock:
+                if self.unstable.get(pathname) is not pending:
+                    return
+                if signature is None:
+                    del self.unstable[pathname]
+                    logger.debug("%s removed before it was written"%pathname)
+                    return
+                if signature != pending.signature and time.time() - signature[1] < self.stable_after:
+                    pending.signature = signature
+                    pending.changed = monotonic()
+                    wait = self.stable_after
+                else:
+                    del self.unstable[pathname]
+        if wait > 0:
+            self.timers.call_later(wait, self.checkStable, pathname)
+            return
+        event = pending.event
+        event.maskname = maskname(event.mask)
+        logger.info("Written: %s (%s)"%(pathname, event.maskname))
+        self.runCommand(event)
+
+    def runCommand(self, event):
+        if self.debounce:
+            self.debounceEvent(event)
+        else:
+            self.batchEvent(event)
+
+    def holdMove(self, event):
+        """ Wait `move_window` seconds for the IN_MOVED_TO event matching an IN_MOVED_FROM event.
+            """
+        with self.lock:
+            # the timer cannot flush the move before it is held
+            self.moves[event.cookie] = (event, self.timers.call_later(self.move_window, self.flushMove, event.cookie))
+
+    def pairMove(self, event):
+        """ Run the command once for an IN_MOVED_TO event and its IN_MOVED_FROM event.
+
+            The move event has both flags, and the source path in $src. Without
+            IN_MOVED_FROM event, the file came from outside the job: it is created.
+            The command only runs if the job watches the resulting event.
+            """
+        with self.lock:
+            held = self.moves.pop(event.cookie, None)
+        if held is None:
+            if self.run_mask & pyinotify.IN_CREATE:
+                logger.debug("No source for the move of %s, run as a creation"%event.pathname)
+                self.runCommand(copy_event(event, mask=(event.mask & ~pyinotify.IN_MOVED_TO) | pyinotify.IN_CREATE,
+                                           src_pathname=event.pathname))
+            return
+        held[1].cancel()
+        if self.run_mask & self.MOVE_MASK:
+            self.runCommand(copy_event(event, mask=event.mask | pyinotify.IN_MOVED_FROM, src_pathname=held[0].pathname))
+
+    def flushMove(self, cookie):
+        """ Run the command for an IN_MOVED_FROM event left without IN_MOVED_TO event, as a deletion.
+            """
+        with self.lock:
+            held = self.moves.pop(cookie, None)
+        if held is not None and self.run_mask & pyinotify.IN_DELETE:
+            event = held[0]
+            logger.debug("No destination for the move of %s, run as a deletion"%event.pathname)
+            self.runCommand(copy_event(event, mask=(event.mask & ~pyinotify.IN_MOVED_FROM) | pyinotify.IN_DELETE))
+
+    def debounceEvent(self, event):
+        """ Merge the events of a pathname during `debounce` seconds after the first one.
+            """
+        with self.lock:
+            merged = self.debounced.get(event.pathname)
+            if merged is not None:
+                merged.mask |= event.mask
+                merged.cookie = getattr(event, 'cookie', 0)
+                return
+            self.debounced[event.pathname] = copy_event(event, cookie=getattr(event, 'cookie', 0))
+        self.timers.call_later(self.debounce, self.flushDebounced, event.pathname)
+
+    def flushDebounced(self, pathname):
+        with self.lock:
+            merged = self.debounced.pop(pathname)
+        merged.maskname = maskname(merged.mask)
+        logger.debug("Debounced events for %s: %s"%(pathname, merged.maskname))
+        self.batchEvent(merged)
+
+    def batchEvent(self, event):
+        """ Accumulate events until `batch_size` of them are pending or `batch_latency` seconds passed.
+            """
+        if self.dedupe is not None:
+            if self.scheduler is not None and self.scheduler.loop is not None:
+                return self.dedupeInExecutor(event)
+            if not self.dedupe.changed(event):
+                return
+        self.collectEvent(event)
+
+    def dedupeInExecutor(self, event):
+        """ Read the content of `event` in the default executor of the loop, then batch it if it changed.
+
+            The events are read one at a time, in their order, so they are batched in that order.
+            """
+        if threading.current_thread() is not self.scheduler.thread:
+            self.scheduler.loop.call_soon_threadsafe(self.dedupeInExecutor, event)
+            return
+        self.deduping.append(event)
+        if len(self.deduping) == 1:
+            self.dedupeNext()
+
+    def dedupeNext(self):
+        future = self.scheduler.loop.run_in_executor(None, self.dedupe.changed, self.deduping[0])
+        future.add_done_callback(self.dedupeDone)
+
+    def dedupeDone(self, future):
+        event = self.deduping.popleft()
+        try:
+            changed = future.result()
+        except Exception:
+            logger.exception("%s: cannot read %s"%(self.job, event.pathname))
+            changed = True
+        if changed:
+            self.collectEvent(event)
+        if self.deduping:
+            self.dedupeNext()
+
+    def collectEvent(self, event):
+        if not self.batch_size:
+            return self.dispatch(event)
+        with self.lock:
+            self.batch.append(event)
+            if len(self.batch) < self.batch_size:
+                if self.batch_timer is None:
+                    self.batch_timer = self.timers.call_later(self.batch_latency, self.flushBatch)
+                return
+            events = self.takeBatch()
+        self.dispatchBatch(events)
+
+    def takeBatch(self):
+        events, self.batch = self.batch, []
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        return events
+
+    def flushBatch(self):
+        with self.lock:
+            events = self.takeBatch()
+        if events:
+            self.dispatchBatch(events)
+
+    def substitute(self, event, filenames=None):
+        """ Expand the command template for `event`.
+            """
+        t = string.Template(self.command)
+        return t.substitute(job=self.shellquote(self.job),
+                            watched=self.shellquote(event.path),
+                            filename=self.shellquote(event.pathname),
+                            filenames=self.shellquote(event.pathname) if filenames is None else filenames,
+                            tflags=self.shellquote(event.maskname),
+                            nflags=self.shellquote(event.mask),
+                            cookie=self.shellquote(event.cookie if hasattr(event, "cookie") else 0),
+                            src=self.shellquote(getattr(event, 'src_pathname', event.pathname)),
+                            dest=self.shellquote(event.pathname))
+
+    def dispatch(self, event):
+        """ Run the command for an event that passed the filters. Return False if it was dropped.
+            """
+        if self.handler:
+            queued = self.submitHandler(self.handlerEvent(event))
+        elif self.coprocess is not None:
+            queued = self.coprocess.send(self.jsonLine(event))
+        else:
+            queued = self.submit(self.substitute(event))
+        if self.dedupe is not None:
+            self.dedupe.record([event.pathname], queued)
+        return queued
+
+    def dispatchBatch(self, events):
+        """ Run the command once for a batch of events.
+
+            The other variables than $filenames refer to the first event of the batch.
+            A python handler gets the list of events.
+            """
+        logger.debug("%s: batch of %d events"%(self.job, len(events)))
+        pathnames = [event.pathname for event in events]
+        if self.handler:
+            queued = self.submitHandler([self.handlerEvent(event) for event in events])
+        elif self.coprocess is not None:
+            queued = self.coprocess.send(b''.join(self.jsonLine(event) for event in events))
+        elif self.batch_input == 'args':
+            queued = all([self.submit(self.substitute(events[0], ' '.join(chunk)))
+                          for chunk in self.splitArgs(events[0], [self.shellquote(p) for p in pathnames])])
+        else:
+            sep = '\0' if self.batch_input == 'null' else '\n'
+            data = ''.join(p + sep for p in pathnames)
+            queued = self.submit(self.substitute(events[0], ''), fsencode(data))
+        if self.dedupe is not None:
+            self.dedupe.record(pathnames, queued)
+        return queued
+
+    def splitArgs(self, event, args):
+        """ Split `args` into chunks that fit on the command line of `event`.
+
+            A shell command is a single argument, limited to MAX_ARG_STRLEN on Linux,
+            the whole command line is limited to ARG_MAX (minus the environment).
+            """
+        limit = ARG_MAX // 2
+        if not self.background:
+            limit = min(limit, MAX_ARG_STRLEN)
+        limit -= len(fsencode(self.substitute(event, '')))
+        chunk, size = [], 0
+        for arg in args:
+            arg_size = len(fsencode(arg)) + 1
+            if chunk and size + arg_size > limit:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(arg)
+            size += arg_size
+        if chunk:
+            yield chunk
+
+    def submit(self, command, data=None):
+        """ Queue `command`, or run it without scheduler. Return False if it was dropped or failed.
+            """
+        if self.scheduler is None:
+            return self.execute(command, data) == 0
+        elif self.scheduler.loop is not None:
+            return self.scheduler.submit(self.job, functools.partial(self.spawn, command, data))
+        else:
+            return self.scheduler.submit(self.job, functools.partial(self.execute, command, data))
+
+    def execute(self, command, data=None):
+        """ Run `command` and wait for it to exit. Return its exit status.
+
+            If `data` is given, it is written to the standard input of the command.
+            """
+        stdin = None if data is None else subprocess.PIPE
+        metrics.inc('watcher_commands_launched_total', job=self.job)
+        start = monotonic()
+        try:
+            if not self.background:
+                # shell exec
+                process = subprocess.Popen(command, shell=True, stdin=stdin)
+                #print "Run command print: %s" % (command)
+                logger.info("Run command log: %s" % (command))
+            else:
+                logger.info("Executing child: \"%s\""%command)
+                args = shlex.split(command)
+                # exec with output redirected
+                process = subprocess.Popen(args, stdin=stdin, stdout=self.outfile, stderr=self.outfile)
+            process.communicate(data)
+        except OSError as err:
+            return self.commandFailed(command, err)
+        return self.commandExited(command, process.returncode, start)
+
+    def spawn(self, command, data=None):
+        """ Start `command` on the event loop of the scheduler, like `execute`.
+
+            Return a future of its exit status.
+            """
+        loop = self.scheduler.loop
+        stdin = None if data is None else subprocess.PIPE
+        metrics.inc('watcher_commands_launched_total', job=self.job)
+        start = monotonic()
+        if not self.background:
+            logger.info("Run command log: %s" % (command))
+            coro = asyncio.create_subprocess_shell(command, stdin=stdin)
+        else:
+            logger.info("Executing child: \"%s\""%command)
+            coro = asyncio.create_subprocess_exec(*shlex.split(command), stdin=stdin, stdout=self.outfile, stderr=self.outfile)
+        result = loop.create_future()
+
+        def started(future):
+            try:
+                process = future.result()
+            except OSError as err:
+                return result.set_result(self.commandFailed(command, err))
+            asyncio.ensure_future(process.communicate(data), loop=loop).add_done_callback(
+                functools.partial(exited, process))
+
+        def exited(process, future):
+            if future.exception() is not None:
+                result.set_result(self.commandFailed(command, future.exception()))
+            else:
+                result.set_result(self.commandExited(command, process.returncode, start))
+        asyncio.ensure_future(coro, loop=loop).add_done_callback(started)
+        return result
+
+    def jsonLine(self, event):
+        """ Line written to the coprocess for `event`.
+            """
+        return (json.dumps(dict(job=self.job, watched=event.path, filename=event.pathname, tflags=event.maskname,
+                                nflags=event.mask, cookie=getattr(event, 'cookie', 0), timestamp=time.time(),
+                                src=getattr(event, 'src_pathname', event.pathname)),
+                           sort_keys=True) + '\n').encode('utf-8')
+
+    def handlerEvent(self, event):
+        return HandlerEvent(self.job, event.path, event.pathname, event.mask, event.maskname,
+                            getattr(event, 'cookie', 0), getattr(event, 'src_pathname', event.pathname))
+
+    def submitHandler(self, arg):
+        """ Queue a call of the python handler, with the limits of the commands of the job.
+            """
+        call = functools.partial(self.callHandler, self.handler, self.handler_pool, arg)
+        if self.scheduler is None:
+            call()
+            return True
+        elif self.scheduler.loop is not None:
+            # handlers block, they run in the default executor of the loop
+            return self.scheduler.submit(self.job, functools.partial(self.scheduler.loop.run_in_executor, None, call))
+        else:
+            return self.scheduler.submit(self.job, call)
+
+    def callHandler(self, handler, pool, arg):
+        """ Call the python `handler` with `arg`, in this thread or in the process pool of the scheduler.
+
+            Exceptions are logged, with their traceback.
+            """
+        metrics.inc('watcher_commands_launched_total', job=self.job)
+        start = monotonic()
+        logger.info("Run handler %s for %s" % (handler, arg.pathname if isinstance(arg, HandlerEvent)
+                                               else '%d events'%len(arg)))
+        try:
+            if pool == 'processes':
+                result = self.scheduler.process_pool().apply_async(call_handler, (handler, arg)).get()
+            else:
+                result = call_handler(handler, arg)
+        except Exception:
+            logger.exception("Handler %s failed" % handler)
+            metrics.inc('watcher_commands_failed_total', job=self.job)
+            result = None
+        metrics.observe('watcher_command_duration_seconds', monotonic() - start, job=self.job)
+        return result
+
+    def commandFailed(self, command, err):
+        #print "Failed to run command '%s' %s" % (command, str(err))
+        logger.info("Failed to run command '%s' %s" % (command, str(err)))
+        metrics.inc('watcher_commands_failed_total', job=self.job)
+        return None
+
+    def commandExited(self, command, returncode, start):
+        metrics.observe('watcher_command_duration_seconds', monotonic() - start, job=self.job)
+        metrics.inc('watcher_command_exit_codes_total', job=self.job, code=returncode)
+        if returncode != 0:
+            metrics.inc('watcher_commands_failed_total', job=self.job)
+            logger.warning("Command '%s' exited with status %d" % (command, returncode))
+        return returncode
+
+    def process_IN_Q_OVERFLOW(self, event):
+        if self.index is None:
+            logger.warning("%s: event queue overflowed, events were lost"%self.job)
+            return
+        logger.warning("%s: event queue overflowed, rescanning the tree"%self.job)
+        self.index.request(self, self.timers)
+
+    def process_IN_ACCESS(self, event):
+        #print "Access: %s"%(event.pathname)
+        logger.info("Access: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_ATTRIB(self, event):
+        #print "Attrib: %s"%(event.pathname)
+        logger.info("Attrib: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        #print "Close write: %s"%(event.pathname)
+        logger.info("Close write: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_CLOSE_NOWRITE(self, event):
+        #print "Close nowrite: %s"%(event.pathname)
+        logger.info("Close nowrite: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_CREATE(self, event):
+        #print "Creating: %s"%(event.pathname)
+        logger.info("Creating: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_DELETE(self, event):
+        #print "Deleting: %s"%(event.pathname)
+        logger.info("Deleting: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_MODIFY(self, event):
+        #print "Modify: %s"%(event.pathname)
+        logger.info("Modify: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_MOVE_SELF(self, event):
+        #print "Move self: %s"%(event.pathname)
+        logger.info("Move self: %s"%(event.pathname))
+        self.runCommand(event)
+
+    def process_IN_MOVED_FROM(self, event):
+        #print "Moved from: %s"%(event.pathname)
+        logger.info("Moved from: %s"%(event.pathname))
+        if self.pair_moves:
+            return self.holdMove(event)
+        self.runCommand(event)
+
+    def process_IN_MOVED_TO(self, event):
+        #print "Moved to: %s"%(event.pathname)
+        logger.info("Moved to: %s"%(event.pathname))
+        if self.pair_moves:
+            return self.pairMove(event)
+        self.runCommand(event)
+
+    def process_IN_OPEN(self, event):
+        #print "Opened: %s"%(event.pathname)
+        logger.info("Opened: %s"%(event.pathname))
+        self.runCommand(event)
+
+def get_option(config, section, option, default=None, convert=None):
+    """ Return the value of `option` in `section`, or `default` if it is missing or blank.
+
+        If given, `convert` is applied to the non-blank value.
+        """
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option).strip()
+    if value == '':
+        return default
+    if convert is not None:
+        return convert(value)
+    return value
+
+def to_bool(value):
+    """ Convert a config string to a boolean, like `ConfigParser.getboolean`. """
+    value = value.lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError('Not a boolean: %r' % value)
+
+def split_list(value):
+    """ Split a comma separated config value, dropping blank items. """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def parse_job(config, section):
+    """ Read the options of the job `section` into a dict.
+        """
+    job = dict(name=section)
+    job['mask']      = parseMask(config.get(section,'events').split(','))
+    job['folder']    = os.path.normpath(config.get(section,'watch'))
+    job['recursive'] = config.getboolean(section,'recursive')
+    job['autoadd']   = config.getboolean(section,'autoadd')
+    job['excluded']  = PathTrie(split_list(config.get(section,'excluded')))
+    job['include_extensions'] = None if '' in config.get(section,'include_extensions').split(',') else set(config.get(section,'include_extensions').split(','))
+    job['exclude_extensions'] = None if '' in config.get(section,'exclude_extensions').split(',') else set(config.get(section,'exclude_extensions').split(','))
+    job['exclude_re'] = None if not config.get(section,'exclude_re') else config.get(section,'exclude_re')
+    job['include_glob'] = get_option(config, section, 'include_glob', None, split_list)
+    job['exclude_glob'] = get_option(config, section, 'exclude_glob', None, split_list)
+    job['ignore_case'] = get_option(config, section, 'ignore_case', True, to_bool)
+    job['command']   = get_option(config, section, 'command')
+    job['handler']   = get_option(config, section, 'handler')
+    if job['handler'] is not None:
+        # fail on reload rather than on the first event
+        load_handler(job['handler'])
+    elif job['command'] is None:
+        raise ValueError("No command nor handler for %s"%section)
+    job['handler_pool'] = get_option(config, section, 'handler_pool', 'threads')
+    job['coprocess'] = get_option(config, section, 'coprocess', False, to_bool)
+    job['coprocess_instances'] = get_option(config, section, 'coprocess_instances', 1, int)
+    if job['coprocess'] and job['handler'] is not None:
+        raise ValueError("%s has both a handler and a coprocess"%section)
+    if job['handler_pool'] not in ('threads', 'processes'):
+        raise ValueError("Unknown handler_pool %r for %s"%(job['handler_pool'], section))
+    job['background']= config.getboolean(section,'background')
+    job['max_concurrency'] = get_option(config, section, 'max_concurrency', None, int)
+    job['overflow']  = get_option(config, section, 'overflow', 'block')
+    job['rate_limit'] = get_option(config, section, 'rate_limit', None, float)
+    job['rate_burst'] = get_option(config, section, 'rate_burst', 1, int)
+    if job['rate_limit'] is not None and job['rate_limit'] <= 0 or job['rate_burst'] < 1:
+        raise ValueError("rate_limit and rate_burst of %s must be positive"%section)
+    job['priority']  = get_option(config, section, 'priority', 0, int)
+    job['weight']    = get_option(config, section, 'weight', 1, float)
+    if job['weight'] <= 0:
+        raise ValueError("weight of %s must be positive"%section)
+    job['debounce']  = get_option(config, section, 'debounce_ms', 0, int) / 1000
+    job['batch_size'] = get_option(config, section, 'batch_size', 0, int)
+    job['batch_latency'] = get_option(config, section, 'batch_latency_ms', 1000, int) / 1000
+    job['batch_input'] = get_option(config, section, 'batch_input', 'args')
+    job['pair_moves'] = get_option(config, section, 'pair_moves', False, to_bool)
+    job['move_window'] = get_option(config, section, 'move_window_ms', 100, int) / 1000
+    # events that run the command; `mask` is widened with the events only watched
+    job['run_mask']  = job['mask']
+    if job['pair_moves']:
+        # both halves are needed to pair them
+        job['mask'] |= EventHandler.MOVE_MASK
+    job['dedupe']    = get_option(config, section, 'dedupe', 'none')
+    if job['dedupe'] not in ('none', 'content'):
+        raise ValueError("Unknown dedupe %r for %s"%(job['dedupe'], section))
+    job['dedupe_cache_size'] = get_option(config, section, 'dedupe_cache_size', 10000, int)
+    job['stable_after'] = get_option(config, section, 'stable_after_ms', 0, int) / 1000
+    if job['stable_after']:
+        # writes delay the command, they do not run it
+        job['mask'] |= pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE
+    job['reconcile'] = get_option(config, section, 'reconcile', False, to_bool)
+    job['reconcile_interval'] = get_option(config, section, 'reconcile_interval', 60, float)
+    job['backend']   = get_option(config, section, 'backend', 'auto')
+    if job['backend'] not in ('auto', 'inotify', 'poll'):
+        raise ValueError("Unknown backend %r for %s"%(job['backend'], section))
+    job['poll_interval'] = get_option(config, section, 'poll_interval', 10, float)
+    job['state_file'] = get_option(config, section, 'state_file', None, lambda value: string.Template(value).substitute(job=section))
+    if job['batch_input'] not in ('args', 'lines', 'null'):
+        raise ValueError("Unknown batch_input %r for %s"%(job['batch_input'], section))
+    t = string.Template(config.get(section, 'outfile'))
+    job['outfile']   = t.substitute(job=section)
+
+    # parse include_extensions
+    if job['include_extensions'] and 'video' in job['include_extensions']:
+        job['include_extensions'].discard('video')
+        job['include_extensions'] |= set(VIDEO_EXTENSIONS)
+    return job
+
+def make_handler(job, scheduler, timers):
+    """ Build the `EventHandler` of a job parsed by `parse_job`, and register it to `scheduler`.
+
+        Without `max_concurrency`, a job runs one command at a time, or as many as
+        there are workers with `background`.
+        """
+    outfile_h = open(job['outfile'], 'a+b', buffering=0) if job['outfile'] else None
+    logger.debug("outfile = '%s'"%job['outfile'])
+    max_concurrency = job['max_concurrency']
+    if max_concurrency is None:
+        max_concurrency = scheduler.max_workers if job['background'] else 1
+    scheduler.add_job(job['name'], max_concurrency, job['overflow'], job['rate_limit'], job['rate_burst'],
+                      job['priority'], job['weight'])
+    handler = EventHandler(job['name'], job['command'], job['include_extensions'], job['exclude_extensions'],
+                           job['exclude_re'], job['background'], outfile_h, scheduler,
+                           timers, job['debounce'], job['batch_size'], job['batch_latency'], job['batch_input'],
+                           job['include_glob'], job['exclude_glob'], job['ignore_case'],
+                           job['handler'], job['handler_pool'], job['pair_moves'], job['move_window'],
+                           job['run_mask'], job['stable_after'])
+    if job['coprocess']:
+        command = string.Template(job['command']).safe_substitute(job=handler.shellquote(job['name']))
+        handler.coprocess = CoprocessPool(job['name'], command, job['background'], outfile_h,
+                                          job['coprocess_instances'], job['overflow'], timers,
+                                          scheduler.loop, getattr(scheduler, 'backpressure', None))
+        handler.coprocess.start()
+    if job['dedupe'] == 'content':
+        handler.dedupe = ContentCache(job['name'], job['dedupe_cache_size'])
+    if job['reconcile'] or job['state_file']:
+        # the state file is only valid for the files selected by these options
+        key = repr([job[option] if not isinstance(job[option], (set, PathTrie)) else sorted(getattr(job[option], 'paths', job[option]))
+                    for option in ('folder', 'recursive', 'excluded', 'include_extensions', 'exclude_extensions',
+                                   'exclude_re', 'include_glob', 'exclude_glob', 'ignore_case')])
+        handler.index = TreeIndex(job['folder'], job['recursive'], job['excluded'], handler.filter,
+                                  job['mask'], job['reconcile_interval'], state_file=job['state_file'],
+                                  key=hashlib.sha1(key.encode('utf-8')).hexdigest())
+    return handler
+
+class PathTrie(object):
+    """ Set of directories, stored as a tree of path components.
+
+        `path in trie` is True if `path` is one of the directories or is under one
+        of them; it costs one dict lookup per component of `path`. A trie is also
+        a valid pyinotify `exclude_filter`.
+        """
+    def __init__(self, paths=()):
+        self.paths = frozenset(os.path.normpath(path) for path in paths)
+        self.root = dict()
+        for path in self.paths:
+            node = self.root
+            for part in self.split(path):
+                node = node.setdefault(part, dict())
+            node[None] = True   # end of a path
+
+    @staticmethod
+    def split(path):
+        return [part for part in os.path.normpath(path).split(os.sep) if part]
+
+    def __contains__(self, path):
+        node = self.root
+        if None in node:
+            return True
+        for part in self.split(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    __call__ = __contains__
+
+    def __bool__(self):
+        return bool(self.paths)
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return isinstance(other, PathTrie) and self.paths == other.paths
+
+    def __ne__(self, other):
+        return not self == other
+
+def walk_tree(top, excluded):
+    """ Like `os.walk(top)`, but never descends into the `excluded` directories.
+        """
+    if top in excluded:
+        logger.debug("Excluded dir : " + top)
+        return
+    for root, dirs, files in os.walk(top):
+        kept = []
+        for d in dirs:
+            if os.path.join(root, d) in excluded:
+                logger.debug("Excluded dir : " + os.path.join(root, d))
+            else:
+                kept.append(d)
+        dirs[:] = kept
+        yield root, dirs, files
+
+
+class TreeScanner(object):
+    """ Walk a directory tree breadth first with `os.scandir`, on several threads.
+
+        `visit(path)` is called once for every directory, before it is listed, from
+        any of the threads; the directory is not descended if it returns False.
+        Symlinks and `excluded` directories are not descended either. The progress
+        is logged every `log_interval` seconds.
+        """
+    def __init__(self, top, excluded, visit, threads=1, name='', log_interval=5):
+        self.top          = top
+        self.excluded     = excluded
+        self.visit        = visit
+        self.threads      = max(1, threads)
+        self.name         = name
+        self.log_interval = log_interval
+        self.cond         = threading.Condition()
+        self.queue        = collections.deque()
+        self.busy         = 0
+        self.count        = 0
+
+    def listdirs(self, path):
+        """ Subdirectories of `path` that are not symlinks nor excluded.
+            """
+        try:
+            if scandir is not None:
+                it = scandir(path)
+                try:
+                    dirs = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+                finally:
+                    if hasattr(it, 'close'):
+                        it.close()
+            else:
+                dirs = [os.path.join(path, d) for d in os.listdir(path)]
+                dirs = [d for d in dirs if os.path.isdir(d) and not os.path.islink(d)]
+        except OSError as err:
+            logger.debug("Cannot list %s: %s"%(path, err))
+            return []
+        kept = []
+        for d in dirs:
+            if d in self.excluded:
+                logger.debug("Excluded dir : " + d)
+            else:
+                kept.append(d)
+        return kept
+
+    def progress(self, final=False):
+        elapsed = monotonic() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0
+        if final:
+            logger.info("%s: startup scan finished, %d directories in %.1fs (%.0f dirs/s)"%(self.name, self.count, elapsed, rate))
+        else:
+            logger.info("%s: startup scan, %d directories in %.1fs (%.0f dirs/s), %d pending"%(self.name, self.count, elapsed, rate, len(self.queue)))
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.queue and self.busy:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                path = self.queue.popleft()
+                self.busy += 1
+            subdirs = []
+            try:
+                if self.visit(path):
+                    subdirs = self.listdirs(path)
+            except Exception:
+                logger.exception("%s: failed to scan %s"%(self.name, path))
+            finally:
+                with self.cond:
+                    self.queue.extend(subdirs)
+                    self.busy -= 1
+                    self.count += 1
+                    if monotonic() >= self.next_log:
+                        self.next_log += self.log_interval
+                        self.progress()
+                    self.cond.notify_all()
+
+    def run(self):
+        """ Scan the tree and return the number of directories visited.
+            """
+        self.start = monotonic()
+        self.next_log = self.start + self.log_interval
+        if self.top in self.excluded:
+            logger.debug("Excluded dir : " + self.top)
+            return 0
+        self.queue.append(self.top)
+        workers = [threading.Thread(target=self.worker, name='scan-%d'%i) for i in range(self.threads - 1)]
+        for worker in workers:
+            worker.start()
+        self.worker()
+        for worker in workers:
+            worker.join()
+        self.progress(final=True)
+        return self.count
+
+def is_tree(job):
+    """ True if the watch of `job` is a directory to be scanned recursively.
+        """
+    return job['recursive'] and os.path.isdir(job['folder']) and not os.path.islink(job['folder'])
+
+
+class TreeIndex(object):
+    """ (mtime, size, inode) of the files and directories of a job that pass its filter.
+
+        The index is kept up to date by the events of the job: `record` queues
+        their paths, and the thread of the index stats them (see `update`), so
+        that the notifier does not wait for the disk. When the event queue
+        overflows, `reconcile` scans the tree again, and the differences with the
+        index are sent to the job handler as the events that were lost.
+        Reconciliations are at least `interval` seconds apart.
+
+        The paths are the nodes of a `CompactPaths` tree, and their entry is kept
+        in arrays indexed by node, with the (mtime, inode) of the directories when
+        they were last listed.
+
+        With a `state_file`, the index is also saved in a SQLite database, and the
+        changes made while the daemon was stopped are sent at startup by `build`.
+        The database is only valid for the job options hashed in `key`.
+        """
+    # events synthesized for a change, the first one of the job mask is used
+    EVENTS = {
+        'created':  (pyinotify.IN_CREATE, pyinotify.IN_MOVED_TO, pyinotify.IN_CLOSE_WRITE),
+        'modified': (pyinotify.IN_MODIFY, pyinotify.IN_CLOSE_WRITE),
+        'deleted':  (pyinotify.IN_DELETE, pyinotify.IN_MOVED_FROM),
+    }
+    # the files of a directory whose mtime did not change are stat'ed again only for these events
+    MODIFY_MASK = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB
+    # seconds between the writes of the recorded changes to the state file
+    FLUSH_INTERVAL = 5
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, inode INTEGER, isdir INTEGER)',
+              'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, inode INTEGER)',
+              'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    # flags of a node: it has an entry, which is a directory, or it was listed
+    ENTRY, ISDIR, LISTED = 1, 2, 4
+
+    def __init__(self, top, recursive, excluded, filter, mask, interval=60, watch_dir=None, state_file=None, key=''):
+        self.top       = top
+        self.recursive = recursive
+        self.excluded  = excluded
+        self.filter    = filter
+        self.mask      = mask
+        self.interval  = interval
+        self.watch_dir = watch_dir  # called with the new directories found by a reconciliation
+        self.state_file = state_file
+        self.key       = key
+        # per node
+        self.mtimes    = array.array('d')
+        self.sizes     = array.array('l')
+        self.inodes    = array.array('L')
+        self.flags     = array.array('B')
+        self.listed_mtimes = array.array('d')   # of a directory when it was last listed
+        self.listed_inodes = array.array('L')
+        self.paths     = CompactPaths((self.mtimes, 0), (self.sizes, 0), (self.inodes, 0), (self.flags, 0),
+                                      (self.listed_mtimes, 0), (self.listed_inodes, 0))
+        self.count     = 0          # paths with an entry
+        self.dirty     = set()      # paths changed since the last write to the state file
+        self.lock      = threading.Lock()
+        self.scanning  = threading.Lock()
+        # paths recorded by the events, to update
+        self.queue     = collections.OrderedDict()
+        self.recent    = None       # paths recorded while scanning
+        self.cond      = threading.Condition()
+        self.worker    = None
+        self.closed    = False
+        self.db        = None
+        self.flush_timer = None
+        self.last      = None       # start of the last reconciliation
+        self.scheduled = False
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino, stat.S_ISDIR(st.st_mode))
+
+    def listdir(self, path):
+        """ (path, isdir) of the entries of the directory `path`.
+            """
+        try:
+            if scandir is not None:
+                it = scandir(path)
+                try:
+                    return [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in it]
+                finally:
+                    if hasattr(it, 'close'):
+                        it.close()
+            return [(p, os.path.isdir(p) and not os.path.islink(p)) for p in (os.path.join(path, name) for name in os.listdir(path))]
+        except OSError as err:
+            logger.debug("Cannot list %s: %s"%(path, err))
+            return []
+
+    # nodes, with the lock held
+
+    def entry(self, node):
+        """ (mtime, size, inode, isdir) of `node`, or None.
+            """
+        if node == -1 or not self.flags[node] & self.ENTRY:
+            return None
+        return (self.mtimes[node], self.sizes[node], self.inodes[node], bool(self.flags[node] & self.ISDIR))
+
+    def isdir(self, node):
+        return bool(self.flags[node] & (self.ISDIR | self.LISTED)) or self.paths.first_child[node] != -1
+
+    def hold(self, node, flag):
+        """ Set `flag` on `node`, which is kept while it has an entry or was listed.
+            """
+        if not self.flags[node] & (self.ENTRY | self.LISTED):
+            self.paths.refs[node] += 1
+        self.flags[node] |= flag
+
+    def drop(self, node, flags):
+        """ Clear `flags` on `node`, which is freed when it is no longer used.
+            """
+        held = self.flags[node] & (self.ENTRY | self.LISTED)
+        if self.flags[node] & flags & self.ENTRY:
+            self.count -= 1
+        self.flags[node] &= ~flags
+        if held and not self.flags[node] & (self.ENTRY | self.LISTED):
+            self.paths.refs[node] -= 1
+            self.paths.release(node)
+
+    def recorded(self, path):
+        recent = self.recent
+        return recent is not None and path in recent
+
+    def set_entry(self, node, path, entry, changes=None):
+        """ Set the entry of `node`, and append the change to `changes`.
+
+            A path whose inode changed was deleted then created. A directory
+            replaced by a file loses its content.
+            """
+        old = self.entry(node)
+        if old == entry:
+            return
+        if old is not None and old[3] and not entry[3]:
+            for child in list(self.paths.child_nodes(node)):
+                self.remove(child, changes)
+            self.drop(node, self.LISTED)
+        if changes is not None:
+            if old is None:
+                changes.append(('created', path, entry[3]))
+            elif old[2] != entry[2] or old[3] != entry[3]:
+                changes.append(('deleted', path, old[3]))
+                changes.append(('created', path, entry[3]))
+            elif not entry[3]:
+                changes.append(('modified', path, False))
+        if old is None:
+            self.count += 1
+        self.hold(node, self.ENTRY | (self.ISDIR if entry[3] else 0))
+        if not entry[3]:
+            self.flags[node] &= ~self.ISDIR
+        self.mtimes[node], self.sizes[node], self.inodes[node] = entry[:3]
+        if self.db is not None:
+            self.dirty.add(path)
+
+    def remove_entry(self, node, path, changes=None):
+        if not self.flags[node] & self.ENTRY:
+            return
+        if changes is not None:
+            changes.append(('deleted', path, bool(self.flags[node] & self.ISDIR)))
+        if self.db is not None:
+            self.dirty.add(path)
+        self.drop(node, self.ENTRY | self.ISDIR)
+
+    def remove(self, node, changes=None):
+        """ Remove `node` and the nodes under it, and append their deletion to `changes`.
+
+            The paths recorded during a scan are not reported, the thread of the
+            index updates them after it.
+            """
+        for child in list(self.paths.subtree(node)):
+            if self.flags[child] & self.ENTRY:
+                self.count -= 1
+                if changes is not None or self.db is not None:
+                    path = self.paths.path(child)
+                    if changes is not None and not self.recorded(path):
+                        changes.append(('deleted', path, bool(self.flags[child] & self.ISDIR)))
+                    if self.db is not None:
+                        self.dirty.add(path)
+        self.paths.remove(node)
+
+    # scans
+
+    def walk(self, top, changes=None):
+        """ Index the tree under the directory `top`, and append the changes found to `changes`.
+
+            A directory whose mtime and inode did not change since it was listed is
+            not listed again: its indexed content is stat'ed again, its files only
+            if the job watches modifications. The disk is read without the lock,
+            which is taken for each directory to update its content.
+            """
+        start = time.time()
+        restat = self.mask & self.MODIFY_MASK
+        stack = [(top, self.stat(top))]
+        while stack:
+            (path, st) = stack.pop()
+            if st is None or not st[3]:
+                continue
+            with self.lock:
+                node = self.paths.lookup(path)
+                known = None
+                if node != -1 and self.flags[node] & self.LISTED and \
+                   (self.listed_mtimes[node], self.listed_inodes[node]) == (st[0], st[2]):
+                    # no entry was added, removed or renamed in the directory since it was listed
+                    known = [(os.path.join(path, self.paths.name(child)), self.isdir(child))
+                             for child in self.paths.child_nodes(node)]
+            children = self.listdir(path) if known is None else known
+            found = []
+            for (child, isdir) in children:
+                if isdir and self.recursive and child in self.excluded:
+                    logger.debug("Excluded dir : " + child)
+                elif isdir or known is None or restat:
+                    found.append((child, self.stat(child)))
+                else:
+                    found.append((child, True))
+            subdirs = []
+            with self.lock:
+                node = self.paths.lookup(path, True)
+                self.paths.refs[node] += 1
+                present = set()
+                for (child, entry) in found:
+                    if entry is None:
+                        continue
+                    name = os.path.basename(child)
+                    present.add(name)
+                    if entry is True:
+                        continue
+                    if entry[3] and self.recursive:
+                        subdirs.append((child, entry))
+                    if self.recorded(child):
+                        continue
+                    sub = self.paths.child(node, name)
+                    if self.filter(child) is None:
+                        if sub == -1:
+                            sub = self.paths.add_node(node, self.paths.intern(name))
+                        self.set_entry(sub, child, entry, changes)
+                    elif sub != -1:
+                        self.remove_entry(sub, child, changes)
+                for sub in [sub for sub in self.paths.child_nodes(node) if self.paths.name(sub) not in present]:
+                    self.remove(sub, changes)
+                if known is None:
+                    # a directory changed within the mtime resolution may change again unnoticed: list it next time
+                    self.hold(node, self.LISTED)
+                    self.listed_mtimes[node] = st[0] if st[0] < start - 1 else -1
+                    self.listed_inodes[node] = st[2]
+                self.paths.refs[node] -= 1
+                self.paths.release(node)
+            stack.extend(subdirs)
+
+    def rescan(self, report=True):
+        """ Scan the tree and update the index. Return the changes found, as
+            (change, path, isdir) tuples, or None without `report`.
+
+            The paths recorded during the scan keep their recorded entry and are
+            not reported; they are updated again after the scan.
+            """
+        with self.cond:
+            self.recent = set()
+        changes = [] if report else None
+        st = self.stat(self.top)
+        if st is not None and st[3] and not (self.recursive and self.top in self.excluded):
+            with self.lock:
+                node = self.paths.lookup(self.top)
+                if node != -1:
+                    self.remove_entry(node, self.top, changes)
+            self.walk(self.top, changes)
+        else:
+            if st is not None and st[3]:
+                logger.debug("Excluded dir : " + self.top)
+            with self.lock:
+                node = self.paths.lookup(self.top, st is not None)
+                if node != -1:
+                    self.paths.refs[node] += 1
+                    for child in list(self.paths.child_nodes(node)):
+                        self.remove(child, changes)
+                    self.drop(node, self.LISTED)
+                    if st is not None and not st[3] and self.filter(self.top) is None:
+                        self.set_entry(node, self.top, st, changes)
+                    else:
+                        self.remove_entry(node, self.top, changes)
+                    self.paths.refs[node] -= 1
+                    self.paths.release(node)
+        with self.cond:
+            recent, self.recent = self.recent, None
+            if recent and not self.closed:
+                self.queue.update((path, None) for path in recent)
+                self.wake()
+        if changes is None:
+            return None
+        return (sorted((c for c in changes if c[0] == 'deleted'), key=lambda c: c[1], reverse=True) +
+                sorted((c for c in changes if c[0] == 'created'), key=lambda c: c[1]) +
+                sorted((c for c in changes if c[0] == 'modified'), key=lambda c: c[1]))
+
+    def build(self, handler):
+        """ Index the tree, and send the changes made since the state file was saved to `handler`.
+            """
+        start = monotonic()
+        with self.scanning:
+            loaded = self.open() if self.state_file else False
+            changes = self.rescan(report=loaded)
+            if self.db is not None:
+                self.save_dirs()
+        self.flush(handler.timers)
+        logger.info("%s: indexed %d paths in %.1fs"%(handler.job, self.count, monotonic() - start))
+        if loaded:
+            self.send(handler, changes, 'changes since the last run')
+
+    def open(self):
+        """ Open the state file, and load the index and directories it holds.
+
+            Return False if the state file is new, or was saved with other options.
+            """
+        if sqlite3 is None:
+            logger.warning("%s: sqlite3 is not available, the index is not saved"%self.state_file)
+            return False
+        try:
+            self.db = sqlite3.connect(self.state_file, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+            row = self.db.execute("SELECT value FROM meta WHERE name='key'").fetchone()
+            if row is not None and row[0] == self.key:
+                with self.lock:
+                    parent, node = None, -1
+                    for (path, mtime, size, inode, isdir) in self.db.execute('SELECT path, mtime, size, inode, isdir FROM files ORDER BY path'):
+                        # the files of a directory are loaded together, their directory is looked up once
+                        (dirname, name) = os.path.split(path)
+                        if dirname != parent:
+                            parent, node = dirname, self.paths.lookup(dirname, True)
+                        sub = self.paths.add_node(node, self.paths.intern(name))
+                        self.hold(sub, self.ENTRY | (self.ISDIR if isdir else 0))
+                        self.mtimes[sub], self.sizes[sub], self.inodes[sub] = mtime, size, inode
+                        self.count += 1
+                    for (path, mtime, inode) in self.db.execute('SELECT path, mtime, inode FROM dirs'):
+                        node = self.paths.lookup(path, True)
+                        self.hold(node, self.LISTED)
+                        self.listed_mtimes[node], self.listed_inodes[node] = mtime, inode
+                return True
+            if row is not None:
+                logger.info("%s: job options changed, the tree is indexed again"%self.state_file)
+            with self.db:
+                self.db.execute('DELETE FROM files')
+                self.db.execute('DELETE FROM dirs')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('key', ?)", (self.key,))
+        except sqlite3.Error as err:
+            logger.warning("%s: cannot open the state file: %s"%(self.state_file, err))
+            self.db = None
+        return False
+
+    def save_dirs(self):
+        with self.lock:
+            top = self.paths.lookup(self.top)
+            rows = [] if top == -1 else [(self.paths.path(node), self.listed_mtimes[node], self.listed_inodes[node])
+                                         for node in self.paths.subtree(top) if self.flags[node] & self.LISTED]
+        try:
+            with self.db:
+                self.db.execute('DELETE FROM dirs')
+                self.db.executemany('INSERT INTO dirs VALUES (?, ?, ?)', rows)
+        except sqlite3.Error as err:
+            logger.warning("%s: cannot write the state file: %s"%(self.state_file, err))
+
+    def flush(self, timers=None):
+        """ Write the changed paths to the state file in one transaction, then every `FLUSH_INTERVAL` seconds.
+            """
+        if self.db is None:
+            return
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            rows = [(path, self.entry(self.paths.lookup(path))) for path in dirty]
+        try:
+            with self.db:
+                self.db.executemany('DELETE FROM files WHERE path=?', ((path,) for (path, entry) in rows if entry is None))
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                    ((path,) + entry[:3] + (int(entry[3]),) for (path, entry) in rows if entry is not None))
+        except sqlite3.Error as err:
+            logger.warning("%s: cannot write the state file: %s"%(self.state_file, err))
+            with self.lock:
+                self.dirty.update(dirty)
+        if timers is not None:
+            self.flush_timer = timers.call_later(self.FLUSH_INTERVAL, self.flush, timers)
+
+    def close(self):
+        """ Update the index with the paths recorded, and write it to the state file.
+            """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join()
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    # live events
+
+    def record(self, event):
+        """ Queue the path of a live event, to update the index in the thread of the index.
+            """
+        with self.cond:
+            if self.closed:
+                return
+            self.queue[event.pathname] = None
+            if self.recent is not None:
+                self.recent.add(event.pathname)
+            self.wake()
+
+    def wake(self):
+        """ Start the thread of the index, or wake it up. The condition is held.
+            """
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name='index-%s'%self.top)
+            self.worker.daemon = True
+            self.worker.start()
+        self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                path = self.queue.popitem(last=False)[0]
+            try:
+                self.update(path)
+            except Exception:
+                logger.exception("%s: cannot index %s"%(self.top, path))
+
+    def update(self, path):
+        """ Update the index with the current entry of `path`.
+
+            The content of a directory moved in is indexed and the content of a
+            directory moved out is removed, neither is reported.
+            """
+        entry = self.stat(path)
+        with self.lock:
+            node = self.paths.lookup(path, entry is not None)
+            old = self.entry(node)
+            if old == entry:
+                return
+            if entry is None:
+                self.remove(node)
+                return
+            self.set_entry(node, path, entry)
+        if entry[3] and self.recursive and path not in self.excluded and (old is None or old[2] != entry[2] or not old[3]):
+            self.walk(path)
+
+    # reconciliation
+
+    def request(self, handler, timers):
+        """ Reconcile the index now, or later if the last reconciliation is too recent.
+            """
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+            delay = 0 if self.last is None else max(0, self.last + self.interval - monotonic())
+        if delay and timers is not None:
+            logger.info("%s: reconciliation in %.0fs"%(handler.job, delay))
+            timers.call_later(delay, self.start, handler)
+        else:
+            self.start(handler)
+
+    def start(self, handler):
+        thread = threading.Thread(target=self.reconcile, args=(handler,), name='reconcile-%s'%handler.job)
+        thread.daemon = True
+        thread.start()
+
+    def reconcile(self, handler):
+        """ Scan the tree and send the changes missing from the index to `handler` as events.
+            """
+        with self.scanning:
+            with self.lock:
+                self.scheduled = False
+                self.last = monotonic()
+            changes = self.rescan()
+            if self.db is not None:
+                self.save_dirs()
+        metrics.inc('watcher_reconciliations_total', job=handler.job)
+        self.send(handler, changes, 'reconciled in %.1fs'%(monotonic() - self.last))
+
+    def send(self, handler, changes, what):
+        """ Send the `changes` found by a scan to `handler` as events.
+            """
+        counts = collections.Counter(change for (change, path, isdir) in changes)
+        logger.info("%s: %s %s, %d created, %d modified, %d deleted"%(
+                    handler.job, self.top, what, counts['created'], counts['modified'], counts['deleted']))
+        new_dirs = set()
+        for (change, path, isdir) in changes:
+            if change == 'created' and isdir:
+                # watch the new trees, once from their top directory
+                if self.watch_dir is not None and os.path.dirname(path) not in new_dirs:
+                    self.watch_dir(path)
+                new_dirs.add(path)
+            mask = next((m for m in self.EVENTS[change] if m & self.mask and not (isdir and m == pyinotify.IN_CLOSE_WRITE)), None)
+            if mask is None:
+                continue
+            if isdir:
+                mask |= pyinotify.IN_ISDIR
+            metrics.inc('watcher_reconciled_events_total', job=handler.job, event=change)
+            handler(pyinotify.Event({'wd': -1, 'mask': mask, 'cookie': 0, 'path': os.path.dirname(path),
+                                     'name': os.path.basename(path), 'dir': isdir}))
+
+
+class Poller(object):
+    """ Poll the trees that are not watched with inotify, from a single thread.
+
+        Each tree is a `TreeIndex` scanned every `poll_interval` seconds of its
+        job: only the directories whose mtime changed are listed again, and the
+        differences are sent to the job handler as events.
+        """
+    def __init__(self):
+        self.trees    = dict()  # (job name, path) -> [due, TreeIndex, handler, interval]
+        self.cond     = threading.Condition()
+        self.thread   = None
+        self.stopping = False
+
+    def add(self, job, handler, path, new=False):
+        """ Poll `path` (with its subdirectories if the job is recursive) for `job`.
+
+            The content of a `new` tree is sent as created by the first scan,
+            otherwise the first scan only indexes the tree.
+            """
+        name = job['name']
+        if job['backend'] == 'inotify':
+            logger.warning("%s: cannot watch %s, its changes are missed"%(name, path))
+            return
+        recursive = job['recursive'] or path != job['folder']
+        tree = TreeIndex(path, recursive, job['excluded'], handler.filter, job['mask'])
+        with self.cond:
+            if (name, path) in self.trees:
+                return
+            # the first scan of the tree is made by the poller thread
+            self.trees[(name, path)] = [0 if new else None, tree, handler, job['poll_interval']]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='poller')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        logger.debug("%s: polling %s every %gs"%(name, path, job['poll_interval']))
+
+    def remove_job(self, name):
+        with self.cond:
+            for key in [key for key in self.trees if key[0] == name]:
+                del self.trees[key]
+
+    def update_job(self, job, handler):
+        with self.cond:
+            for (key, item) in self.trees.items():
+                if key[0] == job['name']:
+                    item[1].filter = handler.filter
+                    item[1].mask = job['mask']
+                    item[3] = job['poll_interval']
+
+    def count_trees(self):
+        with self.cond:
+            return len(self.trees)
+
+    def next_tree(self):
+        """ Wait for the next tree to poll, and return its key and item.
+            """
+        with self.cond:
+            while not self.stopping:
+                now = monotonic()
+                due = [(item[0] or 0, key) for (key, item) in self.trees.items()]
+                if due:
+                    when, key = min(due)
+                    if when <= now:
+                        return key, self.trees[key]
+                    self.cond.wait(when - now)
+                else:
+                    self.cond.wait()
+        return None, None
+
+    def run(self):
+        while True:
+            key, item = self.next_tree()
+            if key is None:
+                return
+            due, tree, handler, interval = item
+            try:
+                if not os.path.lexists(tree.top):
+                    # a new tree at this path is watched by inotify when it is created
+                    logger.debug("%s: %s removed, no longer polled"%key)
+                    with self.cond:
+                        self.trees.pop(key, None)
+                    changes = tree.rescan()
+                    if changes:
+                        tree.send(handler, changes, 'polled')
+                    continue
+                changes = tree.rescan(report=due is not None)
+                if changes:
+                    tree.send(handler, changes, 'polled')
+            except Exception:
+                logger.exception("%s: failed to poll %s"%key)
+            with self.cond:
+                if key in self.trees:
+                    self.trees[key][0] = monotonic() + interval
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+class CompactPaths(object):
+    """ Absolute paths stored as a tree of nodes in arrays, instead of a string each.
+
+        A node holds the id of its name, shared by all the paths with this name,
+        and the index of its parent node; the root node 0 is '/'. Nodes are
+        found from their parent and name in the `children` dict, and the
+        children of a node are linked by the `first_child` and `next_sibling`
+        arrays, so that a subtree is walked in proportion to its size. Paths
+        are only built when asked for.
+
+        A node is kept while it is used (`refs`): by each of its children, and
+        by its owner (e.g. a watch). The other arrays of the owner, indexed by
+        node, are given as (array, default) `columns` and grow with the nodes.
+        It is not thread safe: the owner locks it.
+        """
+    def __init__(self, *columns):
+        self.names        = []              # name id -> path component
+        self.name_ids     = dict()          # path component -> name id
+        self.children     = dict()          # parent node << 32 | name id -> node
+        self.free         = []              # unused node indexes
+        self.node_name    = array.array('i', [0])
+        self.parents      = array.array('i', [-1])
+        self.refs         = array.array('i', [1])
+        self.first_child  = array.array('i', [-1])
+        self.next_sibling = array.array('i', [-1])
+        self.prev_sibling = array.array('i', [-1])
+        self.columns      = columns
+        for (column, default) in columns:
+            column.append(default)
+
+    def __len__(self):
+        return len(self.parents) - len(self.free)
+
+    def intern(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def lookup(self, path, create=False):
+        """ Node of the absolute `path`, or -1. With `create`, the missing nodes are added.
+            """
+        node = 0
+        for part in path.split('/'):
+            if not part:
+                continue
+            name_id = self.intern(part) if create else self.name_ids.get(part)
+            if name_id is None:
+                return -1
+            child = self.children.get(node << 32 | name_id)
+            if child is None:
+                if not create:
+                    return -1
+                child = self.add_node(node, name_id)
+            node = child
+        return node
+
+    def child(self, node, name):
+        """ Child `name` of `node`, or -1.
+            """
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            return -1
+        return self.children.get(node << 32 | name_id, -1)
+
+    def add_node(self, parent, name_id):
+        if self.free:
+            node = self.free.pop()
+            self.node_name[node] = name_id
+            self.refs[node] = 0
+            self.first_child[node] = -1
+            for (column, default) in self.columns:
+                column[node] = default
+        else:
+            node = len(self.parents)
+            self.node_name.append(name_id)
+            self.parents.append(parent)
+            self.refs.append(0)
+            self.first_child.append(-1)
+            self.next_sibling.append(-1)
+            self.prev_sibling.append(-1)
+            for (column, default) in self.columns:
+                column.append(default)
+        self.link(node, parent)
+        self.refs[parent] += 1
+        self.children[parent << 32 | name_id] = node
+        return node
+
+    def link(self, node, parent):
+        self.parents[node] = parent
+        first = self.first_child[parent]
+        self.prev_sibling[node] = -1
+        self.next_sibling[node] = first
+        if first != -1:
+            self.prev_sibling[first] = node
+        self.first_child[parent] = node
+
+    def unlink(self, node):
+        previous, following = self.prev_sibling[node], self.next_sibling[node]
+        if previous != -1:
+            self.next_sibling[previous] = following
+        else:
+            self.first_child[self.parents[node]] = following
+        if following != -1:
+            self.prev_sibling[following] = previous
+
+    def release(self, node):
+        """ Free `node` and its parents, up to the first one still used.
+            """
+        while node > 0 and self.refs[node] == 0:
+            parent = self.parents[node]
+            key = parent << 32 | self.node_name[node]
+            if self.children.get(key) == node:
+                del self.children[key]
+            self.unlink(node)
+            self.free.append(node)
+            self.refs[parent] -= 1
+            node = parent
+
+    def path(self, node):
+        parts = []
+        while node > 0:
+            parts.append(self.names[self.node_name[node]])
+            node = self.parents[node]
+        return '/' + '/'.join(reversed(parts))
+
+    def name(self, node):
+        return self.names[self.node_name[node]]
+
+    def move(self, node, path):
+        """ Move `node`, with its subtree, to the absolute `path`.
+            """
+        parent, name = os.path.split(path)
+        name_id = self.intern(name)
+        new_parent = self.lookup(parent, True)
+        self.refs[new_parent] += 1
+        old_parent = self.parents[node]
+        key = old_parent << 32 | self.node_name[node]
+        if self.children.get(key) == node:
+            del self.children[key]
+        self.unlink(node)
+        self.link(node, new_parent)
+        self.node_name[node] = name_id
+        self.children[new_parent << 32 | name_id] = node
+        self.refs[old_parent] -= 1
+        self.release(old_parent)
+
+    def remove(self, node):
+        """ Free `node` with the nodes under it, and its parents up to the first one still used.
+            """
+        parent = self.parents[node]
+        for child in list(self.subtree(node)):
+            key = self.parents[child] << 32 | self.node_name[child]
+            if self.children.get(key) == child:
+                del self.children[key]
+            self.free.append(child)
+        self.unlink(node)
+        self.refs[parent] -= 1
+        self.release(parent)
+
+    def child_nodes(self, node):
+        """ Children of `node`. The tree must not change meanwhile.
+            """
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def subtree(self, node):
+        """ `node` and the nodes under it, parents first. The tree must not change meanwhile.
+            """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(self.child_nodes(node))
+
+
+class CompactWatch(object):
+    """ Watch of a `CompactWatchManager`, with the attributes of a `pyinotify.Watch`.
+
+        Its path is rebuilt from the path tree when it is read; setting it moves
+        the directory in the tree, with the watches under it.
+        """
+    __slots__ = ('wm', 'wd')
+
+    def __init__(self, wm, wd):
+        self.wm = wm
+        self.wd = wd
+
+    @property
+    def node(self):
+        return self.wm.wd_node(self.wd)
+
+    @property
+    def path(self):
+        return self.wm.get_path(self.wd)
+
+    @path.setter
+    def path(self, path):
+        self.wm.rename(self.wd, path)
+
+    @property
+    def mask(self):
+        return self.wm.masks[self.node]
+
+    @mask.setter
+    def mask(self, mask):
+        self.wm.masks[self.node] = mask
+
+    def attribute(self, i):
+        return self.wm.attributes[self.wm.attrs[self.node]][i]
+
+    proc_fun       = property(lambda self: self.attribute(0))
+    auto_add       = property(lambda self: self.attribute(1))
+    exclude_filter = property(lambda self: self.attribute(2))
+    dir            = property(lambda self: self.attribute(3))
+
+    def __repr__(self):
+        return '<CompactWatch wd=%d path=%s mask=%d>' % (self.wd, self.path, self.mask)
+
+
+class WatchTable(object):
+    """ Read-only {wd: watch} mapping of a `CompactWatchManager`, for `WatchManager.watches`.
+        """
+    def __init__(self, wm):
+        self.wm = wm
+
+    def __len__(self):
+        return self.wm.count
+
+    def __contains__(self, wd):
+        return self.wm.wd_node(wd) != -1
+
+    def __iter__(self):
+        return (wd for (wd, node) in enumerate(self.wm.nodes) if node != -1)
+
+    def __getitem__(self, wd):
+        watch = self.wm.get_watch(wd)
+        if watch is None:
+            raise KeyError(wd)
+        return watch
+
+    def get(self, wd, default=None):
+        return self.wm.get_watch(wd) or default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [CompactWatch(self.wm, wd) for wd in self]
+
+    def items(self):
+        return [(wd, CompactWatch(self.wm, wd)) for wd in self]
+
+
+def check_pyinotify(obj, names):
+    """ Fail with a clear error if `obj` lacks the private pyinotify attributes `names`.
+
+        `CompactWatchManager` and `follow_moves` use private attributes of
+        pyinotify 0.9 (see requirements.txt): another version fails when they
+        are created rather than on the first event.
+        """
+    missing = [name for name in names if not hasattr(obj, name)]
+    if missing:
+        raise pyinotify.PyinotifyError("pyinotify %s is not supported, %s has no %s" % (
+                                       getattr(pyinotify, '__version__', '?'), type(obj).__name__, ', '.join(missing)))
+
+
+class CompactWatchManager(pyinotify.WatchManager):
+    """ `pyinotify.WatchManager` storing its watches in arrays instead of a `Watch` object each.
+
+        The watched paths are interned in a `CompactPaths` tree, watch
+        descriptors are mapped to its nodes by the `nodes` array, and paths are
+        only built when asked for (e.g. for an event). The other attributes of a
+        watch are in arrays too, or shared between the watches added with the
+        same `proc_fun`, `auto_add` and `exclude_filter`.
+
+        It costs less than half the memory of a `WatchManager`, finding the
+        watch of a path (`get_wd`) costs one lookup per path component instead
+        of a scan of all the watches, and the watches under a directory are
+        found in proportion to their number (`subtree`).
+
+        It replaces the methods of `WatchManager` that use its private
+        attributes, those of pyinotify 0.9 (see `check_pyinotify`).
+        """
+    def __init__(self, exclude_filter=lambda path: False):
+        pyinotify.WatchManager.__init__(self, exclude_filter)
+        check_pyinotify(self, ('_inotify_wrapper', '_fd', '_exclude_filter'))
+        self.lock       = threading.RLock()
+        # per node
+        self.node_wd    = array.array('i')
+        self.masks      = array.array('I')
+        self.attrs      = array.array('H')
+        self.tree       = CompactPaths((self.node_wd, -1), (self.masks, 0), (self.attrs, 0))
+        self.attributes = []                # (proc_fun, auto_add, exclude_filter, dir)
+        self.attribute_ids = dict()
+        # per watch descriptor
+        self.nodes      = array.array('i')
+        self.count      = 0
+
+    def wd_node(self, wd):
+        if 0 <= wd < len(self.nodes):
+            return self.nodes[wd]
+        return -1
+
+    def register(self, wd, path, mask, proc_fun=None, auto_add=False, exclude_filter=None, isdir=True):
+        """ Record the watch `wd` of `path`, added to inotify.
+            """
+        attributes = (proc_fun, auto_add, exclude_filter, isdir)
+        key = tuple(id(value) for value in attributes)
+        with self.lock:
+            attrs = self.attribute_ids.get(key)
+            if attrs is None:
+                attrs = self.attribute_ids[key] = len(self.attributes)
+                self.attributes.append(attributes)
+            if self.wd_node(wd) != -1:
+                self.unregister(wd)
+            node = self.tree.lookup(os.path.abspath(path), True)
+            if self.node_wd[node] != -1:
+                # the path had another watch descriptor, e.g. it was replaced
+                self.nodes[self.node_wd[node]] = -1
+            else:
+                self.tree.refs[node] += 1
+                self.count += 1
+            if wd >= len(self.nodes):
+                self.nodes.extend([-1] * (wd + 1 - len(self.nodes)))
+            self.nodes[wd] = node
+            self.node_wd[node] = wd
+            self.masks[node] = mask
+            self.attrs[node] = attrs
+
+    def unregister(self, wd):
+        with self.lock:
+            node = self.wd_node(wd)
+            if node == -1:
+                return False
+            self.nodes[wd] = -1
+            self.node_wd[node] = -1
+            self.tree.refs[node] -= 1
+            self.count -= 1
+            self.tree.release(node)
+            return True
+
+    def rename(self, wd, path):
+        """ Move the watch `wd`, and the watches under it, to `path`.
+            """
+        with self.lock:
+            node = self.wd_node(wd)
+            if node != -1:
+                self.tree.move(node, os.path.abspath(path))
+
+    def subtree(self, wds):
+        """ Watch descriptors of the watches `wds` and of the watches under them.
+            """
+        with self.lock:
+            found = []
+            for wd in wds:
+                node = self.wd_node(wd)
+                if node == -1:
+                    continue
+                found.extend(self.node_wd[child] for child in self.tree.subtree(node) if self.node_wd[child] != -1)
+        return list(collections.OrderedDict.fromkeys(found))
+
+    # pyinotify.WatchManager interface
+
+    def get_watch(self, wd):
+        if self.wd_node(wd) == -1:
+            return None
+        return CompactWatch(self, wd)
+
+    def del_watch(self, wd):
+        if not self.unregister(wd):
+            pyinotify.log.error('Cannot delete unknown watch descriptor %s' % wd)
+
+    @property
+    def watches(self):
+        return WatchTable(self)
+
+    def get_wd(self, path):
+        node = self.tree.lookup(os.path.abspath(path))
+        if node == -1 or self.node_wd[node] == -1:
+            return None
+        return self.node_wd[node]
+
+    def get_path(self, wd):
+        node = self.wd_node(wd)
+        if node == -1:
+            return None
+        return self.tree.path(node)
+
+    def add_watch(self, path, mask, proc_fun=None, rec=False, auto_add=False, do_glob=False, quiet=True,
+                  exclude_filter=None):
+        result = dict()
+        if exclude_filter is None:
+            exclude_filter = self._exclude_filter
+        if auto_add:
+            mask |= pyinotify.IN_CREATE
+        for npath in (path if isinstance(path, list) else [path]):
+            for apath in (glob.iglob(npath) if do_glob else [npath]):
+                if rec and os.path.isdir(apath) and not os.path.islink(apath):
+                    paths = (root for (root, dirs, files) in os.walk(apath))
+                else:
+                    paths = [apath]
+                for rpath in paths:
+                    rpath = os.path.normpath(rpath)
+                    if exclude_filter(rpath):
+                        result[rpath] = -2
+                        continue
+                    wd = result[rpath] = self._inotify_wrapper.inotify_add_watch(self._fd, rpath, mask)
+                    if wd >= 0:
+                        self.register(wd, rpath, mask, proc_fun, auto_add, exclude_filter, os.path.isdir(rpath))
+                        continue
+                    err = 'add_watch: cannot watch %s WD=%d, %s' % (rpath, wd, self._inotify_wrapper.str_errno())
+                    if not quiet:
+                        raise pyinotify.WatchManagerError(err, result)
+                    pyinotify.log.error(err)
+        return result
+
+    def update_watch(self, wd, mask=None, proc_fun=None, rec=False, auto_add=False, quiet=True):
+        wds = wd if isinstance(wd, list) else [wd]
+        if rec:
+            wds = list(self.subtree(wds))
+        result = dict()
+        for awd in wds:
+            path = self.get_path(awd)
+            if path is None:
+                err = 'update_watch: invalid WD=%d' % awd
+            elif mask and self._inotify_wrapper.inotify_add_watch(self._fd, path, mask) < 0:
+                result[awd] = False
+                err = 'update_watch: cannot update %s WD=%d, %s' % (path, awd, self._inotify_wrapper.str_errno())
+            else:
+                node = self.wd_node(awd)
+                if mask:
+                    self.masks[node] = mask
+                if proc_fun or auto_add:
+                    watch = CompactWatch(self, awd)
+                    self.register(awd, path, self.masks[node], proc_fun or watch.proc_fun,
+                                  auto_add or watch.auto_add, watch.exclude_filter, watch.dir)
+                result[awd] = True
+                continue
+            if not quiet:
+                raise pyinotify.WatchManagerError(err, result)
+            pyinotify.log.error(err)
+        return result
+
+    def rm_watch(self, wd, rec=False, quiet=True):
+        wds = wd if isinstance(wd, list) else [wd]
+        if rec:
+            wds = list(self.subtree(wds))
+        result = dict()
+        for awd in wds:
+            if self._inotify_wrapper.inotify_rm_watch(self._fd, awd) < 0:
+                result[awd] = False
+                err = 'rm_watch: cannot remove WD=%d, %s' % (awd, self._inotify_wrapper.str_errno())
+                if not quiet:
+                    raise pyinotify.WatchManagerError(err, result)
+                pyinotify.log.error(err)
+                continue
+            self.unregister(awd)
+            result[awd] = True
+        return result
+
+
+class MoveProcessEvent(getattr(pyinotify, '_SysProcessEvent', object)):
+    """ Internal processing of the events of a notifier, see `follow_moves`.
+
+        pyinotify renames the watches of a moved directory on its IN_MOVE_SELF
+        event, by building the path of every watch to find those under it.
+        `rename_watches` already moved them on the IN_MOVED_TO event, and
+        recorded the move for the new path of the directory.
+        """
+    def process_IN_MOVE_SELF(self, raw_event):
+        watch = self._watch_manager.get_watch(raw_event.wd)
+        if watch is not None:
+            path = watch.path
+            move = self._mv.get(path)
+            if move is not None and move[0] == path:
+                del self._mv[path]
+                return self.process_default(raw_event)
+        return pyinotify._SysProcessEvent.process_IN_MOVE_SELF(self, raw_event)
+
+def follow_moves(notifier):
+    """ Leave the watches of the directories moved to the engine of `notifier`, which renames them
+        with `rename_watches`, instead of pyinotify. Return `notifier`.
+        """
+    check_pyinotify(pyinotify, ('_SysProcessEvent',))
+    check_pyinotify(notifier, ('_sys_proc_fun', '_watch_manager'))
+    check_pyinotify(notifier._sys_proc_fun, ('_mv',))
+    notifier._sys_proc_fun = MoveProcessEvent(notifier._watch_manager, notifier)
+    return notifier
+
+def rename_watches(wm, notifier, wd, dest):
+    """ Move the watch `wd` of a directory moved to `dest`, with the watches under it, in place.
+
+        The move recorded by pyinotify for the old path of the watch is recorded
+        for `dest` instead, for `MoveProcessEvent`.
+        """
+    src = wm.get_path(wd)
+    wm.rename(wd, dest)
+    moves = notifier._sys_proc_fun._mv
+    if src in moves:
+        moves[dest] = moves.pop(src)
+    logger.debug("Moved the watches of %s to %s"%(src, dest))
+
+def max_user_watches():
+    """ Maximum number of inotify watches of the user, or None if it is unknown.
+        """
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class ThreadedEngine(object):
+    """ One `CompactWatchManager` and one `ThreadedNotifier` thread per job.
+
+        Directories that cannot be watched, because the inotify watches reached
+        `budget` or ran out, are polled by `poller`, as well as the jobs with
+        the 'poll' backend.
+        """
+    def __init__(self, scan_threads=1):
+        self.jobs      = dict()
+        self.handlers  = dict()
+        self.wms       = dict()
+        self.notifiers = dict()
+        self.scan_threads = scan_threads
+        self.started   = False
+        self.budget    = None
+        self.poller    = None
+
+    def add_job(self, job, handler):
+        section = job['name']
+        self.jobs[section] = job
+        self.handlers[section] = handler
+        if job['backend'] == 'poll':
+            return self.poll(section, job['folder'])
+        wm = self.wms[section] = CompactWatchManager()
+        # Create ThreadNotifier so that each job has its own thread,
+        # started first to get the events of the dirs watched during the scan
+        self.notifiers[section] = follow_moves(pyinotify.ThreadedNotifier(wm, functools.partial(self.dispatch, section, handler)))
+        if self.started:
+            self.start_notifier(section)
+
+        visit = functools.partial(self.watch, section)
+        if is_tree(job):
+            TreeScanner(job['folder'], job['excluded'], visit, self.scan_threads, section).run()
+        else:
+            visit(job['folder'])
+
+    def watch(self, name, path):
+        """ Watch `path` for the job `name`, or poll it if no more watches can be added.
+
+            Return True if `path` is watched.
+            """
+        job = self.jobs[name]
+        if self.budget is None or self.count_watches() < self.budget:
+            # Excluded dirs are pruned from the scan, and from the auto added dirs by pyinotify
+            wdd = self.wms[name].add_watch(path, self.watch_mask(job), auto_add=job['autoadd'],
+                                           exclude_filter=job['excluded'])
+            if wdd.get(path, -1) >= 0:
+                return True
+        self.poll(name, path)
+        return False
+
+    def poll(self, name, path, new=False):
+        """ Poll `path` for the job `name` instead of watching it, from an empty tree if it is `new`.
+            """
+        if self.poller is not None and os.access(path, os.R_OK):
+            self.poller.add(self.jobs[name], self.handlers[name], path, new)
+
+    @staticmethod
+    def watch_mask(job):
+        """ Mask of the watches of `job`: with `autoadd`, directories created or moved are followed.
+            """
+        if job['autoadd']:
+            return job['mask'] | pyinotify.IN_CREATE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        return job['mask']
+
+    def dispatch(self, name, handler, event):
+        """ Follow the directories moved, and poll the directories added by pyinotify when the
+            watches ran out, then run `handler` if the job watches the event.
+            """
+        job = self.jobs.get(name)
+        if job is not None and event.mask & pyinotify.IN_ISDIR and event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+            moved = event.mask & pyinotify.IN_MOVED_TO and self.move_dir(name, event)
+            if not moved and job['autoadd'] and event.pathname not in job['excluded']:
+                wm = self.wms[name]
+                wd = wm.get_wd(event.pathname)
+                if wd is None or (self.budget is not None and self.count_watches() > self.budget):
+                    if wd is not None:
+                        wm.rm_watch(wd, rec=True, quiet=True)
+                    # what was created in the directory before its first scan is sent too
+                    self.poll(name, event.pathname, new=True)
+        if job is not None and event.mask & (self.watch_mask(job) & ~job['mask']) and not event.mask & job['mask']:
+            # only watched to follow the directories
+            return
+        handler(event)
+
+    def move_dir(self, name, event):
+        """ Move the watches of a directory moved within the tree of the job `name` to its new path,
+            or remove them if it was moved to an excluded directory.
+
+            Return False if the directory was not watched, e.g. moved from another tree.
+            """
+        src = getattr(event, 'src_pathname', None)
+        wm = self.wms.get(name)
+        wd = wm.get_wd(src) if src and wm is not None else None
+        if wd is None:
+            return False
+        rename_watches(wm, self.notifiers[name], wd, event.pathname)
+        if event.pathname in self.jobs[name]['excluded']:
+            wm.rm_watch(wd, rec=True, quiet=True)
+        return True
+
+    def remove_job(self, name):
+        if name in self.notifiers:
+            self.notifiers.pop(name).stop()
+            del self.wms[name]
+        del self.jobs[name]
+        del self.handlers[name]
+
+    def update_job(self, job):
+        """ Apply the new mask of `job` to its watches.
+            """
+        self.jobs[job['name']] = job
+        wm = self.wms.get(job['name'])
+        if wm is None:
+            return
+        mask = self.watch_mask(job)
+        wds = list(wm.watches)
+        wm.update_watch(wds, mask=mask)
+        # pyinotify does not store the updated mask, which is inherited by auto added watches
+        for wd in wds:
+            wm.get_watch(wd).mask = mask
+
+    def start_notifier(self, name):
+        try:
+            self.notifiers[name].start()
+            logger.debug('Notifier for %s is instanciated'%(name))
+        except pyinotify.NotifierError as err:
+            logger.warning( '%r %r'%(sys.stderr, err))
+
+    def start(self):
+        # Start all the notifiers.
+        self.started = True
+        for name in self.notifiers:
+            self.start_notifier(name)
+
+    def add_dir(self, name, path):
+        """ Watch a directory found after its creation event was lost, with its subdirectories.
+            """
+        if name in self.wms:
+            for root, dirs, files in walk_tree(path, self.jobs[name]['excluded']):
+                if not self.watch(name, root):
+                    dirs[:] = []
+
+    def count_watches(self):
+        return sum(len(wm.watches) for wm in list(self.wms.values()))
+
+    def stop(self):
+        cleanup_notifiers(self.notifiers)
+
+
+class SharedEngine(object):
+    """ A single inotify instance and reader thread shared by all the jobs.
+
+        A directory watched by several jobs gets one watch descriptor with the union
+        of the job masks. Events are routed to the handlers of the jobs subscribed
+        to their watch descriptor, if the event matches the job mask.
+
+        Directories that cannot be watched, because the inotify watches reached
+        `budget` or ran out, are polled by `poller`, as well as the jobs with
+        the 'poll' backend.
+        """
+    budget = None
+    poller = None
+
+    def __init__(self, scan_threads=1):
+        self.scan_threads = scan_threads
+        self.wm          = CompactWatchManager()
+        self.notifier    = self.make_notifier()
+        self.jobs        = dict()   # job name -> job
+        self.handlers    = dict()   # job name -> EventHandler
+        self.subscribers = dict()   # wd -> {job name: mask}, shared and never modified, see `subscribe`
+        self.subscriptions = dict() # frozenset of {job name: mask} items -> the shared dict
+        self.lock        = threading.RLock()
+
+    def make_notifier(self):
+        return follow_moves(pyinotify.ThreadedNotifier(self.wm, self.dispatch))
+
+    def add_job(self, job, handler):
+        name = job['name']
+        with self.lock:
+            self.jobs[name] = job
+            self.handlers[name] = handler
+        if job['backend'] == 'poll':
+            return self.poll(name, job['folder'])
+
+        def visit(path):
+            with self.lock:
+                return self.watch(path, name) is not None
+        if is_tree(job):
+            TreeScanner(job['folder'], job['excluded'], visit, self.scan_threads, name).run()
+        else:
+            visit(job['folder'])
+
+    def add_tree(self, name, top, recursive, created=None):
+        """ Watch `top` (and its subdirectories if `recursive`) for the job `name`.
+
+            If `created` is a list, the files and directories found under `top`
+            are appended to it as (path, name, isdir) tuples.
+            Return the number of directories watched.
+            """
+        count = 0
+        if not recursive or not os.path.isdir(top) or os.path.islink(top):
+            return 1 if self.watch(top, name) else 0
+        for root, dirs, files in walk_tree(top, self.jobs[name]['excluded']):
+            if not self.watch(root, name, created is not None):
+                # polled with its subdirectories
+                dirs[:] = []
+                continue
+            count += 1
+            if created is not None:
+                created.extend((root, d, True) for d in dirs)
+                created.extend((root, f, False) for f in files)
+        return count
+
+    def poll(self, name, path, new=False):
+        """ Poll `path` for the job `name` instead of watching it. Return None.
+            """
+        if self.poller is not None and os.access(path, os.R_OK):
+            self.poller.add(self.jobs[name], self.handlers[name], path, new)
+
+    def watch_mask(self, subscribers):
+        """ Union of the masks of the `subscribers` of a watch.
+            """
+        mask = 0
+        for (name, job_mask) in subscribers.items():
+            mask |= job_mask
+            if self.jobs[name]['autoadd']:
+                mask |= pyinotify.IN_CREATE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        return mask
+
+    def watch(self, path, name, new=False):
+        """ Subscribe the job `name` to `path`, adding or extending the watch.
+
+            If the watch cannot be added, `path` is polled instead, from an
+            empty tree if it is `new`.
+            """
+        path = os.path.normpath(path)
+        wd = self.wm.get_wd(path)
+        if wd is None:
+            if self.budget is not None and len(self.wm.watches) >= self.budget:
+                return self.poll(name, path, new)
+            subscribers = {name: self.jobs[name]['mask']}
+            wd = self.wm.add_watch(path, self.watch_mask(subscribers)).get(path)
+            if wd is None or wd < 0:
+                return self.poll(name, path, new)
+            self.subscribe(wd, subscribers)
+        else:
+            subscribers = dict(self.subscribers.get(wd, {}))
+            subscribers[name] = self.jobs[name]['mask']
+            self.subscribe(wd, subscribers)
+            self.update_mask(wd)
+        return wd
+
+    def subscribe(self, wd, subscribers):
+        """ Set the subscribers of `wd`, sharing the dict between the watches with the same subscribers.
+            """
+        key = frozenset(subscribers.items())
+        self.subscribers[wd] = self.subscriptions.setdefault(key, subscribers)
+
+    def update_mask(self, wd):
+        """ Set the mask of `wd` to the union of the masks of its subscribers.
+            """
+        watch = self.wm.get_watch(wd)
+        mask = self.watch_mask(self.subscribers[wd])
+        if mask != watch.mask:
+            self.wm.update_watch(wd, mask=mask)
+            # pyinotify does not store the updated mask
+            watch.mask = mask
+
+    def remove_job(self, name):
+        """ Unsubscribe the job `name` from its watches, and remove the watches left without subscriber.
+            """
+        with self.lock:
+            for wd in [wd for (wd, subscribers) in self.subscribers.items() if name in subscribers]:
+                subscribers = dict(self.subscribers[wd])
+                del subscribers[name]
+                if subscribers:
+                    self.subscribe(wd, subscribers)
+                    self.update_mask(wd)
+                else:
+                    self.forget(wd)
+                    self.wm.rm_watch(wd)
+            del self.jobs[name]
+            del self.handlers[name]
+
+    def update_job(self, job):
+        """ Apply the new mask of `job` to its watches.
+            """
+        name = job['name']
+        with self.lock:
+            self.jobs[name] = job
+            for (wd, subscribers) in list(self.subscribers.items()):
+                if name in subscribers:
+                    subscribers = dict(subscribers)
+                    subscribers[name] = job['mask']
+                    self.subscribe(wd, subscribers)
+                    self.update_mask(wd)
+
+    def add_dir(self, name, path):
+        """ Watch a directory found after its creation event was lost, with its subdirectories.
+            """
+        with self.lock:
+            if name in self.jobs and self.jobs[name]['backend'] != 'poll':
+                self.add_tree(name, path, True)
+
+    def count_watches(self):
+        return len(self.wm.watches)
+
+    def forget(self, wd):
+        """ Drop the subscribers of a watch descriptor.
+            """
+        self.subscribers.pop(wd, None)
+
+    def auto_add(self, event, subscribers):
+        """ Watch a directory created or moved under a watch, for the jobs with `autoadd`.
+
+            Return the (job name, event) creation events to simulate for the content
+            of the directory, to dispatch after the event of the directory itself.
+            """
+        simulated = []
+        for name in subscribers:
+            job = self.jobs[name]
+            if not job['autoadd'] or event.pathname in job['excluded']:
+                continue
+            created = [] if event.mask & pyinotify.IN_CREATE else None
+            self.add_tree(name, event.pathname, True, created)
+            # Simulate creation events for the content created before the watch was set (mkdir -p)
+            if created and job['mask'] & pyinotify.IN_CREATE:
+                for (root, entry, isdir) in created:
+                    mask = pyinotify.IN_CREATE | (pyinotify.IN_ISDIR if isdir else 0)
+                    simulated.append((name, pyinotify.Event({'wd': self.wm.get_wd(root) or -1, 'mask': mask,
+                                                             'path': root, 'name': entry, 'dir': isdir})))
+        return simulated
+
+    def move_dir(self, event, subscribers):
+        """ Move the watches of a directory moved under a watch to its new path.
+
+            Return False if the directory was not watched, or if it was moved
+            from the trees of other jobs than `subscribers`, or to a directory
+            excluded by one of them: it is then watched like a new directory.
+            """
+        src = getattr(event, 'src_pathname', None)
+        wd = self.wm.get_wd(src) if src else None
+        if wd is None:
+            return False
+        rename_watches(self.wm, self.notifier, wd, event.pathname)
+        if self.subscribers.get(wd) != subscribers:
+            return False
+        return not any(event.pathname in self.jobs[name]['excluded'] for name in subscribers)
+
+    def dispatch(self, event):
+        """ Route an event to the handlers of the subscribed jobs.
+            """
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # events of any job may have been lost
+            for handler in list(self.handlers.values()):
+                handler(event)
+            return
+        simulated = ()
+        with self.lock:
+            subscribers = self.subscribers.get(event.wd, {})
+            handlers = [self.handlers[name] for (name, mask) in subscribers.items() if event.mask & mask]
+            if event.mask & pyinotify.IN_ISDIR and event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                if not (event.mask & pyinotify.IN_MOVED_TO and self.move_dir(event, subscribers)):
+                    simulated = [(self.handlers[name], created) for (name, created) in self.auto_add(event, subscribers)]
+            if event.mask & pyinotify.IN_IGNORED:
+                self.forget(event.wd)
+        # the directory is created before its content
+        for handler in handlers:
+            handler(event)
+        for (handler, created) in simulated:
+            handler(created)
+
+    def start(self):
+        try:
+            self.notifier.start()
+        except pyinotify.NotifierError as err:
+            logger.warning( '%r %r'%(sys.stderr, err))
+
+    def stop(self):
+        self.notifier.stop()
+
+
+class AsyncioEngine(SharedEngine):
+    """ `SharedEngine` reading the inotify file descriptor from an asyncio event loop.
+        """
+    def __init__(self, scan_threads=1, loop=None):
+        self.loop = loop
+        SharedEngine.__init__(self, scan_threads)
+
+    def make_notifier(self):
+        return follow_moves(pyinotify.AsyncioNotifier(self.wm, self.loop, default_proc_fun=self.dispatch))
+
+    def start(self):
+        # the notifier reads events as soon as the loop runs
+        pass
+
+    def pause(self):
+        self.loop.remove_reader(self.notifier._fd)
+
+    def resume(self):
+        self.loop.add_reader(self.notifier._fd, self.notifier.handle_read)
+
+
+ENGINES = {'threaded': ThreadedEngine, 'shared': SharedEngine}
+if asyncio is not None:
+    ENGINES['asyncio'] = AsyncioEngine
+
+def read_config(paths):
+    """ Read the config files `paths`. Return None if none of them could be read.
+        """
+    config = configparser.ConfigParser()
+    if not config.read(paths):
+        return None
+    return config
+
+
+class Watcher(object):
+    """ Run the jobs of the config files.
+
+        On SIGHUP, the config files are read again and only the jobs that changed
+        are updated: see `reload`.
+        """
+    # job options that need the job to be watched again when they change
+    WATCH_OPTIONS = ('folder', 'recursive', 'autoadd', 'excluded', 'state_file', 'backend')
+    # general options that need a restart when they change
+    RESTART_OPTIONS = ('engine', 'scan_threads', 'max_workers', 'queue_size', 'watch_budget', 'handler_processes')
+
+    def __init__(self, config_files):
+        self.config_files = config_files
+        self.config       = read_config(config_files)
+        self.jobs         = dict()
+        self.handlers     = dict()
+        self.reload_requested = threading.Event()
+
+        name = get_option(self.config, 'DEFAULT', 'engine', 'threaded')
+        if name not in ENGINES:
+            raise ValueError('Unknown engine %r, use one of %s'%(name, ', '.join(sorted(ENGINES))))
+        scan_threads = get_option(self.config, 'DEFAULT', 'scan_threads', 4, int)
+        max_workers = get_option(self.config, 'DEFAULT', 'max_workers', multiprocessing.cpu_count(), int)
+        queue_size = get_option(self.config, 'DEFAULT', 'queue_size', 10000, int)
+        if name == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.engine = AsyncioEngine(scan_threads, self.loop)
+            self.scheduler = AsyncioScheduler(self.loop, max_workers, queue_size)
+            self.scheduler.backpressure = self.engine
+            self.timers = LoopTimers(self.loop)
+        else:
+            self.loop = None
+            self.engine = ENGINES[name](scan_threads)
+            self.scheduler = CommandScheduler(max_workers, queue_size)
+            self.timers = TimerQueue()
+        self.scheduler.timers = self.timers
+        self.scheduler.processes = get_option(self.config, 'DEFAULT', 'handler_processes', None, int)
+        if any(get_option(self.config, section, 'handler_pool') == 'processes' for section in self.config.sections()):
+            # fork the pool before any thread is started
+            self.scheduler.process_pool()
+        self.poller = Poller()
+        self.engine.poller = self.poller
+        self.engine.budget = get_option(self.config, 'DEFAULT', 'watch_budget', None, int)
+        if self.engine.budget is None and max_user_watches() is not None:
+            # leave some watches to the other programs of the user
+            self.engine.budget = max_user_watches() * 9 // 10
+        port = get_option(self.config, 'DEFAULT', 'stats_port', None, int)
+        self.stats = StatsServer(stats_socket(self.config), port,
+                                 get_option(self.config, 'DEFAULT', 'stats_address', '127.0.0.1'),
+                                 get_option(self.config, 'DEFAULT', 'stats_file'),
+                                 get_option(self.config, 'DEFAULT', 'stats_interval', 60, float),
+                                 self.timers, self.loop)
+        metrics.gauge('watcher_watches', self.engine.count_watches, 'Active inotify watches.')
+        metrics.gauge('watcher_polled_trees', self.poller.count_trees, 'Directory trees polled instead of watched.')
+        metrics.gauge('watcher_queue_depth', lambda: self.scheduler.queued, 'Commands waiting for a worker.')
+        metrics.gauge('watcher_job_queue_depth', self.scheduler.backlog, 'Commands waiting for a worker, per job.')
+        metrics.gauge('watcher_commands_running', self.scheduler.count_running, 'Commands running.')
+
+    def add_job(self, job):
+        name = job['name']
+        logger.info(name + ": " + job['folder'])
+        self.jobs[name] = job
+        self.handlers[name] = make_handler(job, self.scheduler, self.timers)
+        self.engine.add_job(job, self.handlers[name])
+        self.index_job(job)
+
+    def index_job(self, job):
+        """ Build the `TreeIndex` of a job in the background, once its tree is watched.
+
+            The events received in the meantime are recorded in the index.
+            """
+        name = job['name']
+        index = self.handlers[name].index
+        if index is None:
+            return
+        if is_tree(job) and job['autoadd']:
+            index.watch_dir = functools.partial(self.engine.add_dir, name)
+        thread = threading.Thread(target=index.build, args=(self.handlers[name],), name='index-%s'%name)
+        thread.daemon = True
+        thread.start()
+
+    def add_jobs(self):
+        # read jobs from config file
+        for section in self.config.sections():
+            self.add_job(parse_job(self.config, section))
+
+    def remove_job(self, name):
+        logger.info("Removing job %s"%name)
+        self.engine.remove_job(name)
+        self.poller.remove_job(name)
+        self.scheduler.remove_job(name)
+        self.handlers.pop(name).close()
+        del self.jobs[name]
+
+    def update_job(self, job):
+        """ Update a running job with its new options, keeping its watches if possible.
+            """
+        name = job['name']
+        old = self.jobs[name]
+        if any(old[option] != job[option] for option in self.WATCH_OPTIONS):
+            self.remove_job(name)
+            self.add_job(job)
+            return
+        logger.info("Updating job %s"%name)
+        index = self.handlers[name].index
+        self.handlers[name].update(make_handler(job, self.scheduler, self.timers))
+        if index is None:
+            self.index_job(job)
+        if old['mask'] != job['mask']:
+            self.engine.update_job(job)
+        self.poller.update_job(job, self.handlers[name])
+        self.jobs[name] = job
+
+    def reload(self):
+        """ Read the config files again and apply the changes of the jobs.
+
+            Removed jobs are stopped, new jobs are started, and changed jobs are
+            updated in place; the unchanged jobs are not touched.
+            """
+        start = monotonic()
+        try:
+            config = read_config(self.config_files)
+            if config is None:
+                raise ValueError("cannot read %s"%', '.join(self.config_files))
+            jobs = dict((section, parse_job(config, section)) for section in config.sections())
+        except Exception as err:
+            logger.error("Failed to reload the configuration, keeping the current one: %s"%err)
+            return
+        for option in self.RESTART_OPTIONS:
+            if get_option(config, 'DEFAULT', option) != get_option(self.config, 'DEFAULT', option):
+                logger.warning("Option %r changed, restart the daemon to apply it"%option)
+        self.config = config
+
+        removed = [name for name in self.jobs if name not in jobs]
+        added   = [name for name in jobs if name not in self.jobs]
+        updated = [name for name in jobs if name in self.jobs and jobs[name] != self.jobs[name]]
+        for name in removed:
+            self.remove_job(name)
+        for name in updated:
+            self.update_job(jobs[name])
+        for name in added:
+            self.add_job(jobs[name])
+        logger.info("Configuration reloaded in %.1f ms: %d added, %d removed, %d updated, %d unchanged"%(
+                    (monotonic() - start) * 1000, len(added), len(removed), len(updated),
+                    len(jobs) - len(added) - len(updated)))
+
+    def request_reload(self, signum, frame):
+        # reload from the main loop, not from the signal handler
+        self.reload_requested.set()
+
+    def terminate(self, signum, frame):
+        # stop from the main loop, which closes the handlers, also when not daemonized
+        raise SystemExit("Terminating on signal %d"%signum)
+
+    def run(self):
+        if self.loop is not None:
+            return self.run_loop()
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.terminate)
+        self.scheduler.start()
+        self.timers.start()
+        try:
+            self.stats.start()
+        except (IOError, OSError) as err:
+            logger.warning("Failed to start the stats server: %s"%err)
+        # events are delivered as soon as the first directories are watched
+        self.engine.start()
+
+        self.add_jobs()
+
+        # Wait for SIGTERM
+        try:
+            while 1:
+                time.sleep(0.1)
+                if self.reload_requested.is_set():
+                    self.reload_requested.clear()
+                    self.reload()
+        except:
+            self.engine.stop()
+            self.poller.stop()
+            self.stats.stop()
+            self.timers.stop()
+            self.scheduler.stop()
+        for handler in self.handlers.values():
+            handler.close()
+
+    def run_loop(self):
+        """ Run the jobs from the asyncio event loop, until SIGTERM or SIGINT.
+
+            The jobs are added, and the configuration is reloaded on SIGHUP, from
+            another thread, so that events are read meanwhile.
+            """
+        loop = self.loop
+        watch_children(loop)
+        reloading = threading.Lock()
+        def in_thread(func):
+            def run():
+                with reloading:
+                    try:
+                        func()
+                    except Exception:
+                        logger.exception("Failed to start the jobs")
+            thread = threading.Thread(target=run, name='reload')
+            thread.daemon = True
+            thread.start()
+        loop.add_signal_handler(signal.SIGHUP, in_thread, self.reload)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, loop.stop)
+        self.scheduler.start()
+        try:
+            self.stats.start()
+        except (IOError, OSError) as err:
+            logger.warning("Failed to start the stats server: %s"%err)
+        in_thread(self.add_jobs)
+        try:
+            loop.run_forever()
+        finally:
+            self.engine.stop()
+            self.poller.stop()
+            self.stats.stop()
+            self.scheduler.stop()
+            for handler in list(self.handlers.values()):
+                handler.close()
+            loop.close()
+
+def watch_children(loop):
+    """ Reap the children of `loop` with pidfds when possible, without a thread per child.
+        """
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return  # kernel < 5.3
+    child_watcher = asyncio.PidfdChildWatcher()
+    child_watcher.attach_loop(loop)
+    asyncio.set_child_watcher(child_watcher)
+
+def watcher(config_files):
+    try:
+        w = Watcher(config_files)
+    except ValueError as err:
+        logger.warning(str(err))
+        return
+    w.run()
+
+def cleanup_notifiers(notifiers):
+    """Close notifiers instances when the process is killed
+    """
+    for notifier in notifiers.values():
+        notifier.stop()
+
+def parseMask(masks):
+    ret = False;
+
+    for mask in masks:
+        mask = mask.strip()
+
+        if 'access' == mask:
+            ret = addMask(pyinotify.IN_ACCESS, ret)
+        elif 'attribute_change' == mask:
+            ret = addMask(pyinotify.IN_ATTRIB, ret)
+        elif 'write_close' == mask:
+            ret = addMask(pyinotify.IN_CLOSE_WRITE, ret)
+        elif 'nowrite_close' == mask:
+            ret = ddMask(pyinotify.IN_CLOSE_NOWRITE, ret)
+        elif 'create' == mask:
+            ret = addMask(pyinotify.IN_CREATE, ret)
+        elif 'delete' == mask:
+            ret = addMask(pyinotify.IN_DELETE, ret)
+        elif 'self_delete' == mask:
+            ret = addMask(pyinotify.IN_DELETE_SELF, ret)
+        elif 'modify' == mask:
+            ret = addMask(pyinotify.IN_MODIFY, ret)
+        elif 'self_move' == mask:
+            ret = addMask(pyinotify.IN_MOVE_SELF, ret)
+        elif 'move_from' == mask:
+            ret = addMask(pyinotify.IN_MOVED_FROM, ret)
+        elif 'move_to' == mask:
+            ret = addMask(pyinotify.IN_MOVED_TO, ret)
+        elif 'open' == mask:
+            ret = addMask(pyinotify.IN_OPEN, ret)
+        elif 'all' == mask:
+            m = pyinotify.IN_ACCESS | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | \
+                pyinotify.IN_CLOSE_NOWRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+                pyinotify.IN_DELETE_SELF | pyinotify.IN_MODIFY | pyinotify.IN_MOVE_SELF | \
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_OPEN
+            ret = addMask(m, ret)
+        elif 'move' == mask:
+            ret = addMask(pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO, ret)
+        elif 'close' == mask:
+            ret = addMask(pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE, ret)
+    return ret
+
+def addMask(new_option, current_options):
+    if not current_options:
+        return new_option
+    else:
+        return current_options | new_option
+
+def init_daemon(cf):
+    """Convert config.defaults() OrderedDict to a `dict` to use in daemon initialization
+    """
+    #logfile = cf.get('logfile', '/tmp/watcher.log')
+    pidfile = cf.get('pidfile', '/tmp/watcher.pid')
+    # uid
+    uid = cf.get('uid', None)
+    if uid is not None:
+        try:
+            uid = int(uid)
+        except ValueError as e:
+            if uid != '':
+                logger.warning('Incorrect uid value: %r' %(e))    
+            uid = None
+    # gid
+    gid = cf.get('gid', None)
+    if gid is not None:
+        try:
+            gid = int(gid)
+        except ValueError as e:
+            if gid != '':
+                logger.warning('Incorrect gid value: %r' %(e))    
+            gid = None
+
+    umask = cf.get('umask', None)
+    if umask is not None:
+        try:
+            umask = int(umask)
+        except ValueError as e:
+            if umask != '':
+                logger.warning('Incorrect umask value: %r' %(e))    
+            umask = None
+
+    wd = cf.get('working_directory', None)
+    if wd is not None and not os.path.isdir(wd):
+        if wd != '':
+            logger.warning('Working directory not a valid directory ("%s"). Set to default ("/")' %(wd))    
+        wd = None
+
+    return {'pidfile':pidfile, 'stdin':None, 'stdout':None, 'stderr':None, 'uid':uid, 'gid':gid, 'umask':umask, 'working_directory':wd}
+
+if __name__ == "__main__":
+    # Parse commandline arguments
+    parser = argparse.ArgumentParser(
+                description='A daemon to monitor changes within specified directories and run commands on these changes.',
+             )
+    parser.add_argument('-c','--config',
+                        action='store',
+                        help='Path to the config file (default: %(default)s)')
+    parser.add_argument('command',
+                        action='store',
+                        choices=['start','stop','restart','reload','debug','stats'],
+                        help='What to do.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
+
+    args = parser.parse_args()
+
+    # Parse the config file
+    if args.config:
+        # load config file specified by commandline (absolute, the daemon changes its directory)
+        config_files = [os.path.abspath(args.config)]
+    else:
+        # load config file from default locations
+        config_files = ['/etc/watcher.ini', os.path.expanduser('~/.watcher.ini')]
+    config = read_config(config_files)
+    if config is None:
+        sys.stderr.write("Failed to read config file. Try -c parameter\n")
+        sys.exit(4);
+
+    if args.command == 'stats':
+        path = stats_socket(config)
+        if path is None:
+            sys.stderr.write("The stats socket is disabled\n")
+            sys.exit(1)
+        try:
+            sys.stdout.write(query_stats(path))
+        except socket.error as err:
+            sys.stderr.write("Failed to read stats from %s: %s\n" % (path, err))
+            sys.exit(1)
+        sys.exit(0)
 
     # Initialize logging
     if args.command == 'debug':
@@ -502,7 +4375,7 @@ if __name__ == "__main__":
     # Initialize the daemon
     options = init_daemon(config.defaults())
     options['files_preserve'] = [loghandler.stream]
-    options['func_arg'] = config
+    options['func_arg'] = config_files
     daemon = DaemonRunner(watcher, **options)
     
     # Execute the command
@@ -515,6 +4388,8 @@ if __name__ == "__main__":
     elif 'restart' == args.command:
         daemon.restart()
         #logger.info('Daemon restarted')
+    elif 'reload' == args.command:
+        daemon.reload()
     elif 'debug' == args.command:
         logger.warning('Press Control+C to quit...')
         daemon.run()